@@ -0,0 +1,136 @@
+import argparse
+import json
+from types import SimpleNamespace
+
+# Exercises the Gemini prompt prefix cache against a local stub client (no network, no
+# API key) and reports cached vs uncached input tokens for a simulated chat session.
+# The stub counts ~4 characters per token, like Gemini's own rough estimate, and keeps
+# cached contents with a TTL on a fake clock so that renewal and schema-change
+# invalidation can be checked deterministically.
+#
+# Usage: python bench-prompt-cache.py --turns 20 --tables 40 --columns 12
+
+import sql_assistant
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def contents_text(contents):
+    return "".join(part["text"] for message in contents for part in message["parts"])
+
+
+class StubCaches:
+    def __init__(self, clock):
+        self.clock = clock
+        self.store = {}
+        self.created = self.updated = self.deleted = 0
+
+    def create(self, model, config):
+        self.created += 1
+        name = f"cachedContents/stub-{self.created}"
+        self.store[name] = {"text": config.system_instruction, "expires_at": self.clock() + int(config.ttl.rstrip("s"))}
+        return SimpleNamespace(name=name, model=model)
+
+    def update(self, name, config):
+        entry = self.live(name)
+        self.updated += 1
+        entry["expires_at"] = self.clock() + int(config.ttl.rstrip("s"))
+
+    def delete(self, name):
+        self.deleted += 1
+        self.store.pop(name, None)
+
+    def live(self, name):
+        entry = self.store.get(name)
+        if entry is None or entry["expires_at"] <= self.clock():
+            raise RuntimeError(f"404 NOT_FOUND: {name}")
+        return entry
+
+
+class StubModels:
+    def __init__(self, caches):
+        self.caches = caches
+
+    def generate_content(self, model, contents, config=None):
+        cached_tokens = 0
+        prefix_tokens = 0
+        if config is not None and config.cached_content:
+            cached_tokens = count_tokens(self.caches.live(config.cached_content)["text"])
+        elif config is not None and config.system_instruction:
+            prefix_tokens = count_tokens(config.system_instruction)
+        prompt_tokens = cached_tokens + prefix_tokens + count_tokens(contents_text(contents))
+        json_mode = config is not None and config.response_mime_type == "application/json"
+        text = json.dumps({"kind": "sql", "sql": "SELECT 1"}) if json_mode else "SELECT 1"
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=count_tokens(text),
+                                cached_content_token_count=cached_tokens or None)
+        return SimpleNamespace(text=text, prompt_feedback=None, usage_metadata=usage)
+
+
+def synthetic_schema(num_databases, num_tables, num_columns, salt=""):
+    return {
+        f"db_{d}": {f"table_{d}_{t}{salt}": [f"column_{c}_{'x' * (c % 5)}" for c in range(num_columns)] for t in range(num_tables)}
+        for d in range(num_databases)
+    }
+
+
+def run_turns(turns, schema, history):
+    for turn in range(turns):
+        question = f"question number {turn}: show the ten most recent rows of table_0_{turn % 5}"
+        sql = sql_assistant.generate_sql_with_gemini(question, schema, history)
+        history += [{"role": "user", "parts": [{"text": question}]}, {"role": "model", "parts": [{"text": sql}]}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count cached vs uncached prompt tokens against a stub Gemini client.")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--databases", type=int, default=3)
+    parser.add_argument("--tables", type=int, default=40)
+    parser.add_argument("--columns", type=int, default=12)
+    args = parser.parse_args()
+
+    clock = FakeClock()
+    caches = StubCaches(clock)
+    sql_assistant.gemini_client = SimpleNamespace(models=StubModels(caches), caches=caches)
+    sql_assistant.gemini_initialized = True
+    manager = sql_assistant.prompt_cache = sql_assistant.PromptCacheManager(clock=clock)
+    schema = synthetic_schema(args.databases, args.tables, args.columns)
+    prefix_tokens = count_tokens(sql_assistant.build_stable_prefix(schema))
+
+    history = []
+    run_turns(args.turns, schema, history)
+    stats = dict(manager.stats)
+    uncached = stats["prompt_tokens"] - stats["cached_tokens"]
+    print(f"stable prefix: ~{prefix_tokens} tokens; {stats['requests']} requests")
+    print(f"prompt tokens {stats['prompt_tokens']}, cached {stats['cached_tokens']} "
+          f"({stats['cached_tokens'] / stats['prompt_tokens']:.1%}), uncached {uncached}")
+    print(f"without the cache every token would be uncached: {stats['prompt_tokens']} "
+          f"({stats['prompt_tokens'] / max(1, uncached):.1f}x the uncached tokens above)")
+    print(f"cache creates {caches.created}, renewals {caches.updated}, deletes {caches.deleted}")
+
+    # TTL renewal: a request inside the renewal margin extends the cache rather than recreating it.
+    clock.now += sql_assistant.PROMPT_CACHE_TTL_SECONDS - sql_assistant.PROMPT_CACHE_RENEW_MARGIN_SECONDS + 1
+    run_turns(1, schema, history)
+    print(f"after renewal window: creates {caches.created}, renewals {caches.updated}")
+
+    # Schema change: new fingerprint -> new cache, the superseded one is deleted.
+    run_turns(1, synthetic_schema(args.databases, args.tables, args.columns, salt="_v2"), history)
+    print(f"after schema change: creates {caches.created}, deletes {caches.deleted}, live caches {len(caches.store)}")
+
+    # Expiry without renewal (e.g. server idle past the TTL): the cache is recreated.
+    clock.now += sql_assistant.PROMPT_CACHE_TTL_SECONDS * 2
+    run_turns(1, schema, history)
+    print(f"after expiry: creates {caches.created}, final stats {manager.stats}")
+
+
+if __name__ == "__main__":
+    main()
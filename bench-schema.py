@@ -0,0 +1,78 @@
+import argparse
+import gzip
+import json
+import os
+import runpy
+import statistics
+import time
+
+# Benchmarks how schema-dependent code paths scale with catalog size.
+# For each DATABASESxTABLESxCOLUMNS size it (re)creates the deterministic benchmark
+# catalog from gen-data.py and reports:
+#   - introspection time of fetch_all_tables_and_columns()
+#   - size of the schema listing sent in the SQL-generation prompt
+#   - size of the /schema JSON payload (raw and gzipped)
+#
+# Usage: python bench-schema.py --sizes 1x10x8 5x20x10 10x50x12 --repeat 3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# gen-data.py is not importable by name (hyphen), so load its functions via runpy.
+gen_data = runpy.run_path(os.path.join(HERE, "gen-data.py"), run_name="gen_data")
+
+import sql_assistant # noqa: E402 (reads the same .env as gen-data.py)
+
+
+def benchmark_size(num_databases, num_tables, num_columns, seed, repeat):
+    """Creates one catalog size and measures the schema-dependent paths against it."""
+    gen_data["create_catalog"](num_databases, num_tables, num_columns, seed=seed)
+
+    timings = []
+    schema = {}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        schema = sql_assistant.fetch_all_tables_and_columns()
+        timings.append(time.perf_counter() - started)
+    if "error" in schema:
+        raise SystemExit(f"Schema introspection failed: {schema['error']}")
+
+    prompt_schema = sql_assistant.format_schema_for_prompt(schema)
+    payload = json.dumps({"schema": schema}).encode("utf-8")
+    return {
+        "size": f"{num_databases}x{num_tables}x{num_columns}",
+        "tables": sum(len(tables) for tables in schema.values() if isinstance(tables, dict)),
+        "introspect_ms": statistics.median(timings) * 1000,
+        "prompt_chars": len(prompt_schema),
+        "prompt_tokens_est": len(prompt_schema) // 4, # ~4 characters per token
+        "payload_kb": len(payload) / 1024,
+        "payload_gzip_kb": len(gzip.compress(payload)) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark schema introspection, prompt size and /schema payload as the catalog grows.")
+    parser.add_argument("--sizes", nargs="+", type=gen_data["parse_catalog_size"], default=[(1, 10, 8), (5, 20, 10), (10, 50, 12)],
+                        metavar="DBSxTABLESxCOLS", help="Catalog sizes to benchmark, smallest first.")
+    parser.add_argument("--seed", type=int, default=7, help="Catalog generator seed.")
+    parser.add_argument("--repeat", type=int, default=3, help="Introspection runs per size (median is reported).")
+    parser.add_argument("--keep", action="store_true", help="Keep the last catalog instead of dropping it.")
+    args = parser.parse_args()
+
+    rows = []
+    try:
+        for num_databases, num_tables, num_columns in args.sizes:
+            rows.append(benchmark_size(num_databases, num_tables, num_columns, args.seed, max(1, args.repeat)))
+    finally:
+        if not args.keep:
+            gen_data["drop_catalog"]()
+
+    header = f"{'catalog':>12} {'tables':>7} {'introspect ms':>14} {'prompt chars':>13} {'~tokens':>8} {'/schema KB':>11} {'gzip KB':>8}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['size']:>12} {row['tables']:>7} {row['introspect_ms']:>14.1f} {row['prompt_chars']:>13} "
+              f"{row['prompt_tokens_est']:>8} {row['payload_kb']:>11.1f} {row['payload_gzip_kb']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import gzip
+import os
+
+# Precompresses static assets at build/deploy time so the server can send
+# ready-made .br/.gz variants instead of compressing on every request.
+# CachingStaticFiles in sql_assistant.py picks a variant by Accept-Encoding and
+# ignores any variant older than its source file, so rerun this after editing assets.
+#
+# Usage: python build-static.py [--directory static] [--clean]
+
+try:
+    import brotli # Optional: without it only .gz variants are written
+except ImportError:
+    brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPRESSIBLE_EXTENSIONS = (".js", ".css", ".html", ".svg", ".json", ".map", ".txt")
+MIN_SIZE = 1024 # Smaller files are served as-is
+VARIANT_SUFFIXES = (".gz", ".br")
+
+
+def write_if_smaller(path, data, source_size):
+    """Writes a compressed variant only when it actually saves bytes."""
+    if len(data) >= source_size:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def precompress(directory):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                source = f.read()
+            if len(source) < MIN_SIZE:
+                continue
+            # mtime=0 keeps the .gz output byte-identical across builds.
+            gz_size = write_if_smaller(path + ".gz", gzip.compress(source, compresslevel=9, mtime=0), len(source))
+            br_size = None
+            if brotli is not None:
+                br_size = write_if_smaller(path + ".br", brotli.compress(source, quality=11), len(source))
+            print(f"{os.path.relpath(path, directory):<24} {len(source):>9} B"
+                  f"  gz {gz_size if gz_size is not None else '-':>8}"
+                  f"  br {br_size if br_size is not None else '-':>8}")
+    if brotli is None:
+        print("brotli is not installed; only .gz variants were written (pip install brotli).")
+
+
+def clean(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(VARIANT_SUFFIXES) and name[:-3].endswith(COMPRESSIBLE_EXTENSIONS):
+                os.remove(os.path.join(root, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write precompressed .gz/.br variants of static assets.")
+    parser.add_argument("--directory", default=os.path.join(HERE, "static"), help="Static asset directory.")
+    parser.add_argument("--clean", action="store_true", help="Remove existing variants instead of building them.")
+    args = parser.parse_args()
+    if args.clean:
+        clean(args.directory)
+    else:
+        precompress(args.directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,12 @@ import random
 from dotenv import load_dotenv
 import os
 from decimal import Decimal # Import Decimal for price
+import argparse
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date
+import numpy as np
 
 load_dotenv()
 
@@ -302,29 +308,382 @@ def insert_product_data(products):
             conn.close()
 
 
-# --- Main script execution ---
-print("Starting data generation process...")
-
-# 1. Create Databases
-create_database_if_not_exist(MYSQL_DATABASE_MAIN)
-create_database_if_not_exist(MYSQL_DATABASE_STORE)
-
-# 2. Create Tables in respective databases
-create_main_tables_if_not_exist()
-create_store_tables_if_not_exist()
-
-# 3. Generate Data
-num_employee_records = 500 # Reduced for potentially faster runs
-num_product_records = 200  # Generate fewer products
-print(f"Generating {num_employee_records} employee/salary records...")
-employees_data = generate_employee_data(num_employee_records)
-salaries_data = generate_salary_data(employees_data)
-
-print(f"Generating {num_product_records} product records...")
-products_data = generate_product_data(num_product_records)
+# === Scale-Factor Bulk Generation ===
+# `--scale N` generates N x SCALE_UNIT_EMPLOYEES employees (plus one salary row each)
+# and N x SCALE_UNIT_PRODUCTS products. Columns are generated with NumPy from small
+# pre-sampled Faker pools, chunks are produced in parallel worker processes as
+# tab-separated temp files, and each file is bulk loaded as soon as it is ready.
+
+SCALE_UNIT_EMPLOYEES = 100_000
+SCALE_UNIT_PRODUCTS = 40_000
+SCALE_CHUNK_ROWS = 250_000 # Rows per generated temp file
+NAME_POOL_SIZE = 2_000
+INSERT_BATCH_ROWS = 10_000 # Rows per multi-row INSERT when LOAD DATA is unavailable
+
+DEPARTMENTS = ['HR', 'Finance', 'Engineering', 'Sales', 'Marketing', 'Operations']
+PRODUCT_CATEGORIES = ['Electronics', 'Clothing', 'Home Goods', 'Books', 'Groceries', 'Toys', 'Sports']
+
+def build_name_pools(seed):
+    """Pre-samples the Faker values that bulk generation draws from."""
+    pool_fake = Faker('en_IN')
+    pool_fake.seed_instance(seed)
+    return {
+        "first_names": [pool_fake.first_name() for _ in range(NAME_POOL_SIZE)],
+        "last_names": [pool_fake.last_name() for _ in range(NAME_POOL_SIZE)],
+        "product_names": [pool_fake.catch_phrase() for _ in range(NAME_POOL_SIZE)],
+    }
+
+def _write_tsv(path, columns):
+    """Writes equally long column arrays as a tab-separated file (one row per line)."""
+    with open(path, "w", encoding="utf-8", newline="\n") as tsv_file:
+        for offset in range(0, len(columns[0]), 50_000):
+            block = [column[offset:offset + 50_000].astype(str) for column in columns]
+            tsv_file.write("\n".join(map("\t".join, zip(*block))))
+            tsv_file.write("\n")
+
+def generate_employee_chunk(task):
+    """Worker: generates employees and salaries for ids [start_id, start_id + count) into two TSV files."""
+    start_id, count, seed, pools, out_dir = task
+    rng = np.random.default_rng(seed)
+    employee_ids = np.arange(start_id, start_id + count)
+    first_names = np.array(pools["first_names"], dtype=object)[rng.integers(0, NAME_POOL_SIZE, count)]
+    last_names = np.array(pools["last_names"], dtype=object)[rng.integers(0, NAME_POOL_SIZE, count)]
+    # Ages between 22 and 60, expressed as days before today
+    birth_dates = np.datetime64(date.today(), 'D') - rng.integers(22 * 365, 60 * 365, count).astype('timedelta64[D]')
+    department_codes = rng.integers(0, len(DEPARTMENTS), count)
+    departments = np.array(DEPARTMENTS, dtype=object)[department_codes]
+
+    # Same salary model as generate_salary_data, vectorized per department
+    base_salary = rng.integers(15000, 80001, count).astype(np.float64)
+    low = np.array([1.0, 1.3, 1.5, 1.2, 1.0, 1.0])[department_codes]
+    high = np.array([1.8, 2.8, 3.0, 2.5, 1.8, 1.8])[department_codes]
+    salary = base_salary * rng.uniform(low, high)
+    is_sales = department_codes == DEPARTMENTS.index('Sales')
+    salary[is_sales] += rng.integers(0, 50001, int(is_sales.sum()))
+    full_names = first_names + " " + last_names
+
+    employees_path = os.path.join(out_dir, f"employees_{start_id}.tsv")
+    salaries_path = os.path.join(out_dir, f"salaries_{start_id}.tsv")
+    _write_tsv(employees_path, [employee_ids, first_names, last_names, birth_dates, departments])
+    _write_tsv(salaries_path, [employee_ids, full_names, salary.astype(np.int64), departments])
+    return [("employees", employees_path, count), ("salaries", salaries_path, count)]
+
+def generate_product_chunk(task):
+    """Worker: generates `count` products into a TSV file."""
+    start_id, count, seed, pools, out_dir = task
+    rng = np.random.default_rng(seed)
+    product_names = np.array(pools["product_names"], dtype=object)[rng.integers(0, NAME_POOL_SIZE, count)]
+    categories = np.array(PRODUCT_CATEGORIES, dtype=object)[rng.integers(0, len(PRODUCT_CATEGORIES), count)]
+    prices = np.char.mod("%.2f", rng.uniform(5.00, 2500.00, count))
+    stock = rng.integers(0, 501, count)
+    products_path = os.path.join(out_dir, f"products_{start_id}.tsv")
+    _write_tsv(products_path, [product_names, categories, prices, stock])
+    return [("products", products_path, count)]
+
+BULK_TABLES = {
+    "employees": (MYSQL_DATABASE_MAIN, "employee_id, first_name, last_name, date_of_birth, department"),
+    "salaries": (MYSQL_DATABASE_MAIN, "employee_id, full_name, salary, departments"),
+    "products": (MYSQL_DATABASE_STORE, "product_name, category, price, stock_quantity"),
+}
+
+def recreate_tables_for_bulk_load(conn):
+    """Drops and recreates the sample tables without secondary keys; see add_deferred_indexes()."""
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS `{MYSQL_DATABASE_MAIN}`.salaries")
+    cursor.execute(f"DROP TABLE IF EXISTS `{MYSQL_DATABASE_MAIN}`.employees")
+    cursor.execute(f"DROP TABLE IF EXISTS `{MYSQL_DATABASE_STORE}`.products")
+    # Primary keys stay: rows are generated in key order, which InnoDB appends cheaply.
+    cursor.execute(f"""
+    CREATE TABLE `{MYSQL_DATABASE_MAIN}`.employees (
+        employee_id INT PRIMARY KEY,
+        first_name VARCHAR(50),
+        last_name VARCHAR(50),
+        date_of_birth DATE,
+        department VARCHAR(50)
+    )""")
+    cursor.execute(f"""
+    CREATE TABLE `{MYSQL_DATABASE_MAIN}`.salaries (
+        employee_id INT,
+        full_name VARCHAR(100),
+        salary INT,
+        departments VARCHAR(50)
+    )""")
+    cursor.execute(f"""
+    CREATE TABLE `{MYSQL_DATABASE_STORE}`.products (
+        product_id INT AUTO_INCREMENT PRIMARY KEY,
+        product_name VARCHAR(100) NOT NULL,
+        category VARCHAR(50),
+        price DECIMAL(10, 2),
+        stock_quantity INT,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )""")
+    cursor.close()
+
+def add_deferred_indexes(conn):
+    """Adds the foreign key (and its index) that the regular schema declares, after the load."""
+    cursor = conn.cursor()
+    cursor.execute(f"ALTER TABLE `{MYSQL_DATABASE_MAIN}`.salaries ADD FOREIGN KEY (employee_id) REFERENCES `{MYSQL_DATABASE_MAIN}`.employees(employee_id)")
+    cursor.close()
+
+def load_tsv(conn, table, path, method):
+    """Loads one generated TSV file with LOAD DATA LOCAL INFILE or multi-row INSERT batches."""
+    db_name, columns = BULK_TABLES[table]
+    cursor = conn.cursor()
+    try:
+        if method == "infile":
+            cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE `{db_name}`.`{table}` "
+                f"CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({columns})",
+                (path,)
+            )
+        else:
+            placeholders = ", ".join(["%s"] * len(columns.split(",")))
+            query = f"INSERT INTO `{db_name}`.`{table}` ({columns}) VALUES ({placeholders})"
+            with open(path, encoding="utf-8") as tsv_file:
+                batch = []
+                for line in tsv_file:
+                    batch.append(line.rstrip("\n").split("\t"))
+                    if len(batch) >= INSERT_BATCH_ROWS:
+                        cursor.executemany(query, batch) # Rewritten into one multi-row INSERT by the connector
+                        batch = []
+                if batch:
+                    cursor.executemany(query, batch)
+        conn.commit()
+    finally:
+        cursor.close()
+
+def run_bulk_generation(scale, workers, method, seed):
+    """Generates and loads a scale-factor dataset, reporting rows/sec per table."""
+    num_employees = int(scale * SCALE_UNIT_EMPLOYEES)
+    num_products = int(scale * SCALE_UNIT_PRODUCTS)
+    print(f"Bulk generation at scale {scale}: {num_employees} employees/salaries, {num_products} products "
+          f"({workers} workers, load method: {method}).")
+
+    pools = build_name_pools(seed)
+    conn = mysql.connector.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        auth_plugin='mysql_native_password',
+        allow_local_infile=(method == "infile")
+    )
+    cursor = conn.cursor()
+    cursor.execute("SET SESSION unique_checks = 0")
+    cursor.execute("SET SESSION foreign_key_checks = 0")
+    cursor.close()
+    recreate_tables_for_bulk_load(conn)
+
+    loaded = {table: 0 for table in BULK_TABLES}
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="gen-data-") as out_dir:
+        tasks = []
+        for index, start in enumerate(range(0, num_employees, SCALE_CHUNK_ROWS)):
+            tasks.append((generate_employee_chunk, (start + 1, min(SCALE_CHUNK_ROWS, num_employees - start), seed + index, pools, out_dir)))
+        for index, start in enumerate(range(0, num_products, SCALE_CHUNK_ROWS)):
+            tasks.append((generate_product_chunk, (start + 1, min(SCALE_CHUNK_ROWS, num_products - start), seed + 1_000_000 + index, pools, out_dir)))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Keep at most two chunks per worker in flight so temp files never pile up
+            # on disk; each chunk is loaded as soon as it is ready while others generate.
+            pending = set()
+            task_iter = iter(tasks)
+            while True:
+                while len(pending) < workers * 2:
+                    next_task = next(task_iter, None)
+                    if next_task is None:
+                        break
+                    pending.add(executor.submit(next_task[0], next_task[1]))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for table, path, rows in future.result():
+                        load_tsv(conn, table, path, method)
+                        os.remove(path)
+                        loaded[table] += rows
+                total = sum(loaded.values())
+                elapsed = time.perf_counter() - started
+                print(f"  loaded {total} rows ({total / elapsed:,.0f} rows/sec)")
+
+    load_elapsed = time.perf_counter() - started
+    print("Adding deferred indexes...")
+    index_started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("SET SESSION foreign_key_checks = 1")
+    cursor.close()
+    add_deferred_indexes(conn)
+    index_elapsed = time.perf_counter() - index_started
+    conn.close()
+
+    total = sum(loaded.values())
+    for table, rows in loaded.items():
+        print(f"  {table}: {rows} rows")
+    print(f"Generated and loaded {total} rows in {load_elapsed:.1f}s ({total / load_elapsed:,.0f} rows/sec); "
+          f"indexes built in {index_elapsed:.1f}s.")
+
+
+# === Wide-Catalog Benchmark Schemas ===
+# Deterministic N databases x M tables x K columns catalogs for exercising the code
+# paths that grow with catalog size (schema introspection, the schema prompt and the
+# /schema payload). Databases are prefixed with CATALOG_DB_PREFIX so they can be
+# dropped again with --drop-catalog. See bench-schema.py for the benchmark.
+
+CATALOG_DB_PREFIX = "bench_catalog_"
+CATALOG_DOMAINS = [
+    'sales', 'finance', 'hr', 'inventory', 'marketing', 'support', 'logistics', 'billing',
+    'analytics', 'crm', 'procurement', 'payroll', 'catalog', 'shipping', 'audit', 'identity',
+]
+CATALOG_ENTITIES = [
+    'customers', 'orders', 'order_items', 'invoices', 'payments', 'products', 'suppliers',
+    'warehouses', 'shipments', 'employees', 'departments', 'accounts', 'transactions',
+    'campaigns', 'leads', 'tickets', 'contracts', 'regions', 'stores', 'returns', 'refunds',
+    'subscriptions', 'plans', 'vendors', 'budgets', 'ledgers', 'assets', 'audits', 'sessions',
+    'events', 'reviews', 'coupons', 'carriers', 'routes', 'teams', 'projects', 'timesheets',
+]
+CATALOG_ATTRIBUTES = [
+    ('name', 'VARCHAR(100)'), ('code', 'VARCHAR(20)'), ('status', "ENUM('active','inactive','pending')"),
+    ('email', 'VARCHAR(255)'), ('phone', 'VARCHAR(30)'), ('description', 'TEXT'),
+    ('amount', 'DECIMAL(12,2)'), ('quantity', 'INT'), ('unit_price', 'DECIMAL(10,2)'),
+    ('discount_rate', 'DOUBLE'), ('is_active', 'TINYINT(1)'), ('created_at', 'DATETIME'),
+    ('updated_at', 'TIMESTAMP NULL'), ('due_date', 'DATE'), ('score', 'FLOAT'),
+    ('country', 'CHAR(2)'), ('city', 'VARCHAR(80)'), ('postal_code', 'VARCHAR(12)'),
+    ('notes', 'VARCHAR(500)'), ('priority', 'SMALLINT'), ('external_ref', 'BIGINT'),
+    ('currency', 'CHAR(3)'), ('weight_kg', 'DECIMAL(8,3)'), ('metadata', 'JSON'),
+]
+CATALOG_MAX_FOREIGN_KEYS = 2
+
+def build_catalog_ddl(num_databases, num_tables, num_columns, seed):
+    """
+    Returns {db_name: [CREATE TABLE ...]} for a seeded catalog. Every table has an `id`
+    primary key, up to CATALOG_MAX_FOREIGN_KEYS `<table>_id` columns referencing
+    earlier tables in the same database, and typed attribute columns up to num_columns.
+    """
+    rng = random.Random(seed)
+    catalog = {}
+    for db_index in range(num_databases):
+        domain = CATALOG_DOMAINS[db_index % len(CATALOG_DOMAINS)]
+        db_name = f"{CATALOG_DB_PREFIX}{db_index:03d}_{domain}"
+        entities = rng.sample(CATALOG_ENTITIES, len(CATALOG_ENTITIES))
+        tables = []
+        statements = []
+        for table_index in range(num_tables):
+            entity = entities[table_index % len(entities)]
+            table_name = entity if table_index < len(entities) else f"{entity}_{table_index // len(entities)}"
+            columns = ["id INT AUTO_INCREMENT PRIMARY KEY"]
+            constraints = []
+            if tables:
+                references = rng.sample(tables, min(len(tables), rng.randint(0, CATALOG_MAX_FOREIGN_KEYS), max(0, num_columns - 1)))
+                for referenced in references:
+                    columns.append(f"`{referenced}_id` INT")
+                    constraints.append(f"FOREIGN KEY (`{referenced}_id`) REFERENCES `{db_name}`.`{referenced}`(id)")
+            used = set()
+            while len(columns) < num_columns:
+                attribute, column_type = rng.choice(CATALOG_ATTRIBUTES)
+                column_name = attribute
+                suffix = 2
+                while column_name in used:
+                    column_name = f"{attribute}_{suffix}"
+                    suffix += 1
+                used.add(column_name)
+                columns.append(f"`{column_name}` {column_type}")
+            statements.append(f"CREATE TABLE `{db_name}`.`{table_name}` (\n    " + ",\n    ".join(columns + constraints) + "\n)")
+            tables.append(table_name)
+        catalog[db_name] = statements
+    return catalog
+
+def drop_catalog():
+    """Drops every database created by create_catalog()."""
+    conn = mysql.connector.connect(host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD, auth_plugin='mysql_native_password')
+    cursor = conn.cursor()
+    cursor.execute("SHOW DATABASES LIKE %s", (CATALOG_DB_PREFIX.replace("_", "\\_") + "%",))
+    databases = [row[0] for row in cursor.fetchall()]
+    for db_name in databases:
+        cursor.execute(f"DROP DATABASE `{db_name}`")
+    print(f"Dropped {len(databases)} catalog databases.")
+    cursor.close()
+    conn.close()
+
+def create_catalog(num_databases, num_tables, num_columns, seed=7):
+    """Replaces any existing benchmark catalog with a freshly generated one."""
+    drop_catalog()
+    catalog = build_catalog_ddl(num_databases, num_tables, num_columns, seed)
+    conn = mysql.connector.connect(host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD, auth_plugin='mysql_native_password')
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    for db_name, statements in catalog.items():
+        cursor.execute(f"CREATE DATABASE `{db_name}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+        for statement in statements:
+            cursor.execute(statement)
+    cursor.close()
+    conn.close()
+    print(f"Created catalog {num_databases}x{num_tables}x{num_columns} "
+          f"({num_databases * num_tables} tables) in {time.perf_counter() - started:.1f}s.")
+    return catalog
+
+def parse_catalog_size(value):
+    """Parses 'DATABASESxTABLESxCOLUMNS', e.g. '10x50x12'."""
+    try:
+        num_databases, num_tables, num_columns = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("catalog size must look like DATABASESxTABLESxCOLUMNS, e.g. 10x50x12")
+    if min(num_databases, num_tables, num_columns) < 1:
+        raise argparse.ArgumentTypeError("catalog dimensions must be positive")
+    return num_databases, num_tables, num_columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and populate the sample databases.")
+    parser.add_argument("--scale", type=float, default=None,
+                        help=f"Bulk mode: generate SCALE x {SCALE_UNIT_EMPLOYEES} employees/salaries and SCALE x {SCALE_UNIT_PRODUCTS} products.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Generator processes for bulk mode.")
+    parser.add_argument("--load-method", choices=["infile", "insert"], default="infile",
+                        help="Bulk mode loader: LOAD DATA LOCAL INFILE (needs local_infile=ON on the server) or multi-row INSERT batches.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for bulk mode and the benchmark catalog.")
+    parser.add_argument("--catalog", type=parse_catalog_size, default=None, metavar="DBSxTABLESxCOLS",
+                        help="Create a deterministic wide benchmark catalog instead of the sample data, e.g. 10x50x12.")
+    parser.add_argument("--drop-catalog", action="store_true", help="Drop the benchmark catalog databases and exit.")
+    args = parser.parse_args()
+
+    if args.drop_catalog:
+        drop_catalog()
+        return
+    if args.catalog:
+        create_catalog(*args.catalog, seed=args.seed)
+        return
+
+    print("Starting data generation process...")
+
+    # 1. Create Databases
+    create_database_if_not_exist(MYSQL_DATABASE_MAIN)
+    create_database_if_not_exist(MYSQL_DATABASE_STORE)
+
+    if args.scale:
+        run_bulk_generation(args.scale, max(1, args.workers), args.load_method, args.seed)
+        print("Data generation process finished.")
+        return
+
+    # 2. Create Tables in respective databases
+    create_main_tables_if_not_exist()
+    create_store_tables_if_not_exist()
+
+    # 3. Generate Data
+    num_employee_records = 500 # Reduced for potentially faster runs
+    num_product_records = 200  # Generate fewer products
+    print(f"Generating {num_employee_records} employee/salary records...")
+    employees_data = generate_employee_data(num_employee_records)
+    salaries_data = generate_salary_data(employees_data)
+
+    print(f"Generating {num_product_records} product records...")
+    products_data = generate_product_data(num_product_records)
+
+    # 4. Insert Data into respective databases
+    insert_main_data_into_mysql(employees_data, salaries_data)
+    insert_product_data(products_data)
+
+    print("Data generation process finished.")
 
-# 4. Insert Data into respective databases
-insert_main_data_into_mysql(employees_data, salaries_data)
-insert_product_data(products_data)
 
-print("Data generation process finished.")
\ No newline at end of file
+# --- Main script execution ---
+# Guarded so that bulk-mode worker processes can import this file safely.
+if __name__ == "__main__":
+    main()
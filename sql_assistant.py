@@ -1,12 +1,27 @@
 import os
 import logging
 import json
-from typing import List, Dict, Any, Tuple, Optional
+import io
+import zlib
+import gzip
+import hashlib
+import threading
+import asyncio
+import heapq
+import bisect
+from collections import OrderedDict, deque
+import mimetypes
+import time
+import random
+from typing import List, Dict, Any, Tuple, Optional, Literal
 import mysql.connector
+import mysql.connector.pooling
 import sqlparse
-from mysql.connector import FieldType
-from fastapi import FastAPI, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from mysql.connector import FieldType, FieldFlag
+from mysql.connector.conversion import MySQLConverter
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.encoders import jsonable_encoder
@@ -14,13 +29,18 @@ from pydantic import BaseModel
 from google import genai
 from dotenv import load_dotenv
 import functools
+import itertools
 import uuid
 from fastapi_sessions.frontends.implementations import SessionCookie, CookieParameters
 from fastapi_sessions.backends.implementations import InMemoryBackend
 from fastapi_sessions.session_verifier import SessionVerifier
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 import re
-from starlette.staticfiles import StaticFiles
+from operator import itemgetter
+import numpy as np
+import httpx
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.datastructures import Headers
 
 # --- Configuration ---
 load_dotenv() # Load environment variables from .env file
@@ -33,6 +53,14 @@ logger = logging.getLogger(__name__)
 MYSQL_HOST = os.getenv("MYSQL_HOST", "localhost")
 MYSQL_USER = os.getenv("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "root")
+DB_POOL_SIZE = 5 # Connections in the shared "mypool" pool (and in each replica's pool)
+
+# Read replicas for read-only queries and schema introspection: "host[:port],host[:port]".
+# Empty keeps all traffic on MYSQL_HOST.
+MYSQL_REPLICA_HOSTS = [host.strip() for host in os.getenv("MYSQL_REPLICA_HOSTS", "").split(",") if host.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_SELECTION = os.getenv("REPLICA_SELECTION", "least_busy").lower() # "least_busy" or "round_robin"
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
 
 # Gemini API Configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
@@ -47,6 +75,25 @@ gemini_client: Optional[genai.client.Client] = None
 # In-memory store for chat history (a list of message dictionaries)
 MAX_HISTORY_LENGTH = 20 # Max number of user/model turn pairs to keep
 
+# Gemini admission control: concurrent calls and an optional input+output token budget per minute (0 = no budget).
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "0"))
+
+# Chat queries slower than this get an EXPLAIN-based index advisor in the response (0 = off).
+# EXPLAIN ANALYZE runs the query a second time, so it is opt-in.
+QUERY_ADVISOR_THRESHOLD_MS = float(os.getenv("QUERY_ADVISOR_THRESHOLD_MS", "1000"))
+QUERY_ADVISOR_ANALYZE = os.getenv("QUERY_ADVISOR_ANALYZE", "false").lower() in ("1", "true", "yes")
+
+# Overall deadline for one /chat turn (schema fetch, SQL generation, execution, insights/explanations).
+CHAT_LATENCY_BUDGET_SECONDS = float(os.getenv("CHAT_LATENCY_BUDGET_SECONDS", "20"))
+
+# Resolve uncertain chat turns with one structured Gemini call (SQL or reply) instead of
+# SQL generation followed by a separate conversational call.
+COMBINED_GENERATION = os.getenv("COMBINED_GENERATION", "true").lower() not in ("0", "false", "no")
+
+# Answer questions that differ from an earlier one only in a literal from a learned template, without Gemini.
+QUESTION_TEMPLATES = os.getenv("QUESTION_TEMPLATES", "true").lower() not in ("0", "false", "no")
+
 # Path to .env file
 ENV_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
 
@@ -162,10 +209,26 @@ def initialize_gemini_api():
 # Initialize Gemini API on startup
 initialize_gemini_api()
 
+def install_gemini_client(api_key: str, validated: bool):
+    """
+    Swaps in a client for a key that /config already validated (no second test call).
+    Calls in flight keep the client object they started with.
+    """
+    global gemini_initialized, gemini_client
+    if api_key and validated:
+        gemini_client, gemini_initialized = genai.Client(api_key=api_key), True
+        logger.info("Gemini client swapped for the new API key")
+    else:
+        gemini_client, gemini_initialized = None, False
+
 # Function to update environment variables and .env file
-def update_environment(config_data):
-    """Updates environment variables and .env file with new configurations."""
+def update_environment(config_data, gemini_validated: bool = False):
+    """
+    Updates environment variables and .env file with new configurations.
+    The primary connection pool is swapped separately (see SwappablePool.rebuild).
+    """
     global MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, GEMINI_API_KEY
+    previous_gemini_client = gemini_client
     
     defaults = {
         "mysql_host": "localhost",
@@ -187,14 +250,22 @@ def update_environment(config_data):
     
     # For Gemini API key, allow an empty string from config_data to be set
     if "gemini_api_key" in config_data:
-        GEMINI_API_KEY = config_data["gemini_api_key"]
+        requested_gemini_key = config_data["gemini_api_key"]
+    else:
+        requested_gemini_key = defaults["gemini_api_key"] # Should not happen if key always in config_data
+    if requested_gemini_key == GEMINI_API_KEY and gemini_client is not None:
+        pass # Same key: keep the working client even if this test failed or timed out
+    elif requested_gemini_key and not gemini_validated:
+        if requested_gemini_key != GEMINI_API_KEY:
+            logger.warning("The new Gemini API key failed its test; keeping the current key and client.")
     else:
-        GEMINI_API_KEY = defaults["gemini_api_key"] # Should not happen if key always in config_data
+        GEMINI_API_KEY = requested_gemini_key
+        install_gemini_client(GEMINI_API_KEY, gemini_validated)
     os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
-    if config_data.get("gemini_api_key") or defaults["gemini_api_key"]:
-        initialize_gemini_api() # Reinitialize if key is set or was previously set and now defaulted
     
     update_env_file() # Call without arguments
+    schema_flight.forget() # A schema from the previous server must not be served as stale
+    prompt_cache.invalidate(previous_gemini_client) # Cached prefixes embed that schema and belong to the previous key
     logger.info("Environment variables updated with new configuration")
 
 # Function to update .env file
@@ -261,42 +332,660 @@ def update_env_file(): # Removed config_data and defaults parameters
         logger.error(f"Error updating .env file: {e}")
 
 # --- Database Interaction ---
+# Connections come from PoolGeneration objects: a mysql.connector pool plus a count of
+# its checked-out connections. A /config change builds and warms the replacement pool
+# off the request path and swaps it in atomically (SwappablePool.rebuild); the retired
+# pool keeps serving the connections already checked out and is closed once the last
+# one comes back.
+
+CONFIG_TEST_TIMEOUT_SECONDS = 5 # Credential checks on /config
+
+def primary_connection_config() -> Dict[str, Any]:
+    """Connection settings for the primary, from the current configuration."""
+    return {"host": MYSQL_HOST, "user": MYSQL_USER, "password": MYSQL_PASSWORD, "auth_plugin": 'mysql_native_password'}
+
+class _PooledConnection:
+    """A pooled connection that releases its pool generation's in-flight slot on close()."""
+
+    def __init__(self, conn, release):
+        self._conn = conn
+        self._release = release
+
+    def close(self):
+        try:
+            self._conn.close()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class PoolGeneration:
+    """One mysql.connector pool and its checked-out connections."""
+
+    def __init__(self, label: str, config: Dict[str, Any], size: int = DB_POOL_SIZE):
+        self.label = label
+        # Opens all `size` connections up front, which is the warm-up.
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(pool_name=label, pool_size=size, **config)
+        self.in_flight = 0
+        self.retired = False
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        """A connection from this pool; raises mysql.connector.errors.PoolError when all are in use."""
+        conn = self.pool.get_connection()
+        with self._lock:
+            self.in_flight += 1
+        return _PooledConnection(conn, self._release)
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+            drained = self.retired and self.in_flight == 0
+        if drained:
+            self._close()
+
+    def retire(self):
+        """Stops handing out this pool; it closes once every checked-out connection is returned."""
+        with self._lock:
+            self.retired = True
+            drained = self.in_flight == 0
+        if drained:
+            self._close()
+
+    def _close(self):
+        try:
+            closed = self.pool._remove_connections() # mysql.connector has no public way to close a pool
+            logger.info(f"Drained retired connection pool {self.label} ({closed} connections closed)")
+        except Exception as e:
+            logger.warning(f"Error while closing retired connection pool {self.label}: {e}")
+
+class SwappablePool:
+    """The primary's pool, replaceable without interrupting queries that are already running."""
+
+    def __init__(self, name: str = "mypool"):
+        self.name = name
+        self.current: Optional[PoolGeneration] = None
+        self.generation = 0
+        self.target = 0 # Generation the latest rebuild() is building; older builds are discarded
+        self.stats = {"swaps": 0, "failed_builds": 0}
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+
+    def _next_label(self) -> Tuple[int, str]:
+        with self._lock:
+            self.generation += 1
+            return self.generation, f"{self.name}{self.generation}"
+
+    def get_connection(self):
+        """Checks out a connection, creating the pool from the current configuration on first use."""
+        current = self.current
+        if current is None:
+            with self._create_lock:
+                current = self.current
+                if current is None:
+                    _, label = self._next_label()
+                    current = self.current = PoolGeneration(label, primary_connection_config())
+        return current.checkout()
+
+    def rebuild(self, config: Dict[str, Any]) -> bool:
+        """Builds and warms a pool for `config`, then swaps it in unless a newer rebuild started meanwhile."""
+        number, label = self._next_label()
+        with self._lock:
+            self.target = number
+        try:
+            fresh = PoolGeneration(label, config)
+        except mysql.connector.Error as err:
+            logger.error(f"Could not build connection pool {label}: {err}")
+            self.stats["failed_builds"] += 1
+            return False
+        with self._lock:
+            superseded = number != self.target
+            if not superseded:
+                previous, self.current = self.current, fresh
+        if superseded:
+            fresh.retire()
+            return False
+        self.stats["swaps"] += 1
+        logger.info(f"Swapped in connection pool {label}")
+        if previous is not None:
+            previous.retire()
+        return True
+
+    def reset(self):
+        """Retires the current pool; the next checkout builds one from the current configuration."""
+        with self._lock:
+            self.target = 0
+            previous, self.current = self.current, None
+        if previous is not None:
+            previous.retire()
 
-def get_db_connection(db_name: Optional[str] = None):
+    def describe(self) -> Dict[str, Any]:
+        current = self.current
+        return {"pool": current.label if current else None, "in_flight": current.in_flight if current else 0, **self.stats}
+
+primary_pool = SwappablePool()
+
+def get_db_connection(db_name: Optional[str] = None, read_only: bool = False, session_id: Optional[uuid.UUID] = None):
     """
     Establishes a connection to the MySQL server.
     Connects to a specific database if db_name is provided.
+    read_only connections come from a healthy replica when one is configured (see
+    DatasourceRouter), falling back to the primary.
     Returns the connection object or None if connection fails.
     """
+    if read_only:
+        conn = datasource_router.replica_connection(db_name, session_id)
+        if conn is not None:
+            return conn
     try:
-        conn_params = {
-            'host': MYSQL_HOST,
-            'user': MYSQL_USER,
-            'password': MYSQL_PASSWORD,
-            'pool_name': "mypool", 
-            'pool_size': 5,
-            'auth_plugin': 'mysql_native_password'
-        }
+        conn = primary_pool.get_connection()
         if db_name:
-            conn_params['database'] = db_name
-
-        conn = mysql.connector.connect(**conn_params)
+            try:
+                conn.cmd_init_db(db_name)
+            except mysql.connector.Error:
+                conn.close()
+                raise
         logger.info(f"DB connection established (Database: {db_name or 'None'})")
         return conn
     except mysql.connector.Error as err:
         logger.error(f"Database connection error (connecting to {db_name or 'server'}): {err}")
-        return None 
+        return None
+
+# --- Datasource Routing ---
+# Reads go to replicas listed in MYSQL_REPLICA_HOSTS, each with its own pool, picked by
+# least in-flight connections (or round robin). A background health check (started from
+# lifespan) drops replicas that are unreachable, not replicating, or more than
+# REPLICA_MAX_LAG_SECONDS behind. Writes, and reads when no replica is usable, stay on
+# the primary. A session that just wrote reads from the primary for
+# READ_YOUR_WRITES_SECONDS so it sees its own change.
+
+REPLICA_HEALTH_CHECK_SECONDS = 10
+REPLICA_CONNECT_TIMEOUT_SECONDS = 3
+
+class Replica:
+    """One replica host: its connection pool, health and current load."""
+
+    def __init__(self, address: str, index: int):
+        host, _, port = address.partition(":")
+        self.name = address
+        self.host = host
+        self.port = int(port or 3306)
+        self.pool_name = f"replica{index}"
+        self.pool: Optional[PoolGeneration] = None # Created by the first passing health check
+        self.pool_builds = 0
+        self.healthy = False # Unused until the first health check passes
+        self.lag_seconds: Optional[float] = None
+        self.status = "unchecked"
+
+    @property
+    def in_flight(self) -> int:
+        pool = self.pool
+        return pool.in_flight if pool is not None else 0
+
+    def build_pool(self):
+        self.pool_builds += 1
+        self.pool = PoolGeneration(f"{self.pool_name}_{self.pool_builds}", {
+            "host": self.host, "port": self.port, "user": MYSQL_USER, "password": MYSQL_PASSWORD,
+            "auth_plugin": 'mysql_native_password', "connection_timeout": REPLICA_CONNECT_TIMEOUT_SECONDS})
+
+    def describe(self) -> Dict[str, Any]:
+        return {"host": self.name, "healthy": self.healthy, "lag_seconds": self.lag_seconds, "in_flight": self.in_flight, "status": self.status}
+
+class DatasourceRouter:
+    """Chooses a replica connection for reads and tracks replica health."""
+
+    def __init__(self, addresses: List[str], selection: str = REPLICA_SELECTION, max_lag_seconds: float = REPLICA_MAX_LAG_SECONDS,
+                 read_your_writes_seconds: float = READ_YOUR_WRITES_SECONDS, clock=time.monotonic):
+        self.replicas = [Replica(address, index) for index, address in enumerate(addresses)]
+        self.selection = selection
+        self.max_lag_seconds = max_lag_seconds
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.clock = clock
+        self.recent_writes: Dict[str, float] = {} # session id -> time of its last write
+        self.stats = {"replica_reads": 0, "read_your_writes": 0, "replica_unavailable": 0}
+        self._lock = threading.Lock()
+        self._round_robin = 0
+
+    def note_write(self, session_id: Optional[uuid.UUID]):
+        if session_id is not None and self.replicas:
+            self.recent_writes[str(session_id)] = self.clock()
+
+    def _reads_own_write(self, session_id: Optional[uuid.UUID]) -> bool:
+        if session_id is None or not self.recent_writes:
+            return False
+        now = self.clock()
+        # Forget expired windows so the map stays small.
+        for key, written_at in list(self.recent_writes.items()):
+            if now - written_at > self.read_your_writes_seconds:
+                self.recent_writes.pop(key, None)
+        return str(session_id) in self.recent_writes
+
+    def _candidates(self) -> List[Replica]:
+        with self._lock:
+            healthy = [replica for replica in self.replicas if replica.healthy]
+            if not healthy:
+                return []
+            start = self._round_robin % len(healthy)
+            self._round_robin += 1
+            ordered = healthy[start:] + healthy[:start]
+            if self.selection != "round_robin":
+                ordered.sort(key=lambda replica: replica.in_flight) # Stable: ties keep round-robin order
+            return ordered
+
+    def _checkout(self, replica: Replica, db_name: Optional[str]):
+        pool = replica.pool
+        if pool is None:
+            return None
+        try:
+            conn = pool.checkout()
+        except mysql.connector.errors.PoolError:
+            return None # Busy, not broken: try the next replica
+        except mysql.connector.Error as err:
+            logger.warning(f"Replica {replica.name} unavailable, dropping it until the next health check: {err}")
+            replica.healthy, replica.status = False, f"connect failed: {err}"
+            return None
+        if db_name:
+            try:
+                conn.cmd_init_db(db_name)
+            except mysql.connector.Error:
+                conn.close()
+                raise
+        return conn
 
-def execute_sql_query(query: str) -> Tuple[Optional[List[Any]], Optional[List[str]], Optional[str], int, Optional[str]]:
+    def replica_connection(self, db_name: Optional[str] = None, session_id: Optional[uuid.UUID] = None):
+        """A connection to a usable replica, or None when the read must go to the primary."""
+        if not self.replicas:
+            return None
+        if self._reads_own_write(session_id):
+            self.stats["read_your_writes"] += 1
+            return None
+        for replica in self._candidates():
+            conn = self._checkout(replica, db_name)
+            if conn is not None:
+                self.stats["replica_reads"] += 1
+                return conn
+        self.stats["replica_unavailable"] += 1
+        return None
+
+    def read_endpoint(self) -> Tuple[str, int]:
+        """Host and port for a dedicated (non-pooled) read connection such as a streaming export."""
+        candidates = self._candidates()
+        return (candidates[0].host, candidates[0].port) if candidates else (MYSQL_HOST, 3306)
+
+    def check_replica(self, replica: Replica):
+        """Updates one replica's health from SHOW REPLICA STATUS (SHOW SLAVE STATUS before MySQL 8.0.22)."""
+        conn = None
+        try:
+            conn = mysql.connector.connect(host=replica.host, port=replica.port, user=MYSQL_USER, password=MYSQL_PASSWORD,
+                                           auth_plugin='mysql_native_password', connection_timeout=REPLICA_CONNECT_TIMEOUT_SECONDS)
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.Error:
+                cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            cursor.close()
+        except mysql.connector.Error as err:
+            replica.healthy, replica.lag_seconds, replica.status = False, None, f"health check failed: {err}"
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        if not row:
+            replica.healthy, replica.lag_seconds, replica.status = False, None, "not configured as a replica"
+            return
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        if lag is None: # Replication threads stopped
+            replica.healthy, replica.lag_seconds, replica.status = False, None, "replication is not running"
+        elif float(lag) > self.max_lag_seconds:
+            replica.healthy, replica.lag_seconds, replica.status = False, float(lag), f"lagging {lag}s (limit {self.max_lag_seconds:g}s)"
+        else:
+            if replica.pool is None:
+                # Opening the pool's connections happens here, off the request path.
+                try:
+                    replica.build_pool()
+                except mysql.connector.Error as err:
+                    replica.healthy, replica.lag_seconds, replica.status = False, float(lag), f"pool creation failed: {err}"
+                    return
+            if not replica.healthy:
+                logger.info(f"Replica {replica.name} is serving reads (lag {lag}s)")
+            replica.healthy, replica.lag_seconds, replica.status = True, float(lag), "ok"
+
+    async def run_health_checks(self, interval: float = REPLICA_HEALTH_CHECK_SECONDS):
+        """Background loop that re-checks every replica each interval."""
+        while True:
+            for replica in self.replicas:
+                was_healthy = replica.healthy
+                await run_in_threadpool(self.check_replica, replica)
+                if was_healthy and not replica.healthy:
+                    logger.warning(f"Replica {replica.name} removed from rotation: {replica.status}")
+            await asyncio.sleep(interval)
+
+    def reset_pools(self):
+        """After a credentials change: retire every replica pool; health checks rebuild them."""
+        for replica in self.replicas:
+            pool, replica.pool = replica.pool, None
+            replica.healthy, replica.status = False, "reconfiguring"
+            if pool is not None:
+                pool.retire()
+
+    def describe(self) -> Dict[str, Any]:
+        return {"replicas": [replica.describe() for replica in self.replicas], "selection": self.selection, **self.stats}
+
+datasource_router = DatasourceRouter(MYSQL_REPLICA_HOSTS)
+
+# --- Raw Result Encoding ---
+# With a raw cursor the connector hands back each cell exactly as it came off the
+# wire (text protocol bytes). The helpers below turn those bytes straight into
+# JSON text using the column types from cursor.description, so numbers, dates and
+# strings never become Decimal/datetime/str objects just to be serialised again.
+# The JSON produced matches what jsonable_encoder emits for the converted values.
+
+_RAW_PASSTHROUGH_TYPES = {
+    FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.LONGLONG, FieldType.INT24,
+    FieldType.YEAR, FieldType.FLOAT, FieldType.DOUBLE, FieldType.DECIMAL, FieldType.NEWDECIMAL,
+}
+_RAW_DATETIME_TYPES = {FieldType.DATETIME, FieldType.TIMESTAMP}
+_RAW_DATE_TYPES = {FieldType.DATE, FieldType.NEWDATE}
+
+def _raw_passthrough(value: bytes) -> bytes:
+    return value # Numeric text from the wire is already valid JSON
+
+def _raw_string(value: bytes) -> bytes:
+    return json.encoder.encode_basestring(value.decode("utf-8", "replace")).encode("utf-8")
+
+def _raw_datetime(value: bytes) -> bytes:
+    if value.startswith(b"0000-00-00"): # The connector maps zero dates to None
+        return b"null"
+    return b'"' + bytes(value).replace(b" ", b"T", 1) + b'"'
+
+def _raw_date(value: bytes) -> bytes:
+    if value.startswith(b"0000-00-00"):
+        return b"null"
+    return b'"' + bytes(value) + b'"'
+
+def _raw_time(value: bytes) -> bytes:
+    # TIME is converted to timedelta by the connector, which jsonable_encoder emits as total seconds.
+    text = value.decode("ascii")
+    sign = -1 if text.startswith("-") else 1
+    hours, minutes, seconds = text.lstrip("-").split(":")
+    total = sign * (int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+    return repr(float(total)).encode("ascii")
+
+def _raw_bit(value: bytes) -> bytes:
+    return str(int.from_bytes(value, "big")).encode("ascii")
+
+def _raw_set(value: bytes) -> bytes:
+    members = value.decode("utf-8", "replace").split(",") if value else []
+    return json.dumps(members, ensure_ascii=False).encode("utf-8")
+
+def _raw_converter_for(field_type: int, flags: int):
+    """Picks the bytes -> JSON text converter for a column from its wire type and flags."""
+    if flags & FieldFlag.SET:
+        return _raw_set
+    if field_type in _RAW_PASSTHROUGH_TYPES:
+        return _raw_passthrough
+    if field_type in _RAW_DATETIME_TYPES:
+        return _raw_datetime
+    if field_type in _RAW_DATE_TYPES:
+        return _raw_date
+    if field_type == FieldType.TIME:
+        return _raw_time
+    if field_type == FieldType.BIT:
+        return _raw_bit
+    return _raw_string
+
+class RawRows:
+    """
+    Rows fetched through a raw cursor, kept as wire bytes until they are rendered.
+
+    `to_json()` produces the JSON array text for the rows without building a Python
+    object per cell; `to_python()` decodes (a prefix of) them for code that needs values.
+    """
+
+    def __init__(self, rows: List[Tuple[Optional[bytes], ...]], description: List[Tuple[Any, ...]]):
+        self.rows = rows
+        self.description = description
+        self._converters = [_raw_converter_for(col[1], col[7] or 0) for col in description]
+        self.profile: Optional[Dict[str, Any]] = None # Set by execute_sql_query, see profile_result()
+        self.snapshot: Optional["ResultSnapshot"] = None # Set by execute_sql_query(snapshot=True)
+        self.elapsed_ms: Optional[float] = None # Statement execution plus fetch, set by execute_sql_query
+        self.total_rows = len(rows) # Rows in the full result; more than len(self) when only a prefix was kept
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __bool__(self) -> bool:
+        return bool(self.rows)
+
+    def _row_json(self, row: Tuple[Optional[bytes], ...]) -> bytes:
+        return b"[" + b",".join(b"null" if value is None else convert(value) for convert, value in zip(self._converters, row)) + b"]"
+
+    def to_json(self, limit: Optional[int] = None) -> bytes:
+        """Renders the rows (optionally only the first `limit`) as a JSON array."""
+        rows = self.rows if limit is None else self.rows[:limit]
+        return b"[" + b",".join(self._row_json(row) for row in rows) + b"]"
+
+    def to_python(self, limit: Optional[int] = None) -> List[List[Any]]:
+        """Decodes the rows into JSON-compatible Python values."""
+        return json.loads(self.to_json(limit))
+
+def _encode_json_body(response_data: Dict[str, Any]) -> bytes:
+    """Encodes a response dict, splicing pre-encoded RawRows/SnapshotRows results into the body."""
+    results = response_data.get("results")
+    if not isinstance(results, (RawRows, SnapshotRows)):
+        return json.dumps(jsonable_encoder(response_data), ensure_ascii=False).encode("utf-8")
+    rest = {key: value for key, value in response_data.items() if key != "results"}
+    body = json.dumps(jsonable_encoder(rest), ensure_ascii=False).encode("utf-8")
+    return body[:-1] + (b', "results": ' if rest else b'"results": ') + results.to_json() + b"}"
+
+def _json_response(response_data: Dict[str, Any], status_code: int = 200) -> Response:
+    """
+    Builds a JSON response, splicing pre-encoded RawRows/SnapshotRows results into the
+    body instead of passing them through jsonable_encoder.
+    """
+    if not isinstance(response_data.get("results"), (RawRows, SnapshotRows)):
+        return JSONResponse(content=jsonable_encoder(response_data), status_code=status_code)
+    return Response(content=_encode_json_body(response_data), media_type="application/json", status_code=status_code)
+
+# --- Result Profiling ---
+# The insights prompt used to see only the first 20 rows. Instead, every raw result is
+# profiled column by column over everything the buffered cursor fetched (up to
+# RESULT_PROFILE_MAX_ROWS), or a uniform random sample of RESULT_PROFILE_SAMPLE_ROWS of
+# it for larger results, once the connection is back in the pool. The compact profile is
+# sent alongside a small sample of rows.
+
+RESULT_DISPLAY_LIMIT = 100 # Rows returned to the UI
+RESULT_PROFILE_MAX_ROWS = 1000000 # Rows fetched (and counted) for insights
+RESULT_PROFILE_SAMPLE_ROWS = 100000 # Rows actually profiled; larger results are sampled
+PROFILE_TOP_K = 5
+PROFILE_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+PROFILE_MAX_VALUE_BYTES = 64 # Longer strings are truncated for distinct/top-k purposes
+PROFILE_MAX_CORRELATED_COLUMNS = 12
+PROFILE_MIN_ABS_CORRELATION = 0.3
+INSIGHTS_SAMPLE_ROWS = 8 # Rows sent verbatim next to the profile
+
+def _profile_object_column(rows: List[Tuple[Any, ...]], index: int, fill: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Extracts one column as an object array of bytes, with NULLs replaced by `fill`."""
+    column = np.fromiter(map(itemgetter(index), rows), dtype=object, count=len(rows))
+    nulls = np.equal(column, None)
+    present = column[~nulls]
+    if present.size and isinstance(present[0], bytearray):
+        # The pure-Python connector hands back bytearrays, which NumPy cannot cast to S.
+        column = np.fromiter((fill if value is None else bytes(value) for value in column), dtype=object, count=len(column))
+    else:
+        column[nulls] = fill
+    return column, nulls
+
+def _hash_fixed_width(values: np.ndarray) -> np.ndarray:
+    """FNV-style 64-bit hash of every element of a fixed-width bytes array, computed 8 bytes at a time."""
+    n, width = values.shape[0], values.dtype.itemsize
+    padded_width = max(8, (width + 7) // 8 * 8)
+    buffer = np.zeros((n, padded_width), dtype=np.uint8)
+    if width:
+        buffer[:, :width] = values.view(np.uint8).reshape(n, width)
+    words = buffer.view(np.uint64)
+    hashes = np.full(n, 0xcbf29ce484222325, dtype=np.uint64)
+    prime = np.uint64(0x100000001b3)
+    for j in range(words.shape[1]):
+        hashes ^= words[:, j]
+        hashes *= prime
+    return hashes
+
+def _round_stat(value: float) -> Any:
+    if not np.isfinite(value):
+        return None
+    return int(value) if float(value).is_integer() else round(float(value), 4)
+
+def _profile_numeric(values: np.ndarray, nulls: np.ndarray, stats: Dict[str, Any]) -> np.ndarray:
+    numbers = values.astype(np.float64)
+    present = numbers[~nulls]
+    if present.size:
+        quantiles = np.quantile(present, PROFILE_QUANTILES)
+        uniques, counts = np.unique(present, return_counts=True)
+        stats.update({
+            "distinct": int(uniques.size),
+            "min": _round_stat(present.min()),
+            "max": _round_stat(present.max()),
+            "mean": _round_stat(present.mean()),
+            "std": _round_stat(present.std()),
+            "quantiles": {f"p{int(q * 100)}": _round_stat(v) for q, v in zip(PROFILE_QUANTILES, quantiles)},
+        })
+        if uniques.size <= PROFILE_TOP_K * 4: # Low-cardinality numbers are usually codes or categories
+            top = np.argsort(counts, kind="stable")[::-1][:PROFILE_TOP_K]
+            stats["top"] = [[_round_stat(uniques[i]), int(counts[i])] for i in top]
+    return numbers
+
+_TEMPORAL_DIGIT_POSITIONS = {
+    "date": [0, 1, 2, 3, 5, 6, 8, 9], # YYYY-MM-DD
+    "datetime": [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22, 23, 24, 25], # YYYY-MM-DD HH:MM:SS[.ffffff]
+}
+
+def _profile_temporal(values: np.ndarray, nulls: np.ndarray, stats: Dict[str, Any], kind: str) -> None:
+    # MySQL sends dates as fixed-layout text, so the digits are read straight out of the
+    # bytes into a sortable integer key instead of parsing every value as a datetime.
+    positions = _TEMPORAL_DIGIT_POSITIONS[kind]
+    fixed = values.astype(f"S{positions[-1] + 1}")
+    text = fixed.view(np.uint8).reshape(len(fixed), -1)
+    keys = np.zeros(len(fixed), dtype=np.int64)
+    for position in positions:
+        digit = text[:, position].astype(np.int64) - ord("0")
+        keys *= 10
+        keys += np.maximum(digit, 0) # Missing fractional seconds are zero-padded by NumPy
+    nulls = nulls | (keys == 0) # The connector maps zero dates to None
+    present = keys[~nulls]
+    if present.size:
+        present_values = fixed[~nulls]
+        stats.update({
+            "distinct": int(np.unique(present).size),
+            "min": present_values[np.argmin(present)].decode("ascii", "replace"),
+            "max": present_values[np.argmax(present)].decode("ascii", "replace"),
+        })
+    stats["nulls"] = int(nulls.sum())
+
+def _profile_categorical(values: np.ndarray, nulls: np.ndarray, stats: Dict[str, Any]) -> None:
+    fixed = values.astype(f"S{PROFILE_MAX_VALUE_BYTES}")
+    present = fixed[~nulls]
+    if present.size:
+        hashes, first_index, counts = np.unique(_hash_fixed_width(present), return_index=True, return_counts=True)
+        top = np.argsort(counts, kind="stable")[::-1][:PROFILE_TOP_K]
+        stats["distinct"] = int(hashes.size)
+        stats["top"] = [[present[first_index[i]].decode("utf-8", "replace"), int(counts[i])] for i in top]
+
+def profile_result(rows: List[Tuple[Any, ...]], description: List[Tuple[Any, ...]]) -> Dict[str, Any]:
+    """
+    Computes per-column summaries of raw result rows with NumPy: non-null count, nulls,
+    distinct count (hash based for strings), min/max/mean/std/quantiles for numbers,
+    min/max for dates, top-k values for categories and pairwise numeric correlations.
+    Results over RESULT_PROFILE_SAMPLE_ROWS are profiled on a uniform random sample
+    (`sampled_rows`); counts then describe the sample.
+    """
+    profile: Dict[str, Any] = {"row_count": len(rows), "columns": [], "correlations": []}
+    if not rows:
+        return profile
+    if len(rows) > RESULT_PROFILE_SAMPLE_ROWS:
+        rows = random.sample(rows, RESULT_PROFILE_SAMPLE_ROWS)
+        profile["sampled_rows"] = len(rows)
+    numeric_columns: List[Tuple[str, np.ndarray]] = []
+    for index, column in enumerate(description):
+        name, field_type, flags = column[0], column[1], column[7] or 0
+        stats: Dict[str, Any] = {"name": name, "type": FieldType.get_info(field_type)}
+        try:
+            if field_type in _RAW_PASSTHROUGH_TYPES and not flags & FieldFlag.SET:
+                values, nulls = _profile_object_column(rows, index, b"nan")
+                numbers = _profile_numeric(values, nulls, stats)
+                numeric_columns.append((name, numbers))
+            elif field_type in _RAW_DATETIME_TYPES or field_type in _RAW_DATE_TYPES:
+                values, nulls = _profile_object_column(rows, index, b"")
+                _profile_temporal(values, nulls, stats, "datetime" if field_type in _RAW_DATETIME_TYPES else "date")
+            else:
+                values, nulls = _profile_object_column(rows, index, b"")
+                _profile_categorical(values, nulls, stats)
+            stats.setdefault("nulls", int(nulls.sum()))
+            stats["count"] = len(rows) - stats["nulls"]
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Could not profile column '{name}': {e}")
+        profile["columns"].append(stats)
+
+    if len(numeric_columns) > 1:
+        names = [name for name, _ in numeric_columns[:PROFILE_MAX_CORRELATED_COLUMNS]]
+        matrix = np.vstack([numbers for _, numbers in numeric_columns[:PROFILE_MAX_CORRELATED_COLUMNS]])
+        complete = ~np.isnan(matrix).any(axis=0)
+        if complete.sum() > 2:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                coefficients = np.corrcoef(matrix[:, complete])
+            for i in range(len(names)):
+                for j in range(i + 1, len(names)):
+                    r = coefficients[i, j]
+                    if np.isfinite(r) and abs(r) >= PROFILE_MIN_ABS_CORRELATION:
+                        profile["correlations"].append([names[i], names[j], round(float(r), 3)])
+    return profile
+
+def format_result_profile(profile: Dict[str, Any]) -> str:
+    """Renders a profile as compact, one-line-per-column text for the insights prompt."""
+    if "sampled_rows" in profile:
+        lines = [f"Rows profiled: {profile['sampled_rows']} sampled at random from {profile['row_count']} (counts describe the sample)"]
+    else:
+        lines = [f"Rows profiled: {profile['row_count']}"]
+    for stats in profile["columns"]:
+        parts = [f"{key}={stats[key]}" for key in ("count", "nulls", "distinct", "min", "max", "mean", "std") if key in stats]
+        if "quantiles" in stats:
+            parts.append(" ".join(f"{k}={v}" for k, v in stats["quantiles"].items()))
+        if "top" in stats:
+            parts.append("top=" + ", ".join(f"{value}({count})" for value, count in stats["top"]))
+        lines.append(f"- {stats['name']} ({stats['type']}): " + " ".join(parts))
+    if profile["correlations"]:
+        lines.append("Correlations (Pearson r): " + ", ".join(f"{a}~{b}={r}" for a, b, r in profile["correlations"]))
+    return "\n".join(lines)
+
+def execute_sql_query(query: str, raw: bool = False, timeout_ms: Optional[int] = None, profile: bool = True, session_id: Optional[uuid.UUID] = None,
+                      snapshot: bool = False, bound: Optional[Tuple[List[str], Tuple[Any, ...]]] = None) -> Tuple[Optional[Any], Optional[List[str]], Optional[str], int, Optional[str]]:
     """
     Executes an SQL query against the database.
 
     Args:
         query: The SQL query string to execute.
+        raw: Fast path. Fetch through a raw cursor (served by the C extension when it is
+             installed) and return the rows as RawRows, deferring type conversion until
+             the rows are rendered to JSON.
+        timeout_ms: Server-side limit for SELECT statements (MySQL max_execution_time).
+             The pool resets the session when the connection is returned.
+        profile: With raw=True, fetch and profile the full result for insights. Callers
+             that only display rows pass False to fetch just the display limit.
+        session_id: The requesting session. Read-only queries are routed to a replica
+             unless this session wrote recently (see DatasourceRouter).
+        snapshot: With raw=True and profile=True, also keep the full result as a
+             ResultSnapshot on `results.snapshot` (see Result Snapshots).
+        bound: A question template's (SQL segments, slot values). The statement run is the
+             segments with the values escaped by this connection; query is its display
+             form, used for routing, logs and the snapshot (see Question Templates).
 
     Returns:
         A tuple containing:
-        - results: List of result tuples (or None).
+        - results: List of result tuples, RawRows when raw=True (or None).
         - column_names: List of column names (or None).
         - column_types_str: String describing column names and types (or None).
         - status_code: 1 (SELECT/SHOW success), 2 (Other DML/DDL success), 3 (Error).
@@ -308,15 +997,17 @@ def execute_sql_query(query: str) -> Tuple[Optional[List[Any]], Optional[List[st
     results: Optional[List[Any]] = None
     column_names: Optional[List[str]] = None
     column_types_str: Optional[str] = None
+    full_rows: Optional[List[Any]] = None # Everything fetched for profiling, see below
 
     try:
-        conn = get_db_connection(db_name=None) # Connect WITHOUT specifying a default database
+        # Connect WITHOUT specifying a default database; read-only statements may use a replica.
+        conn = get_db_connection(db_name=None, read_only=get_query_risk_level(query) == 0, session_id=session_id)
         if not conn:
             error_message = "SQL Error: Failed to connect to the database server for query execution."
             logger.error(error_message)
             return None, None, None, 3, error_message
 
-        cursor = conn.cursor(buffered=True)
+        cursor = conn.cursor(buffered=True, raw=raw)
 
         # --- SECURITY WARNING ---
         # Executing arbitrary SQL generated by an LLM or user input is a
@@ -326,25 +1017,53 @@ def execute_sql_query(query: str) -> Tuple[Optional[List[Any]], Optional[List[st
         # 3. Limit database user permissions (e.g., read-only access).
         # 4. Consider query allow-listing or blocking certain commands.
         # This example executes the query directly for simplicity, but DO NOT deploy like this.
-        cursor.execute(query)
+        if timeout_ms:
+            cursor.execute(f"SET SESSION max_execution_time = {int(timeout_ms)}")
+        started = time.perf_counter()
+        cursor.execute(render_bound_sql(*bound, conn=conn) if bound is not None else query)
 
         query_lower = query.strip().lower()
         if query_lower.startswith("select") or query_lower.startswith("show"):
-            results = cursor.fetchmany(100) # Limit results for display
+            # The buffered cursor already holds the full result client-side; the raw path
+            # keeps all of it for profiling and trims what is displayed.
+            results = cursor.fetchmany(RESULT_PROFILE_MAX_ROWS if raw and profile else RESULT_DISPLAY_LIMIT)
             if cursor.description: 
                 column_names = [i[0] for i in cursor.description]
                 from mysql.connector.constants import FieldType # Ensure FieldType is imported
                 col_dtypes = [[i[0], FieldType.get_info(i[1])] for i in cursor.description]
                 column_types_str = 'Column : Dtype\n' + '\n'.join(f'{k}: {v}' for k, v in col_dtypes)
+                if raw:
+                    full_rows = results or []
+                    results = RawRows(full_rows[:RESULT_DISPLAY_LIMIT], list(cursor.description))
+                    results.elapsed_ms = (time.perf_counter() - started) * 1000
+                    results.total_rows = max(cursor.rowcount, len(full_rows)) # The buffered cursor counts every row it holds
             else:
                 column_names = ["Result"] 
                 column_types_str = "Column : Dtype\nResult: <unknown>"
                 if results and isinstance(results[0], (str, int, float, bytes)): 
                      results = [(r,) for r in results] # Wrap single values in tuples
+                if raw and results:
+                    results = results[:RESULT_DISPLAY_LIMIT]
+                    results = [tuple(v.decode("utf-8", "replace") if isinstance(v, (bytes, bytearray)) else v for v in row) for row in results]
 
             conn.commit() # Necessary even for SELECT with some configurations/engines
             result_count = len(results) if results is not None else 0
             logger.info(f"Query executed successfully, fetched {result_count} rows.")
+            if isinstance(results, RawRows) and profile:
+                # Profiling and snapshot building only need the fetched rows: release the
+                # connection first so other requests are not waiting on CPU work.
+                _close_query_connection(cursor, conn)
+                cursor = conn = None
+                # Both are optional extras: a failure leaves them None, never fails the query.
+                try:
+                    results.profile = profile_result(full_rows, results.description)
+                except Exception as e:
+                    logger.warning(f"Could not profile the result of '{query}': {e}", exc_info=True)
+                if snapshot:
+                    try:
+                        results.snapshot = ResultSnapshot.from_raw(query, full_rows, results.description)
+                    except Exception as e:
+                        logger.warning(f"Could not build a result snapshot for '{query}': {e}", exc_info=True)
             return results, column_names, column_types_str, 1, None
         else:
             conn.commit()
@@ -370,25 +1089,626 @@ def execute_sql_query(query: str) -> Tuple[Optional[List[Any]], Optional[List[st
                  logger.error(f"Error during rollback: {rb_err}")
         return None, None, None, 3, error_message
     finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected(): # Check conn exists and is connected before closing
-            conn.close()
-            logger.info("DB connection closed.")
+        _close_query_connection(cursor, conn)
+
+def _close_query_connection(cursor, conn):
+    if cursor:
+        cursor.close()
+    if conn and conn.is_connected(): # Check conn exists and is connected before closing
+        conn.close()
+        logger.info("DB connection closed.")
+
+# --- Result Snapshots ---
+# The full result of each chat query (up to RESULT_SNAPSHOT_MAX_ROWS) is kept per session
+# in a columnar form, so it can be sorted, filtered, grouped and aggregated again without
+# another SQL generation or MySQL round trip. Numeric columns hold float64 values next to
+# the original JSON text of every cell (so DECIMALs render exactly as MySQL sent them).
+# Other columns are dictionary-encoded: each distinct JSON cell is stored once, in sorted
+# order, and rows hold its int32 code, so comparisons, sorts and grouping stay in NumPy.
+
+RESULT_SNAPSHOT_MAX_ROWS = 200000
+RESULT_SNAPSHOTS_PER_SESSION = 5
+RESULT_SNAPSHOT_MAX_BYTES = 256 * 1024 * 1024 # Across all sessions; least recently used snapshots go first
+RESULT_SNAPSHOT_AGGREGATES = ("count", "count_distinct", "sum", "avg", "min", "max")
+
+_NUMERIC_CONVERTERS = (_raw_passthrough, _raw_time, _raw_bit)
+
+def _category_key(cell: bytes) -> str:
+    value = json.loads(cell)
+    return value if isinstance(value, str) else json.dumps(value)
+
+class _SnapshotColumn:
+    """One column of a result snapshot: float64 values + JSON text, or sorted dictionary codes."""
+
+    def __init__(self, name: str, type_name: str, values: Optional[np.ndarray] = None, data: Optional[bytes] = None,
+                 offsets: Optional[np.ndarray] = None, codes: Optional[np.ndarray] = None, categories: Optional[List[bytes]] = None,
+                 keys: Optional[List[str]] = None):
+        self.name = name
+        self.type_name = type_name
+        self.numeric = values is not None
+        self.values = values # float64, NaN for NULL
+        self.data = data # Concatenated JSON text of every cell (numeric columns read from a table)
+        self.offsets = offsets
+        self.codes = codes # int32 index into categories, -1 for NULL
+        self.categories = categories # JSON text of each distinct value, for output only
+        self.keys = keys # The decoded values, in the order the categories are sorted by
+
+    @classmethod
+    def from_raw(cls, rows: List[Tuple[Any, ...]], index: int, column: Tuple[Any, ...]) -> "_SnapshotColumn":
+        name, field_type, flags = column[0], column[1], column[7] or 0
+        convert = _raw_converter_for(field_type, flags)
+        type_name = FieldType.get_info(field_type)
+        raw_values, nulls = _profile_object_column(rows, index, b"")
+        if convert in _NUMERIC_CONVERTERS:
+            cells = [b"null" if null else bytes(convert(value)) for value, null in zip(raw_values, nulls)]
+            values = np.fromiter((float(cell) for cell in cells), dtype=np.float64, count=len(cells)) if not nulls.any() else \
+                np.fromiter((np.nan if null else float(cell) for cell, null in zip(cells, nulls)), dtype=np.float64, count=len(cells))
+            offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+            np.cumsum(np.fromiter(map(len, cells), dtype=np.int64, count=len(cells)), out=offsets[1:])
+            return cls(name, type_name, values=values, data=b"".join(cells), offsets=offsets)
+        codes = np.full(len(raw_values), -1, dtype=np.int32)
+        categories: List[bytes] = []
+        keys: List[str] = []
+        if not nulls.all():
+            # Factorize the wire values first, so only distinct values are converted to JSON.
+            distinct, inverse = np.unique(raw_values[~nulls], return_inverse=True)
+            converted = [convert(value) for value in distinct]
+            present = np.array([cell != b"null" for cell in converted]) # Zero dates convert to null
+            # Sorted by the decoded value: in JSON text the closing quote would put "New York" before "New".
+            decoded = [_category_key(cell) if keep else "" for cell, keep in zip(converted, present)]
+            order = sorted(np.flatnonzero(present), key=decoded.__getitem__)
+            rank = np.full(len(distinct), -1, dtype=np.int32)
+            rank[order] = np.arange(len(order), dtype=np.int32)
+            codes[~nulls] = rank[inverse.reshape(-1)]
+            categories = [converted[i] for i in order]
+            keys = [decoded[i] for i in order]
+        return cls(name, type_name, codes=codes, categories=categories, keys=keys)
+
+    def __len__(self) -> int:
+        return len(self.values) if self.numeric else len(self.codes)
+
+    @property
+    def nulls(self) -> np.ndarray:
+        return np.isnan(self.values) if self.numeric else self.codes < 0
+
+    @property
+    def nbytes(self) -> int:
+        if self.numeric:
+            return self.values.nbytes + (len(self.data) + self.offsets.nbytes if self.data is not None else 0)
+        # 33 and 49: bytes and str object overhead
+        return self.codes.nbytes + sum(len(category) + 33 for category in self.categories) + sum(len(key) + 49 for key in self.keys)
+
+    def cell(self, row: int) -> bytes:
+        if self.numeric:
+            if self.data is not None:
+                return self.data[self.offsets[row]:self.offsets[row + 1]]
+            value = _round_stat(self.values[row]) # Computed aggregates
+            return b"null" if value is None else json.dumps(value).encode("ascii")
+        code = self.codes[row]
+        return b"null" if code < 0 else self.categories[code]
+
+    def sort_key(self, descending: bool) -> np.ndarray:
+        """Key for np.lexsort that orders this column as requested with NULLs last."""
+        if self.numeric:
+            return -self.values if descending else self.values # NaN sorts last either way
+        keys = self.codes.astype(np.int64)
+        keys = -keys if descending else keys
+        keys[self.codes < 0] = np.iinfo(np.int64).max
+        return keys
+
+    def group_ids(self) -> np.ndarray:
+        """Equal values share an id (NULLs form one group)."""
+        if self.numeric:
+            return np.unique(self.values, return_inverse=True)[1].reshape(-1)
+        return self.codes
+
+    def _text_bound(self, value: Any, side: str) -> int:
+        """Position of a literal among the sorted categories, compared as decoded text."""
+        return (bisect.bisect_left if side == "left" else bisect.bisect_right)(self.keys, str(value))
+
+    def mask(self, op: str, value: Any) -> np.ndarray:
+        """Boolean row mask for `column <op> value`; NULL only matches is_null."""
+        if op == "is_null":
+            return self.nulls
+        if op == "not_null":
+            return ~self.nulls
+        if op == "in":
+            if not isinstance(value, list):
+                raise ValueError(f"Filter 'in' on '{self.name}' needs a list of values.")
+            result = np.zeros(len(self), dtype=bool)
+            for item in value:
+                result |= self.mask("eq", item)
+            return result
+        if op == "contains":
+            needle = str(value).lower()
+            if self.numeric:
+                raise ValueError(f"Filter 'contains' needs a text column; '{self.name}' is numeric.")
+            matching = [code for code, key in enumerate(self.keys) if needle in key.lower()]
+            return np.isin(self.codes, np.array(matching, dtype=np.int32))
+        if self.numeric:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Column '{self.name}' is numeric; '{value}' is not a number.")
+            with np.errstate(invalid="ignore"):
+                return {"eq": np.equal, "ne": np.not_equal, "lt": np.less, "le": np.less_equal, "gt": np.greater, "ge": np.greater_equal}[op](self.values, number) & ~self.nulls
+        # Categories are sorted, so every comparison becomes a comparison of codes.
+        left, right = self._text_bound(value, "left"), self._text_bound(value, "right")
+        present = self.codes >= 0
+        return {
+            "eq": (self.codes >= left) & (self.codes < right),
+            "ne": present & ((self.codes < left) | (self.codes >= right)),
+            "lt": present & (self.codes < left),
+            "le": present & (self.codes < right),
+            "gt": self.codes >= right,
+            "ge": self.codes >= left,
+        }[op]
+
+class SnapshotRows:
+    """Rows of a snapshot query as (column, row index) views; rendered straight to JSON like RawRows."""
+
+    def __init__(self, columns: List[Tuple[_SnapshotColumn, np.ndarray]]):
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns[0][1]) if self.columns else 0
+
+    def to_json(self) -> bytes:
+        return b"[" + b",".join(b"[" + b",".join(column.cell(index[row]) for column, index in self.columns) + b"]" for row in range(len(self))) + b"]"
+
+class ResultSnapshot:
+    """A query result held column by column for local sort/filter/group/aggregate."""
+
+    def __init__(self, query: str, columns: List[_SnapshotColumn], row_count: int, truncated: bool):
+        self.id = uuid.uuid4().hex[:16]
+        self.query = query
+        self.columns = columns
+        self.by_name = {column.name: column for column in columns}
+        self.row_count = row_count
+        self.truncated = truncated # The result had more rows than RESULT_SNAPSHOT_MAX_ROWS
+        self.created_at = time.time()
+        self.nbytes = sum(column.nbytes for column in columns)
+
+    @classmethod
+    def from_raw(cls, query: str, rows: List[Tuple[Any, ...]], description: List[Tuple[Any, ...]]) -> "ResultSnapshot":
+        kept = rows[:RESULT_SNAPSHOT_MAX_ROWS]
+        columns = [_SnapshotColumn.from_raw(kept, index, column) for index, column in enumerate(description)]
+        return cls(query, columns, len(kept), len(rows) > len(kept))
+
+    def summary(self) -> Dict[str, Any]:
+        return {"id": self.id, "query": self.query, "columns": [column.name for column in self.columns], "row_count": self.row_count,
+                "truncated": self.truncated, "bytes": self.nbytes, "created_at": self.created_at}
+
+    def _column(self, name: str, available: Dict[str, Any]) -> Any:
+        if name not in available:
+            raise ValueError(f"Unknown column '{name}'. Available: {', '.join(available)}")
+        return available[name]
+
+    def run(self, filters: List[Dict[str, Any]], group_by: List[str], aggregates: List[Dict[str, Any]], sort: List[Dict[str, Any]],
+            limit: int = RESULT_DISPLAY_LIMIT) -> Tuple[List[str], SnapshotRows, int]:
+        """
+        Applies filters, then grouping/aggregation, then sorting. Returns the output column
+        names, the first `limit` rows and the total row count; raises ValueError for invalid requests.
+        """
+        selected = np.ones(self.row_count, dtype=bool)
+        for condition in filters:
+            selected &= self._column(condition["column"], self.by_name).mask(condition["op"], condition.get("value"))
+        rows = np.flatnonzero(selected)
+
+        if group_by or aggregates:
+            table = self._aggregate(rows, group_by, aggregates)
+        else:
+            table = [(column.name, column, rows) for column in self.columns]
+
+        if sort:
+            available = {name: (column, index) for name, column, index in table}
+            keys = []
+            for order in reversed(sort): # np.lexsort sorts by the last key first
+                column, index = self._column(order["column"], available)
+                keys.append(column.sort_key(order.get("descending", False))[index])
+            permutation = np.lexsort(keys)
+            table = [(name, column, index[permutation]) for name, column, index in table]
+        total = len(table[0][2]) if table else 0
+        return [name for name, _, _ in table], SnapshotRows([(column, index[:limit]) for _, column, index in table]), total
+
+    def _aggregate(self, rows: np.ndarray, group_by: List[str], aggregates: List[Dict[str, Any]]) -> List[Tuple[str, _SnapshotColumn, np.ndarray]]:
+        group_columns = [self._column(name, self.by_name) for name in group_by]
+        if group_columns and len(rows):
+            # Combine the columns' ids into one key, compacting after each column so it cannot overflow.
+            inverse = np.zeros(len(rows), dtype=np.int64)
+            for column in group_columns:
+                ids = column.group_ids()[rows].astype(np.int64) + 1 # Text NULLs are -1
+                inverse = inverse * (int(ids.max()) + 1) + ids
+                _, first, inverse = np.unique(inverse, return_index=True, return_inverse=True)
+                inverse = inverse.reshape(-1)
+        else:
+            first = np.zeros(1 if not group_columns else 0, dtype=np.intp)
+            inverse = np.zeros(len(rows), dtype=np.intp)
+        groups = len(first)
+        table = [(column.name, column, rows[first]) for column in group_columns]
+
+        for aggregate in aggregates or [{"func": "count", "column": "*"}]:
+            func, name = aggregate["func"], aggregate.get("column") or "*"
+            label = f"{func}({name})"
+            if name == "*":
+                if func != "count":
+                    raise ValueError(f"Only count can be applied to '*', not {func}.")
+                values = np.bincount(inverse, minlength=groups).astype(np.float64)
+            else:
+                column = self._column(name, self.by_name)
+                values = self._aggregate_column(column, func, rows, inverse, groups)
+                if not isinstance(values, np.ndarray): # min/max of a text column keep its categories
+                    table.append((label, _SnapshotColumn(label, column.type_name, codes=values[0], categories=column.categories, keys=column.keys), np.arange(groups)))
+                    continue
+            table.append((label, _SnapshotColumn(label, "DOUBLE", values=values), np.arange(groups)))
+        return table
+
+    @staticmethod
+    def _aggregate_column(column: _SnapshotColumn, func: str, rows: np.ndarray, inverse: np.ndarray, groups: int) -> Any:
+        present = ~column.nulls[rows]
+        if func == "count":
+            return np.bincount(inverse[present], minlength=groups).astype(np.float64)
+        if func == "count_distinct":
+            pairs = np.unique(np.column_stack([inverse[present], column.group_ids()[rows][present]]), axis=0)
+            return np.bincount(pairs[:, 0], minlength=groups).astype(np.float64) if len(pairs) else np.zeros(groups)
+        if func in ("min", "max") and not column.numeric:
+            codes = np.full(groups, -1 if func == "max" else np.iinfo(np.int32).max, dtype=np.int32)
+            (np.maximum if func == "max" else np.minimum).at(codes, inverse[present], column.codes[rows][present])
+            codes[codes == np.iinfo(np.int32).max] = -1 # Groups with only NULLs
+            return (codes,)
+        if not column.numeric:
+            raise ValueError(f"{func} needs a numeric column; '{column.name}' is {column.type_name}.")
+        values, groups_present = column.values[rows][present], inverse[present]
+        counts = np.bincount(groups_present, minlength=groups)
+        if func in ("sum", "avg"):
+            sums = np.bincount(groups_present, weights=values, minlength=groups)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = sums if func == "sum" else sums / counts
+            return np.where(counts > 0, result, np.nan) # SQL: SUM/AVG over no values is NULL
+        extreme = np.full(groups, np.inf if func == "min" else -np.inf)
+        (np.minimum if func == "min" else np.maximum).at(extreme, groups_present, values)
+        return np.where(counts > 0, extreme, np.nan)
+
+class ResultSnapshotStore:
+    """The last RESULT_SNAPSHOTS_PER_SESSION snapshots of every session, LRU-evicted under a global memory cap."""
+
+    def __init__(self, per_session: int = RESULT_SNAPSHOTS_PER_SESSION, max_bytes: int = RESULT_SNAPSHOT_MAX_BYTES):
+        self.per_session = per_session
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._snapshots: "OrderedDict[str, Tuple[uuid.UUID, ResultSnapshot]]" = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"created": 0, "evicted": 0, "too_large": 0, "queries": 0}
+
+    def _drop(self, snapshot_id: str):
+        _, snapshot = self._snapshots.pop(snapshot_id)
+        self.total_bytes -= snapshot.nbytes
+        self.stats["evicted"] += 1
+
+    def add(self, session_id: uuid.UUID, snapshot: ResultSnapshot) -> bool:
+        with self._lock:
+            if snapshot.nbytes > self.max_bytes:
+                self.stats["too_large"] += 1
+                return False
+            self._snapshots[snapshot.id] = (session_id, snapshot)
+            self.total_bytes += snapshot.nbytes
+            self.stats["created"] += 1
+            own = [snapshot_id for snapshot_id, (owner, _) in self._snapshots.items() if owner == session_id]
+            for snapshot_id in own[:-self.per_session]:
+                self._drop(snapshot_id)
+            while self.total_bytes > self.max_bytes:
+                self._drop(next(iter(self._snapshots)))
+            return True
+
+    def get(self, session_id: uuid.UUID, snapshot_id: str) -> Optional[ResultSnapshot]:
+        """The snapshot if it belongs to this session (marking it recently used)."""
+        with self._lock:
+            entry = self._snapshots.get(snapshot_id)
+            if entry is None or entry[0] != session_id:
+                return None
+            self._snapshots.move_to_end(snapshot_id)
+            self.stats["queries"] += 1
+            return entry[1]
+
+    def for_session(self, session_id: uuid.UUID) -> List[ResultSnapshot]:
+        with self._lock:
+            return [snapshot for owner, snapshot in self._snapshots.values() if owner == session_id]
+
+    def drop_session(self, session_id: uuid.UUID):
+        with self._lock:
+            for snapshot_id in [snapshot_id for snapshot_id, (owner, _) in self._snapshots.items() if owner == session_id]:
+                self._drop(snapshot_id)
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, snapshots=len(self._snapshots), bytes=self.total_bytes, max_bytes=self.max_bytes)
+
+result_snapshots = ResultSnapshotStore()
+
+# --- Chart Data ---
+# Charts never receive every row. /chart_data reduces a result to at most CHART_MAX_POINTS
+# points on the server: time series are downsampled with LTTB (Largest-Triangle-Three-
+# Buckets, which keeps the peaks and troughs a line chart needs), numeric x axes are cut
+# into equal-width bins with one aggregate per bin, and text x axes are grouped by value.
+# The input is either a result snapshot or a read-only query re-run on an unbuffered
+# cursor, where only the two charted columns are kept (as float64) while rows stream by.
+
+CHART_DEFAULT_POINTS = 500
+CHART_MAX_POINTS = 5000
+CHART_MAX_ROWS = 5000000 # Rows read from a re-run query; the rest are skipped
+CHART_FETCH_SIZE = 10000
+CHART_AGGREGATES = ("avg", "sum", "min", "max", "count")
+
+class _ChartAxis:
+    """One charted column as float64 values: numbers, epoch milliseconds, or category codes."""
+
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind # "number", "time" or "category"
+        self.parts: List[np.ndarray] = []
+        self.labels: Dict[bytes, int] = {} # Category value -> code, in order of first appearance
+        self.names: Optional[List[str]] = None # Category names by code, when known up front
+
+    @classmethod
+    def for_field(cls, name: str, field_type: int, flags: int) -> "_ChartAxis":
+        if field_type in _RAW_DATETIME_TYPES or field_type in _RAW_DATE_TYPES:
+            return cls(name, "time")
+        return cls(name, "number" if _raw_converter_for(field_type, flags) in _NUMERIC_CONVERTERS else "category")
+
+    def add_raw(self, rows: List[Tuple[Any, ...]], index: int, field_type: int, flags: int):
+        """Appends one fetched chunk of the column (raw wire bytes)."""
+        if self.kind == "number":
+            convert = _raw_converter_for(field_type, flags)
+            values, nulls = _profile_object_column(rows, index, b"nan")
+            if convert is not _raw_passthrough: # TIME and BIT are not plain numeric text; NULLs stay NaN
+                numbers = np.full(len(values), np.nan)
+                numbers[~nulls] = np.fromiter((convert(value) for value in values[~nulls]), dtype=np.float64, count=int((~nulls).sum()))
+                self.parts.append(numbers)
+            else:
+                self.parts.append(values.astype(np.float64))
+        elif self.kind == "time":
+            values, _ = _profile_object_column(rows, index, b"")
+            text = values.astype("S26")
+            text[np.char.startswith(text, b"0000-00-00")] = b"" # Zero dates are NULL
+            self.parts.append(_epoch_ms(text.astype("U26").astype("datetime64[ms]")))
+        else:
+            values, nulls = _profile_object_column(rows, index, b"")
+            codes = np.full(len(values), np.nan)
+            if not nulls.all():
+                distinct, inverse = np.unique(values[~nulls], return_inverse=True)
+                mapping = np.array([self.labels.setdefault(bytes(value), len(self.labels)) for value in distinct], dtype=np.float64)
+                codes[~nulls] = mapping[inverse.reshape(-1)]
+            self.parts.append(codes)
+
+    @classmethod
+    def from_snapshot(cls, column: "_SnapshotColumn") -> "_ChartAxis":
+        if column.numeric:
+            axis = cls(column.name, "number")
+            axis.parts.append(column.values)
+            return axis
+        if column.type_name in ("DATE", "NEWDATE", "DATETIME", "TIMESTAMP"):
+            # Categories are JSON strings such as b'"2024-01-31T10:00:00"'; parse them all at once.
+            text = np.char.strip(np.array(column.categories, dtype=object).astype("S40"), b'"')
+            lookup = _epoch_ms(text.astype("U40").astype("datetime64[ms]")) if len(text) else np.zeros(0)
+            axis = cls(column.name, "time")
+        else:
+            axis = cls(column.name, "category")
+            axis.names = [value if isinstance(value, str) else json.dumps(value) for value in map(json.loads, column.categories)]
+            lookup = np.arange(len(axis.names), dtype=np.float64)
+        axis.parts.append(np.append(lookup, np.nan)[column.codes]) # Code -1 (NULL) picks the trailing NaN
+        return axis
+
+    def values(self) -> np.ndarray:
+        return np.concatenate(self.parts) if self.parts else np.zeros(0)
+
+    def label_list(self) -> List[str]:
+        if self.names is not None:
+            return self.names
+        labels = [""] * len(self.labels)
+        for value, code in self.labels.items():
+            labels[code] = value.decode("utf-8", "replace")
+        return labels
+
+def _epoch_ms(times: np.ndarray) -> np.ndarray:
+    values = times.astype(np.int64).astype(np.float64)
+    values[np.isnat(times)] = np.nan
+    return values
+
+def lttb_downsample(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps (x must be sorted). The first
+    and last points are always kept; from each bucket in between, the point forming the
+    largest triangle with the previously kept point and the next bucket's average.
+    """
+    n = len(x)
+    if n <= points or points < 3:
+        return np.arange(n) if n <= points else np.linspace(0, n - 1, points).astype(np.intp)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.intp) # Bucket boundaries of the n - 2 inner points
+    counts = np.diff(np.append(edges, n))
+    # The next bucket's average for every bucket, computed in one pass (the last bucket is the final point).
+    average_x = np.append(np.add.reduceat(x, edges)[:-1] / counts[:-1], x[-1])
+    average_y = np.append(np.add.reduceat(y, edges)[:-1] / counts[:-1], y[-1])
+    selected = np.empty(points, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_x, next_y = average_x[bucket + 1], average_y[bucket + 1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+def _group_aggregate(groups: np.ndarray, y: Optional[np.ndarray], agg: str, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(value, row count) per group id in [0, size) with NumPy; groups without rows get NaN."""
+    counts = np.bincount(groups, minlength=size)
+    if y is None or agg == "count":
+        return counts.astype(np.float64), counts
+    if agg in ("sum", "avg"):
+        sums = np.bincount(groups, weights=y, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = sums if agg == "sum" else sums / counts
+    else:
+        values = np.full(size, np.inf if agg == "min" else -np.inf)
+        (np.minimum if agg == "min" else np.maximum).at(values, groups, y)
+    return np.where(counts > 0, values, np.nan), counts
+
+def chart_points(x_axis: _ChartAxis, y_axis: Optional[_ChartAxis], mode: str, agg: str, points: int) -> Dict[str, Any]:
+    """Reduces the charted columns to at most `points` points; raises ValueError for unusable columns."""
+    x = x_axis.values()
+    y = y_axis.values() if y_axis is not None else None
+    if y_axis is not None and y_axis.kind == "category":
+        raise ValueError(f"Column '{y_axis.name}' is not numeric and cannot be charted on the y axis.")
+    keep = ~np.isnan(x) if y is None else ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], (y[keep] if y is not None else None)
+    if mode == "auto":
+        mode = "lttb" if x_axis.kind == "time" and y is not None else "bins"
+    chart: Dict[str, Any] = {"x": x_axis.name, "y": y_axis.name if y_axis else None, "x_kind": x_axis.kind, "mode": mode, "row_count": len(x)}
+
+    if x_axis.kind == "category":
+        # Bar chart: one bar per value, the `points` largest kept.
+        labels = x_axis.label_list()
+        values, counts = _group_aggregate(x.astype(np.intp), y, agg, len(labels))
+        top = [code for code in np.argsort(-np.nan_to_num(values, nan=-np.inf), kind="stable")[:points] if counts[code] > 0]
+        chart.update(mode="categories", agg=agg if y is not None else "count",
+                     points=[[labels[code], _round_stat(values[code]), int(counts[code])] for code in top], categories=len(labels))
+        return chart
+
+    if mode == "lttb":
+        if y is None:
+            raise ValueError("LTTB downsampling needs a y column.")
+        order = np.argsort(x, kind="stable")
+        x, y = x[order], y[order]
+        selected = lttb_downsample(x, y, points)
+        chart["points"] = [[_round_stat(x[i]), _round_stat(y[i])] for i in selected]
+        return chart
+
+    bins = max(1, points)
+    if not len(x):
+        chart.update(agg=agg, bin_width=None, points=[])
+        return chart
+    low, high = float(x.min()), float(x.max())
+    width = (high - low) / bins or 1.0
+    groups = np.minimum(((x - low) / width).astype(np.intp), bins - 1)
+    values, counts = _group_aggregate(groups, y, agg, bins)
+    filled = np.flatnonzero(counts) # Empty bins are left out rather than sent as nulls
+    chart.update(agg=agg if y is not None else "count", bin_width=_round_stat(width),
+                 points=[[_round_stat(low + i * width), _round_stat(values[i]), int(counts[i])] for i in filled])
+    return chart
+
+def chart_from_query(query: str, x: str, y: Optional[str], mode: str, agg: str, points: int) -> Dict[str, Any]:
+    """Re-runs a read-only query on an unbuffered cursor, keeping only the charted columns."""
+    query_log.record("chart", query)
+    conn, cursor = open_export_cursor(query)
+    try:
+        description = cursor.description or []
+        names = [column[0] for column in description]
+        for name in filter(None, (x, y)):
+            if name not in names:
+                raise ValueError(f"Unknown column '{name}'. Available: {', '.join(names)}")
+        charted = [(names.index(name), description[names.index(name)]) for name in filter(None, (x, y))]
+        axes = [_ChartAxis.for_field(column[0], column[1], column[7] or 0) for _, column in charted]
+        read = 0
+        while read < CHART_MAX_ROWS:
+            rows = cursor.fetchmany(min(CHART_FETCH_SIZE, CHART_MAX_ROWS - read))
+            if not rows:
+                break
+            read += len(rows)
+            for axis, (index, column) in zip(axes, charted):
+                axis.add_raw(rows, index, column[1], column[7] or 0)
+    finally:
+        _close_export_cursor(conn, cursor) # Also discards rows beyond CHART_MAX_ROWS
+    chart = chart_points(axes[0], axes[1] if y else None, mode, agg, points)
+    chart["truncated"] = read >= CHART_MAX_ROWS
+    return chart
+
+# --- Request Coalescing ---
+
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls per key: the first caller runs the function, callers
+    arriving while it is in flight wait for it and receive the same result (or the
+    same exception). The last successful result per key is kept so that callers who
+    accept staleness can be answered immediately while a refresh is running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, _FlightCall] = {}
+        self._last_results: Dict[Any, Any] = {}
+
+    def do(self, key: Any, func, allow_stale: bool = False, is_success=lambda result: True) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                if allow_stale and key in self._last_results:
+                    return self._last_results[key]
+                leader = False
+            else:
+                call = self._calls[key] = _FlightCall()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            if is_success(call.result):
+                with self._lock:
+                    self._last_results[key] = call.result
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def peek(self, key: Any) -> Any:
+        """The last successful result for a key without triggering a call (None if there is none)."""
+        with self._lock:
+            return self._last_results.get(key)
+
+    def forget(self, key: Any = None):
+        """Drops the remembered result for a key (or all keys), e.g. after a config change."""
+        with self._lock:
+            if key is None:
+                self._last_results.clear()
+            else:
+                self._last_results.pop(key, None)
+
+schema_flight = SingleFlight()
 
-def fetch_all_tables_and_columns() -> Dict[str, Dict[str, Any]]:
+def fetch_all_tables_and_columns(allow_stale: bool = False) -> Dict[str, Dict[str, Any]]:
     """
     Fetches all non-system databases, their tables, and columns.
     Returns: Dict[db_name, Dict[table_name, List[column_name]]]
     Returns an error structure if connection or queries fail.
+
+    Concurrent callers share one in-flight introspection. With allow_stale=True a
+    caller arriving during a refresh gets the previous successful schema instead of waiting.
     """
+    return schema_flight.do("schema", _introspect_schema, allow_stale=allow_stale, is_success=lambda schema: "error" not in schema)
+
+def _introspect_schema() -> Dict[str, Dict[str, Any]]:
+    """Runs the full schema introspection against MySQL; use fetch_all_tables_and_columns()."""
     schema_info: Dict[str, Dict[str, Any]] = {}
     conn = None
     cursor = None
     system_databases = {'information_schema', 'mysql', 'performance_schema', 'sys'} # Exclude system databases
 
     try:
-        conn = get_db_connection(db_name=None) # Connect without specifying a database
+        conn = get_db_connection(db_name=None, read_only=True) # Connect without specifying a database
         if not conn:
              logger.error("Failed to get DB connection for schema fetching.")
              return {"error": {"schema": ["Failed to connect to the database server."]}}
@@ -449,8 +1769,2553 @@ def fetch_all_tables_and_columns() -> Dict[str, Dict[str, Any]]:
         if conn and conn.is_connected():
             conn.close()
 
+# --- Lazy Schema Browsing ---
+# The sidebar expands large catalogs one level at a time: first the database list,
+# then pages of tables (with their columns) for one database, keyed by table name.
+
+SYSTEM_DATABASES = {'information_schema', 'mysql', 'performance_schema', 'sys'}
+SCHEMA_TABLES_PAGE_SIZE = 100
+
+def fetch_database_list() -> Dict[str, Any]:
+    """Returns {"databases": [{"name", "table_count"}]} for all non-system databases."""
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection(db_name=None, read_only=True)
+        if not conn:
+            return {"error": {"schema": ["Failed to connect to the database server."]}}
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT s.SCHEMA_NAME, COUNT(t.TABLE_NAME) FROM information_schema.SCHEMATA s "
+            "LEFT JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = s.SCHEMA_NAME "
+            "GROUP BY s.SCHEMA_NAME ORDER BY s.SCHEMA_NAME"
+        )
+        databases = [
+            {"name": str(name), "table_count": int(count)}
+            for name, count in cursor.fetchall() # type: ignore
+            if name not in SYSTEM_DATABASES
+        ]
+        return {"databases": databases}
+    except mysql.connector.Error as e:
+        logger.error(f"SQL Error fetching database list: {e}")
+        return {"error": {"schema": [f"SQL Error fetching databases: {e}"]}}
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+def fetch_tables_page(db_name: str, after: str = "", limit: int = SCHEMA_TABLES_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Returns one page of tables (with columns) in a database, ordered by name.
+    `after` is the cursor returned as next_cursor by the previous page.
+    """
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection(db_name=None, read_only=True)
+        if not conn:
+            return {"error": {"schema": ["Failed to connect to the database server."]}}
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME > %s "
+            "ORDER BY TABLE_NAME LIMIT %s",
+            (db_name, after, limit + 1)
+        )
+        table_names = [str(row[0]) for row in cursor.fetchall()] # type: ignore
+        next_cursor = table_names[limit - 1] if len(table_names) > limit else None
+        table_names = table_names[:limit]
+
+        tables: Dict[str, List[str]] = {name: [] for name in table_names}
+        if table_names:
+            placeholders = ", ".join(["%s"] * len(table_names))
+            cursor.execute(
+                f"SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s "
+                f"AND TABLE_NAME IN ({placeholders}) ORDER BY TABLE_NAME, ORDINAL_POSITION",
+                (db_name, *table_names)
+            )
+            for table_name, column_name in cursor.fetchall(): # type: ignore
+                tables[str(table_name)].append(str(column_name))
+        return {"database": db_name, "tables": tables, "next_cursor": next_cursor}
+    except mysql.connector.Error as e:
+        logger.error(f"SQL Error fetching tables for database {db_name}: {e}")
+        return {"error": {"schema": [f"SQL Error fetching tables: {e}"]}}
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+# --- Conditional & Compressed JSON Responses ---
+
+GZIP_MIN_SIZE = 1024 # Bodies smaller than this are not worth compressing
+
+def schema_fingerprint(data: Any) -> str:
+    """Stable content hash of a JSON-serialisable structure."""
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return hashlib.sha256(canonical).hexdigest()[:32]
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    base = etag.strip('"')
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        # Both the identity and the gzip representation revalidate the same content.
+        if candidate.strip('"').removesuffix("-gzip") == base:
+            return True
+    return False
+
+def _accepts_encoding(request: Request, encoding: str) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == encoding and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            return True
+    return False
+
+class _EncodedBody:
+    """A JSON body with its fingerprint and a lazily computed gzip variant."""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.fingerprint = hashlib.sha256(body).hexdigest()[:32]
+        self._gzipped: Optional[bytes] = None
+
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+def conditional_json_response(request: Request, encoded: "_EncodedBody", etag_value: Optional[str] = None) -> Response:
+    """
+    Serves a JSON body with a strong ETag: 304 when If-None-Match matches, gzip when
+    the client accepts it. Clients must revalidate (no-cache) so a changed schema is
+    picked up on the next refresh while unchanged ones cost a header round trip.
+    """
+    etag = f'"{etag_value or encoded.fingerprint}"'
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    use_gzip = len(encoded.body) >= GZIP_MIN_SIZE and _accepts_encoding(request, "gzip")
+    representation_etag = etag[:-1] + '-gzip"' if use_gzip else etag # Strong ETags differ per encoding
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={**headers, "ETag": representation_etag})
+    if use_gzip:
+        return Response(content=encoded.gzipped(), media_type="application/json",
+                        headers={**headers, "ETag": representation_etag, "Content-Encoding": "gzip"})
+    return Response(content=encoded.body, media_type="application/json", headers={**headers, "ETag": etag})
+
+_schema_body_cache: Dict[str, Any] = {"schema": None, "encoded": None, "fingerprint": None}
+
+def encoded_schema_body(schema: Dict[str, Any]) -> Tuple["_EncodedBody", str]:
+    """Encodes (and caches, per schema object) the /schema body and its fingerprint ETag."""
+    if _schema_body_cache["schema"] is not schema:
+        encoded = _EncodedBody(json.dumps({"schema": schema}).encode("utf-8"))
+        _schema_body_cache.update(schema=schema, encoded=encoded, fingerprint=schema_fingerprint(schema))
+    return _schema_body_cache["encoded"], _schema_body_cache["fingerprint"]
+
+# --- Streaming Export ---
+# Full-result exports run on their own (non-pooled) connection with an unbuffered raw
+# cursor, so rows are pulled from MySQL only as fast as the client consumes them and a
+# long export never holds one of the pool's slots. Exports are reads, so the connection
+# goes to a healthy replica when one is configured.
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+EXPORT_FETCH_SIZE = 2000 # Rows pulled from the server per fetchmany() call
+EXPORT_PARQUET_ROW_GROUP_SIZE = 100000 # Rows per Parquet row group
+
+def open_export_cursor(query: str):
+    """
+    Opens a dedicated connection and executes the query on an unbuffered raw cursor.
+    Raises mysql.connector.Error if the connection or the query fails, so errors
+    surface before any bytes are streamed.
+    """
+    host, port = datasource_router.read_endpoint()
+    conn = mysql.connector.connect(
+        host=host,
+        port=port,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        auth_plugin='mysql_native_password'
+    )
+    try:
+        cursor = conn.cursor(raw=True)
+        cursor.execute(query)
+        return conn, cursor
+    except Exception:
+        conn.close()
+        raise
+
+def _close_export_cursor(conn, cursor):
+    """Closes an export cursor/connection, tolerating unread rows from an aborted download."""
+    try:
+        cursor.close()
+    except Exception as e:
+        logger.debug(f"Ignoring error while closing export cursor: {e}")
+    try:
+        conn.close()
+    except Exception as e:
+        logger.debug(f"Ignoring error while closing export connection: {e}")
+
+def _iter_export_batches(conn, cursor):
+    """Yields lists of raw rows until the result is exhausted, then closes the connection."""
+    try:
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        _close_export_cursor(conn, cursor)
+
+def _csv_cell(value: Optional[bytes]) -> bytes:
+    if value is None:
+        return b""
+    if b'"' in value or b"," in value or b"\n" in value or b"\r" in value:
+        return b'"' + bytes(value).replace(b'"', b'""') + b'"'
+    return value
+
+def _csv_bit_cell(value: Optional[bytes]) -> bytes:
+    return b"" if value is None else _raw_bit(value)
+
+def _iter_csv(description, batches):
+    yield b",".join(_csv_cell(col[0].encode("utf-8")) for col in description) + b"\r\n"
+    converters = [_csv_bit_cell if col[1] == FieldType.BIT else _csv_cell for col in description]
+    for rows in batches:
+        yield b"".join(b",".join(convert(value) for convert, value in zip(converters, row)) + b"\r\n" for row in rows)
+
+def _iter_ndjson(description, batches):
+    keys = [json.dumps(col[0], ensure_ascii=False).encode("utf-8") + b":" for col in description]
+    converters = [_raw_converter_for(col[1], col[7] or 0) for col in description]
+    for rows in batches:
+        yield b"".join(
+            b"{" + b",".join(key + (b"null" if value is None else convert(value)) for key, convert, value in zip(keys, converters, row)) + b"}\n"
+            for row in rows
+        )
+
+def _arrow_type_for(column):
+    """Maps a cursor.description entry to the Arrow type its raw text is cast to."""
+    import pyarrow as pa
+    field_type, flags = column[1], column[7] or 0
+    if flags & FieldFlag.SET:
+        return pa.string()
+    if field_type in (FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.LONGLONG, FieldType.INT24, FieldType.YEAR, FieldType.BIT):
+        return pa.int64()
+    if field_type in (FieldType.FLOAT, FieldType.DOUBLE, FieldType.DECIMAL, FieldType.NEWDECIMAL):
+        return pa.float64()
+    if field_type in _RAW_DATETIME_TYPES:
+        return pa.timestamp("us")
+    if field_type in _RAW_DATE_TYPES:
+        return pa.date32()
+    if field_type in (FieldType.TINY_BLOB, FieldType.MEDIUM_BLOB, FieldType.LONG_BLOB, FieldType.BLOB, FieldType.STRING, FieldType.VAR_STRING, FieldType.GEOMETRY) and len(column) > 8 and column[8] == 63:
+        return pa.binary() # charset 63 is 'binary'
+    return pa.string()
+
+def _iter_parquet(description, batches):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([pa.field(col[0], _arrow_type_for(col)) for col in description])
+    sink = io.BytesIO()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+
+    def to_table(rows):
+        arrays = []
+        for index, field in enumerate(schema):
+            column = [row[index] for row in rows]
+            if description[index][1] == FieldType.BIT:
+                arrays.append(pa.array([None if v is None else int.from_bytes(v, "big") for v in column], pa.int64()))
+                continue
+            array = pa.array([None if v is None else bytes(v) for v in column], pa.binary())
+            if pa.types.is_binary(field.type):
+                arrays.append(array)
+                continue
+            array = array.cast(pa.string())
+            if pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+                # Zero dates have no Arrow representation; the connector maps them to None too.
+                array = pc.if_else(pc.starts_with(array, "0000-00-00"), pa.scalar(None, pa.string()), array)
+            arrays.append(array.cast(field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    pending: List[Any] = []
+    for rows in batches:
+        pending.extend(rows)
+        if len(pending) >= EXPORT_PARQUET_ROW_GROUP_SIZE:
+            writer.write_table(to_table(pending), row_group_size=len(pending))
+            pending = []
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    if pending:
+        writer.write_table(to_table(pending), row_group_size=len(pending))
+    writer.close()
+    yield sink.getvalue()
+
+def _gzip_stream(chunks):
+    """Gzip-compresses a byte stream incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 writes a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stream_export(conn, cursor, export_format: str, use_gzip: bool = False):
+    """Returns an iterator of encoded export chunks for an already-executed export cursor."""
+    description = list(cursor.description or [])
+    batches = _iter_export_batches(conn, cursor)
+    if export_format == "parquet":
+        chunks = _iter_parquet(description, batches)
+    elif export_format == "ndjson":
+        chunks = _iter_ndjson(description, batches)
+    else:
+        chunks = _iter_csv(description, batches)
+    return _gzip_stream(chunks) if use_gzip else chunks
+
+# --- Batch Query Execution ---
+# Dashboards send many independent read-only queries at once. /batch runs them
+# concurrently on pooled connections and streams one NDJSON line per query as soon as
+# it finishes. mysql.connector raises instead of waiting when the pool is exhausted,
+# so all batches together never use more than all-but-one of the pool's connections.
+
+BATCH_MAX_QUERIES = 50
+BATCH_MAX_CONCURRENCY = max(1, DB_POOL_SIZE - 1) # Leaves a pooled connection for interactive /chat
+BATCH_DEFAULT_TIMEOUT_SECONDS = 30.0
+BATCH_MAX_TIMEOUT_SECONDS = 300.0
+# max_execution_time only interrupts SELECTs; this backstop reports SHOW/DESCRIBE/EXPLAIN
+# (or a stuck connection) as timed out too.
+BATCH_TIMEOUT_GRACE_SECONDS = 2.0
+MYSQL_QUERY_TIMEOUT_ERRNO = "3024" # ER_QUERY_TIMEOUT: maximum statement execution time exceeded
+
+# Shared by every running batch; a batch's own concurrency only limits it further.
+batch_connection_slots = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+def _batch_outcome_line(index: int, query: str, outcome, elapsed: float) -> Dict[str, Any]:
+    """Turns an execute_sql_query() tuple into one line of the /batch stream."""
+    results, columns, _, status, error = outcome
+    line: Dict[str, Any] = {"index": index, "query": query, "elapsed_ms": round(elapsed * 1000, 1)}
+    if status == 1:
+        # Only the first RESULT_DISPLAY_LIMIT rows are streamed; row_count is the full result's.
+        row_count = getattr(results, "total_rows", len(results)) if results is not None else 0
+        line.update(type="result", columns=columns or [], row_count=row_count, truncated=results is not None and row_count > len(results),
+                    results=results if results is not None else [])
+        return line
+    match = MYSQL_ERROR_RE.search(error or "")
+    if match and match.group("code") == MYSQL_QUERY_TIMEOUT_ERRNO:
+        line.update(type="timeout", content=f"Query exceeded its time limit: {match.group('message').strip()}")
+    else:
+        line.update(type="error", content=error or "Unknown query execution status.")
+    return line
+
+async def run_query_batch(queries: List[str], concurrency: int, timeout_seconds: float):
+    """
+    Runs read-only queries concurrently and yields one NDJSON line per query in
+    completion order, followed by a summary line. Queries that are not risk level 0
+    are rejected without touching the database.
+    """
+    started = time.perf_counter()
+    outcomes: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    timeout_ms = int(timeout_seconds * 1000)
+    counts = {"result": 0, "error": 0, "timeout": 0, "rejected": 0}
+
+    async def run_one(index: int, query: str):
+        async with semaphore, batch_connection_slots:
+            query_log.record("batch", query)
+            query_started = time.perf_counter()
+            execution = asyncio.ensure_future(run_in_threadpool(execute_sql_query, query, raw=True, timeout_ms=timeout_ms, profile=False))
+            done, _ = await asyncio.wait({execution}, timeout=timeout_seconds + BATCH_TIMEOUT_GRACE_SECONDS)
+            if done:
+                await outcomes.put(_batch_outcome_line(index, query, execution.result(), time.perf_counter() - query_started))
+                return
+            await outcomes.put({"index": index, "query": query, "type": "timeout", "elapsed_ms": round((time.perf_counter() - query_started) * 1000, 1),
+                                "content": f"Query did not finish within {timeout_seconds:g} seconds."})
+            # The worker thread still holds a pooled connection; keep the slot until it returns.
+            await asyncio.shield(execution)
+
+    workers = []
+    for index, query in enumerate(queries):
+        if get_query_risk_level(query) != 0:
+            logger.warning(f"Rejecting non read-only query in batch: {query}")
+            await outcomes.put({"index": index, "query": query, "type": "rejected", "elapsed_ms": 0.0,
+                                "content": "Only read-only queries can be run in a batch."})
+        else:
+            workers.append(asyncio.ensure_future(run_one(index, query)))
+    try:
+        for _ in range(len(queries)):
+            line = await outcomes.get()
+            counts[line["type"]] += 1
+            yield _encode_json_body(line) + b"\n"
+        summary = {"type": "summary", "queries": len(queries), "concurrency": concurrency,
+                   "elapsed_ms": round((time.perf_counter() - started) * 1000, 1), **counts}
+        yield json.dumps(summary).encode("utf-8") + b"\n"
+    finally:
+        # Client went away: stop queries that have not started yet.
+        for worker in workers:
+            worker.cancel()
+
+# --- Saved Queries ---
+# Users can pin a read-only query. Its result is materialized in memory and refreshed in
+# the background (started from lifespan) every interval, with jitter so refreshes do not
+# line up, and at most SAVED_QUERY_REFRESH_CONCURRENCY at a time. /chat serves the
+# snapshot for a matching query instead of executing it again. Definitions are kept in
+# saved_queries.json; snapshots are rebuilt on startup.
+
+SAVED_QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_queries.json")
+SAVED_QUERY_DEFAULT_INTERVAL = "1h"
+SAVED_QUERY_MIN_INTERVAL_SECONDS = 60
+SAVED_QUERY_JITTER_FRACTION = 0.1 # Each refresh is scheduled interval * (1 ± 10%) after the previous one
+SAVED_QUERY_REFRESH_CONCURRENCY = 2 # Stays well below DB_POOL_SIZE
+SAVED_QUERY_TIMEOUT_SECONDS = 300
+SAVED_QUERY_MAX_STALENESS = 2 # Snapshots older than this many intervals (failing refreshes) are not served
+SAVED_QUERY_IDLE_WAKEUP_SECONDS = 60
+INTERVAL_RE = re.compile(r"^\s*(\d+)\s*([smhd])\s*$", re.IGNORECASE)
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_interval(interval: str) -> Optional[int]:
+    """Parses '90s', '15m', '1h' or '1d' into seconds; None if invalid or too short."""
+    match = INTERVAL_RE.match(interval or "")
+    if not match:
+        return None
+    seconds = int(match.group(1)) * INTERVAL_UNITS[match.group(2).lower()]
+    return seconds if seconds >= SAVED_QUERY_MIN_INTERVAL_SECONDS else None
+
+def normalize_sql(sql: str) -> str:
+    """Canonical form used to match a query against saved queries (comments, case of keywords, whitespace)."""
+    formatted = sqlparse.format(sql, strip_comments=True, keyword_case="upper")
+    parts: List[str] = []
+    for statement in sqlparse.parse(formatted):
+        for token in statement.flatten():
+            if not token.is_whitespace:
+                parts.append(token.value) # String literals keep their whitespace
+            elif parts and parts[-1] != " ":
+                parts.append(" ")
+    return "".join(parts).strip().rstrip(";").strip()
+
+class SavedQueryStore:
+    """Saved query definitions, their materialized snapshots and the refresh scheduler."""
+
+    def __init__(self, path: str = SAVED_QUERIES_PATH, concurrency: int = SAVED_QUERY_REFRESH_CONCURRENCY, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.concurrency = concurrency
+        self.definitions: Dict[str, Dict[str, Any]] = {}
+        self.snapshots: Dict[str, Dict[str, Any]] = {}
+        self.errors: Dict[str, str] = {} # Last refresh error, cleared by a successful refresh
+        self.next_run: Dict[str, float] = {}
+        self.by_sql: Dict[str, str] = {} # normalize_sql(query) -> id
+        self.refreshing: set = set()
+        self.refresh_requested: set = set() # Asked for while already refreshing; runs once more afterwards
+        self.stats = {"snapshot_hits": 0, "refreshes": 0, "refresh_failures": 0}
+        self.generation = 0 # Bumped by invalidate(); refreshes started before it are discarded
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def load(self):
+        """Reads saved definitions; every query is due immediately so snapshots are rebuilt."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                definitions = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read saved queries from {self.path}: {e}")
+            return
+        for definition in definitions:
+            self._index(definition)
+        logger.info(f"Loaded {len(self.definitions)} saved queries")
+
+    def _persist(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self.definitions.values()), f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not write saved queries to {self.path}: {e}")
+
+    def _index(self, definition: Dict[str, Any]):
+        self.definitions[definition["id"]] = definition
+        self.by_sql[normalize_sql(definition["query"])] = definition["id"]
+        self.next_run[definition["id"]] = self.clock()
+
+    def add(self, query: str, name: Optional[str], interval_seconds: int) -> Dict[str, Any]:
+        """Saves a query (or updates the existing one with the same SQL) and schedules a refresh now."""
+        saved_id = self.by_sql.get(normalize_sql(query))
+        if saved_id is not None:
+            definition = self.definitions[saved_id]
+            definition.update(name=name or definition["name"], interval_seconds=interval_seconds)
+        else:
+            definition = {"id": uuid.uuid4().hex[:12], "name": name or query[:60], "query": query, "interval_seconds": interval_seconds}
+            self._index(definition)
+        self._persist()
+        self.wake()
+        return definition
+
+    def remove(self, saved_id: str) -> bool:
+        definition = self.definitions.pop(saved_id, None)
+        if definition is None:
+            return False
+        self.by_sql.pop(normalize_sql(definition["query"]), None)
+        self.snapshots.pop(saved_id, None)
+        self.errors.pop(saved_id, None)
+        self.next_run.pop(saved_id, None)
+        self.refresh_requested.discard(saved_id)
+        self._persist()
+        return True
+
+    def request_refresh(self, saved_id: str) -> bool:
+        if saved_id not in self.definitions:
+            return False
+        if saved_id in self.refreshing:
+            self.refresh_requested.add(saved_id) # The running refresh would reschedule over next_run
+        self.next_run[saved_id] = self.clock()
+        self.wake()
+        return True
+
+    def invalidate(self):
+        """Drops every snapshot (e.g. the primary now points at a different server) and refreshes all queries now."""
+        self.generation += 1
+        self.snapshots.clear()
+        self.errors.clear()
+        now = self.clock()
+        for saved_id in self.definitions:
+            self.next_run[saved_id] = now
+        self.wake()
+
+    def summary(self, saved_id: str) -> Dict[str, Any]:
+        """Definition plus snapshot metadata (no rows)."""
+        definition = self.definitions[saved_id]
+        snapshot = self.snapshots.get(saved_id)
+        now = self.clock()
+        summary = dict(definition, refreshing=saved_id in self.refreshing,
+                       next_refresh_in_seconds=max(0, round(self.next_run.get(saved_id, now) - now)))
+        if snapshot is not None:
+            summary.update(refreshed_at=snapshot["refreshed_at"], age_seconds=round(now - snapshot["refreshed_at"]),
+                           row_count=len(snapshot["results"]) if snapshot["results"] is not None else 0,
+                           elapsed_ms=snapshot["elapsed_ms"])
+        if saved_id in self.errors:
+            summary["last_error"] = self.errors[saved_id]
+        return summary
+
+    def snapshot_for(self, query: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """The fresh-enough snapshot of a saved query with the same SQL, if any."""
+        saved_id = self.by_sql.get(normalize_sql(query))
+        snapshot = self.snapshots.get(saved_id) if saved_id else None
+        if snapshot is None:
+            return None
+        if self.clock() - snapshot["refreshed_at"] > self.definitions[saved_id]["interval_seconds"] * SAVED_QUERY_MAX_STALENESS:
+            return None
+        self.stats["snapshot_hits"] += 1
+        return saved_id, snapshot
+
+    def _schedule_next(self, saved_id: str, started: float):
+        interval = self.definitions[saved_id]["interval_seconds"]
+        jitter = random.uniform(-SAVED_QUERY_JITTER_FRACTION, SAVED_QUERY_JITTER_FRACTION)
+        self.next_run[saved_id] = started + interval * (1 + jitter)
+
+    async def refresh(self, saved_id: str, semaphore: asyncio.Semaphore):
+        """Re-executes one saved query and swaps in the new snapshot on success."""
+        async with semaphore:
+            definition = self.definitions.get(saved_id)
+            if definition is None:
+                return
+            started = self.clock()
+            generation = self.generation
+            self.refresh_requested.discard(saved_id) # This run serves requests made so far
+            query_log.record("saved_query", definition["query"], definition.get("name"))
+            query_started = time.perf_counter()
+            results, columns, col_types, status, error = await run_in_threadpool(
+                execute_sql_query, definition["query"], raw=True, timeout_ms=SAVED_QUERY_TIMEOUT_SECONDS * 1000)
+            if saved_id not in self.definitions: # Deleted while running
+                return
+            if generation != self.generation: # Invalidated while running; may describe the old server
+                self.next_run[saved_id] = self.clock()
+                return
+            if saved_id in self.refresh_requested: # Requested again while this run was in flight
+                self.refresh_requested.discard(saved_id)
+                self.next_run[saved_id] = self.clock()
+            else:
+                self._schedule_next(saved_id, started)
+            if status == 1:
+                self.snapshots[saved_id] = {"results": results, "columns": columns, "col_types": col_types, "refreshed_at": self.clock(),
+                                            "elapsed_ms": round((time.perf_counter() - query_started) * 1000, 1)}
+                self.errors.pop(saved_id, None)
+                self.stats["refreshes"] += 1
+            else:
+                # Keep serving the previous snapshot until it becomes too stale.
+                self.errors[saved_id] = error or "Saved query did not return a result set."
+                self.stats["refresh_failures"] += 1
+                logger.warning(f"Refreshing saved query {saved_id} failed: {self.errors[saved_id]}")
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_scheduler(self):
+        """Background loop: dispatches due refreshes, then sleeps until the next one is due (or wake())."""
+        self._wakeup = asyncio.Event()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        def finished(task, saved_id):
+            tasks.discard(task)
+            self.refreshing.discard(saved_id)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"Saved query refresh {saved_id} crashed: {task.exception()}")
+                if saved_id in self.definitions:
+                    self._schedule_next(saved_id, self.clock())
+            self.wake()
+
+        try:
+            while True:
+                now = self.clock()
+                for saved_id, due in list(self.next_run.items()):
+                    if due <= now and saved_id not in self.refreshing:
+                        self.refreshing.add(saved_id)
+                        task = asyncio.ensure_future(self.refresh(saved_id, semaphore))
+                        tasks.add(task)
+                        task.add_done_callback(functools.partial(finished, saved_id=saved_id))
+                pending = [due for saved_id, due in self.next_run.items() if saved_id not in self.refreshing]
+                delay = min([SAVED_QUERY_IDLE_WAKEUP_SECONDS] + [max(0.0, due - self.clock()) for due in pending])
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+saved_queries = SavedQueryStore()
+
+# --- Workload Digest Report ---
+# Every statement the app runs is appended to a local JSONL query log, together with the
+# natural-language question behind it. The workload report matches those statements to
+# performance_schema.events_statements_summary_by_digest on the primary and every
+# replica with a pool (via STATEMENT_DIGEST(), MySQL 8.0.17+, or by comparing normalized
+# digest text on older servers), and ranks the query shapes by total latency, rows
+# examined and execution count. The counters are cumulative since the server started
+# (or since the digest table was truncated).
+
+QUERY_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_log.jsonl")
+QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024 # The log is rotated to query_log.jsonl.1 beyond this
+WORKLOAD_REPORT_LIMIT = 20
+WORKLOAD_DIGEST_BATCH = 50 # STATEMENT_DIGEST() calls per round trip
+WORKLOAD_TOP_QUESTIONS = 5
+PICOSECONDS_PER_MS = 1e9 # performance_schema timers are in picoseconds
+
+class QueryLog:
+    """Append-only JSONL log of the statements the app ran and the question behind each."""
+
+    def __init__(self, path: str = QUERY_LOG_PATH, max_bytes: int = QUERY_LOG_MAX_BYTES, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def record(self, source: str, sql: str, question: Optional[str] = None):
+        line = json.dumps({"ts": round(self.clock(), 3), "source": source, "sql": sql, "question": question}, ensure_ascii=False) + "\n"
+        with self._lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                logger.warning(f"Could not write to the query log {self.path}: {e}")
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Logged statements, oldest first (including the rotated file)."""
+        entries = []
+        for path in (self.path + ".1", self.path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entries.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            continue # A partially written last line
+            except FileNotFoundError:
+                continue
+        return entries
+
+query_log = QueryLog()
+
+_DIGEST_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_DIGEST_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?(?![\w.])", re.IGNORECASE)
+_DIGEST_PUNCTUATION_RE = re.compile(r"\s*([().,=<>!*+/-])\s*")
+_DIGEST_LIST_RE = re.compile(r"\(\?(?:,\?)+\)|\(\.\.\.\)")
+
+def digest_fingerprint(sql: str) -> str:
+    """
+    Approximates MySQL's statement digest normalization for servers without
+    STATEMENT_DIGEST(): literals become ?, value lists collapse, quoting, case and spacing
+    are ignored. Applied to both logged SQL and DIGEST_TEXT so they can be compared.
+    """
+    text = _DIGEST_NUMBER_RE.sub("?", _DIGEST_STRING_RE.sub("?", sql.strip().rstrip(";")))
+    text = _DIGEST_PUNCTUATION_RE.sub(r"\1", re.sub(r"\s+", " ", text.replace("`", "").lower()))
+    return _DIGEST_LIST_RE.sub("(?)", text)
+
+def _workload_connections() -> List[Tuple[str, Any]]:
+    """(name, connection) for the primary and every replica that has a pool."""
+    connections = []
+    try:
+        connections.append(("primary", primary_pool.get_connection()))
+    except mysql.connector.Error as err:
+        logger.warning(f"Workload report: primary unavailable: {err}")
+    for replica in datasource_router.replicas:
+        if replica.pool is None:
+            continue
+        try:
+            connections.append((replica.name, replica.pool.checkout()))
+        except mysql.connector.Error as err:
+            logger.warning(f"Workload report: replica {replica.name} unavailable: {err}")
+    return connections
+
+def _statement_digests(cursor, statements: List[str]) -> Dict[str, str]:
+    """
+    Maps SQL text to its digest with STATEMENT_DIGEST(); raises mysql.connector.Error
+    before 8.0.17. A logged statement the server cannot parse (a failed query) only
+    makes its own batch fall back to one call per statement, and is left out.
+    """
+    cursor.execute("SELECT STATEMENT_DIGEST('SELECT 1')") # Raises when the function does not exist
+    cursor.fetchall()
+    digests: Dict[str, str] = {}
+    for start in range(0, len(statements), WORKLOAD_DIGEST_BATCH):
+        batch = statements[start:start + WORKLOAD_DIGEST_BATCH]
+        try:
+            cursor.execute("SELECT " + ", ".join(["STATEMENT_DIGEST(%s)"] * len(batch)), tuple(batch))
+            row = cursor.fetchone()
+        except mysql.connector.Error:
+            row = []
+            for statement in batch:
+                try:
+                    cursor.execute("SELECT STATEMENT_DIGEST(%s)", (statement,))
+                    row.append(cursor.fetchone()[0])
+                except mysql.connector.Error as err:
+                    logger.debug(f"No digest for logged statement {statement[:80]!r}: {err}")
+                    row.append(None)
+        for statement, digest in zip(batch, row):
+            if digest:
+                digests[statement] = digest.decode() if isinstance(digest, (bytes, bytearray)) else str(digest)
+    return digests
+
+def _fetch_digest_summary(cursor) -> List[Tuple[Any, ...]]:
+    # Summed over schemas: the app connects without a default database, but other clients may not.
+    cursor.execute(
+        "SELECT DIGEST, MIN(DIGEST_TEXT), SUM(COUNT_STAR), SUM(SUM_TIMER_WAIT), MAX(MAX_TIMER_WAIT), SUM(SUM_ROWS_EXAMINED), "
+        "SUM(SUM_ROWS_SENT), SUM(SUM_NO_INDEX_USED) + SUM(SUM_NO_GOOD_INDEX_USED), SUM(SUM_CREATED_TMP_DISK_TABLES), "
+        "SUM(SUM_SORT_ROWS), MAX(LAST_SEEN) "
+        "FROM performance_schema.events_statements_summary_by_digest WHERE DIGEST IS NOT NULL GROUP BY DIGEST")
+    return cursor.fetchall()
+
+def _workload_hints(entry: Dict[str, Any]) -> List[str]:
+    """Which remedy a query shape looks like a candidate for."""
+    hints = []
+    if entry["no_index_used"] or entry["rows_examined"] > 100 * max(1, entry["rows_sent"]):
+        hints.append("index") # Scans far more rows than it returns
+    if entry["count"] >= 10 and entry["avg_latency_ms"] >= 100:
+        hints.append("materialize") # Frequent and slow: a saved query would serve it from a snapshot
+    if entry["distinct_statements"] == 1 and entry["logged"] >= 3:
+        hints.append("cache") # The exact same statement keeps being asked
+    return hints
+
+def build_workload_report(limit: int = WORKLOAD_REPORT_LIMIT) -> Dict[str, Any]:
+    """Ranks the statements in the query log by their performance_schema digest counters."""
+    logged: Dict[str, Dict[str, Any]] = {}
+    for entry in query_log.entries():
+        sql = str(entry.get("sql") or "").strip()
+        if not sql:
+            continue
+        item = logged.setdefault(sql, {"count": 0, "questions": {}, "sources": {}})
+        item["count"] += 1
+        if entry.get("question"):
+            item["questions"][entry["question"]] = item["questions"].get(entry["question"], 0) + 1
+        item["sources"][entry.get("source", "unknown")] = item["sources"].get(entry.get("source", "unknown"), 0) + 1
+
+    report: Dict[str, Any] = {"generated_at": time.time(), "logged_statements": sum(item["count"] for item in logged.values()),
+                              "servers": [], "matched_by": None, "unmatched_statements": 0, "rankings": {}}
+    if not logged:
+        return report
+
+    totals: Dict[str, List[Any]] = {}
+    statement_digest: Dict[str, str] = {}
+    for name, conn in _workload_connections():
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            if report["matched_by"] is None:
+                try:
+                    statement_digest = _statement_digests(cursor, list(logged))
+                    report["matched_by"] = "statement_digest"
+                except mysql.connector.Error as err:
+                    logger.info(f"STATEMENT_DIGEST() unavailable ({err}); matching by normalized digest text.")
+                    report["matched_by"] = "digest_text"
+            for row in _fetch_digest_summary(cursor):
+                digest = row[0].decode() if isinstance(row[0], (bytes, bytearray)) else str(row[0])
+                values = [int(value or 0) for value in row[2:10]]
+                current = totals.get(digest)
+                if current is None:
+                    totals[digest] = [row[1]] + values + [row[10]]
+                else: # The same shape on several servers: add the counters, keep the maxima
+                    for i, value in enumerate(values, start=1):
+                        current[i] = max(current[i], value) if i == 3 else current[i] + value
+                    current[-1] = max(filter(None, (current[-1], row[10])), default=None)
+            report["servers"].append({"name": name, "status": "ok"})
+        except mysql.connector.Error as err:
+            logger.warning(f"Workload report: could not read performance_schema on {name}: {err}")
+            report["servers"].append({"name": name, "status": f"failed: {err}"})
+        finally:
+            if cursor:
+                cursor.close()
+            conn.close()
+
+    if report["matched_by"] == "digest_text":
+        by_fingerprint = {digest_fingerprint(str(values[0] or "")): digest for digest, values in totals.items()}
+        statement_digest = {sql: by_fingerprint[digest_fingerprint(sql)] for sql in logged if digest_fingerprint(sql) in by_fingerprint}
+
+    shapes: Dict[str, Dict[str, Any]] = {}
+    for sql, item in logged.items():
+        digest = statement_digest.get(sql)
+        if digest is None or digest not in totals:
+            report["unmatched_statements"] += item["count"] # Evicted from the digest table, or run elsewhere
+            continue
+        shape = shapes.setdefault(digest, {"digest": digest, "logged": 0, "distinct_statements": 0, "questions": {}, "sources": {}, "sample_sql": sql, "_sample_count": 0})
+        shape["logged"] += item["count"]
+        shape["distinct_statements"] += 1
+        if item["count"] > shape["_sample_count"]:
+            shape["sample_sql"], shape["_sample_count"] = sql, item["count"]
+        for key in ("questions", "sources"):
+            for value, count in item[key].items():
+                shape[key][value] = shape[key].get(value, 0) + count
+
+    entries = []
+    for digest, shape in shapes.items():
+        digest_text, count, total_wait, max_wait, rows_examined, rows_sent, no_index_used, tmp_disk_tables, sort_rows, last_seen = totals[digest]
+        shape.pop("_sample_count")
+        shape.update({
+            "digest_text": digest_text,
+            "count": count,
+            "total_latency_ms": round(total_wait / PICOSECONDS_PER_MS, 1),
+            "avg_latency_ms": round(total_wait / PICOSECONDS_PER_MS / max(1, count), 2),
+            "max_latency_ms": round(max_wait / PICOSECONDS_PER_MS, 1),
+            "rows_examined": rows_examined,
+            "rows_sent": rows_sent,
+            "no_index_used": no_index_used,
+            "tmp_disk_tables": tmp_disk_tables,
+            "sort_rows": sort_rows,
+            "last_seen": str(last_seen) if last_seen is not None else None,
+            "questions": [[question, n] for question, n in sorted(shape["questions"].items(), key=itemgetter(1), reverse=True)[:WORKLOAD_TOP_QUESTIONS]],
+        })
+        shape["hints"] = _workload_hints(shape)
+        entries.append(shape)
+
+    for ranking, key in (("total_latency", "total_latency_ms"), ("rows_examined", "rows_examined"), ("count", "count")):
+        report["rankings"][ranking] = sorted(entries, key=itemgetter(key), reverse=True)[:limit]
+    return report
+
+# --- Local SQL Error Diagnosis ---
+
+# Diagnoses the common MySQL errors from the error text and a cached schema index in
+# milliseconds; Gemini is only consulted when no rule produces an answer.
+MYSQL_ERROR_RE = re.compile(r"(?P<code>\d{4}) \((?P<sqlstate>[0-9A-Z]{5})\): (?P<message>.*)", re.DOTALL)
+SUGGESTION_LIMIT = 3
+SQL_KEYWORDS = (
+    "SELECT", "FROM", "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "OUTER", "CROSS", "ON", "USING", "GROUP", "ORDER",
+    "BY", "HAVING", "LIMIT", "OFFSET", "UNION", "DISTINCT", "AS", "AND", "OR", "NOT", "IN", "IS", "NULL", "LIKE",
+    "BETWEEN", "EXISTS", "CASE", "WHEN", "THEN", "ELSE", "END", "ASC", "DESC", "INSERT", "INTO", "VALUES", "UPDATE",
+    "SET", "DELETE", "SHOW", "TABLES", "DATABASES", "COLUMNS", "COUNT", "SUM", "AVG", "MIN", "MAX", "WITH",
+)
+_SQL_KEYWORD_SET = set(SQL_KEYWORDS)
+# Reserved words that are also popular column/table names and must be backquoted.
+RESERVED_IDENTIFIER_WORDS = {"order", "group", "key", "keys", "desc", "range", "rank", "condition", "index",
+                             "interval", "change", "read", "usage", "release", "row", "rows", "window"}
+_IDENTIFIER = r"(?:`[^`]+`|[A-Za-z_][\w$]*)"
+_TABLE_REFERENCE_RE = re.compile(
+    rf"\b(?:from|join|update|into)\s+(?P<name>{_IDENTIFIER}(?:\s*\.\s*{_IDENTIFIER})?)"
+    rf"(?:\s+(?:as\s+)?(?!(?:where|on|using|join|inner|left|right|cross|natural|full|outer|straight_join|group|order"
+    rf"|limit|having|set|union|values|select|window|for|lock)\b)(?P<alias>{_IDENTIFIER}))?",
+    re.IGNORECASE,
+)
+
+def _unquote(identifier: str) -> str:
+    return identifier.strip().strip("`")
+
+def _trigrams(name: str) -> set:
+    padded = f"  {name.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Case-insensitive edit distance counting an adjacent transposition (emial -> email)
+    as one edit; stops early once max_distance is exceeded.
+    """
+    a, b = a.lower(), b.lower()
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+    before_previous: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before_previous[j - 2] + 1)
+            current.append(cost)
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        before_previous, previous = previous, current
+    return previous[-1]
+
+class _NgramIndex:
+    """Trigram index over identifiers: trigrams shortlist candidates, edit distance ranks them."""
+
+    def __init__(self, names):
+        self.names: Dict[str, str] = {} # lower -> original spelling
+        self._grams: Dict[str, set] = {}
+        for name in names:
+            lower = name.lower()
+            if lower in self.names:
+                continue
+            self.names[lower] = name
+            for gram in _trigrams(name):
+                self._grams.setdefault(gram, set()).add(lower)
+
+    def closest(self, name: str, limit: int = SUGGESTION_LIMIT, within: Optional[List[str]] = None) -> List[str]:
+        query_grams = _trigrams(name)
+        if within is not None:
+            candidates = {candidate.lower() for candidate in within}
+        else:
+            candidates = set()
+            for gram in query_grams:
+                candidates |= self._grams.get(gram, set())
+        max_distance = max(1, len(name) // 3)
+        scored = []
+        for lower in candidates:
+            grams = _trigrams(lower)
+            dice = 2 * len(query_grams & grams) / (len(query_grams) + len(grams))
+            distance = edit_distance(name, lower, max_distance)
+            # Typos are caught by edit distance; dropped/extra words (qty vs order_qty) by trigram overlap.
+            if distance <= max_distance or dice >= 0.5:
+                scored.append((distance if distance <= max_distance else max_distance + 1, -dice, lower))
+        scored.sort()
+        return [self.names.get(lower, lower) for _, _, lower in scored[:limit]]
+
+class SchemaIndex:
+    """Lookup structures over a fetch_all_tables_and_columns() result for error diagnosis."""
+
+    def __init__(self, schema: Dict[str, Any]):
+        self.columns: Dict[Tuple[str, str], List[str]] = {}
+        self.tables_by_name: Dict[str, List[Tuple[str, str]]] = {}
+        self.tables_by_column: Dict[str, List[Tuple[str, str]]] = {}
+        self.databases: List[str] = []
+        for db_name, tables in schema.items():
+            if db_name == "error" or not isinstance(tables, dict) or "error" in tables:
+                continue
+            self.databases.append(db_name)
+            for table_name, columns in tables.items():
+                columns = [c for c in columns if not str(c).startswith("Error fetching columns")]
+                self.columns[(db_name, table_name)] = columns
+                self.tables_by_name.setdefault(table_name.lower(), []).append((db_name, table_name))
+                for column in columns:
+                    self.tables_by_column.setdefault(column.lower(), []).append((db_name, table_name))
+        self.database_names = _NgramIndex(self.databases)
+        self.table_names = _NgramIndex(table for _, table in self.columns)
+        self.column_names = _NgramIndex(self.tables_by_column)
+
+    def resolve_table(self, db_name: Optional[str], table_name: str) -> List[Tuple[str, str]]:
+        matches = self.tables_by_name.get(table_name.lower(), [])
+        if db_name:
+            matches = [m for m in matches if m[0].lower() == db_name.lower()]
+        return matches
+
+    def tables_in(self, db_name: str) -> List[str]:
+        return [table for db, table in self.columns if db.lower() == db_name.lower()]
+
+_schema_index_cache: Dict[str, Any] = {"schema": None, "index": None}
+
+def schema_index_for(schema: Dict[str, Any]) -> SchemaIndex:
+    """Builds (and caches, per schema object) the diagnosis index."""
+    if _schema_index_cache["schema"] is not schema:
+        _schema_index_cache.update(schema=schema, index=SchemaIndex(schema))
+    return _schema_index_cache["index"]
+
+def _table_references(sql: str) -> List[Dict[str, Optional[str]]]:
+    """FROM/JOIN/UPDATE/INTO references in a query: [{'db', 'table', 'alias', 'text'}]."""
+    references = []
+    for match in _TABLE_REFERENCE_RE.finditer(sql):
+        parts = [_unquote(p) for p in match["name"].split(".")]
+        db_name, table_name = (parts[0], parts[1]) if len(parts) == 2 else (None, parts[0])
+        references.append({"db": db_name, "table": table_name, "alias": _unquote(match["alias"]) if match["alias"] else None,
+                           "text": match["name"]})
+    return references
+
+def _replace_identifier(sql: str, old: str, new: str, qualifier: Optional[str] = None) -> str:
+    """Replaces a (optionally backquoted, optionally qualified) identifier outside string literals."""
+    prefix = rf"`?{re.escape(qualifier)}`?\s*\.\s*" if qualifier else r"(?<![\w`.$])"
+    pattern = re.compile(rf"({prefix})`?{re.escape(old)}`?(?![\w`$])", re.IGNORECASE)
+    replacement = lambda m: f"{m.group(1)}{new}" # Keeps the qualifier exactly as written
+    pieces = re.split(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")", sql)
+    return "".join(piece if i % 2 else pattern.sub(replacement, piece) for i, piece in enumerate(pieces))
+
+def _format_names(names: List[str]) -> str:
+    return ", ".join(f"`{name}`" for name in names)
+
+def _suggestion(summary: str, details: List[str], corrected_sql: Optional[str], failed_sql: str) -> str:
+    lines = ["### Suggested Fix", summary]
+    lines += [f"- {detail}" for detail in details]
+    if corrected_sql and corrected_sql.strip() != failed_sql.strip():
+        lines += ["", "Corrected query:", f"```sql\n{corrected_sql.strip()}\n```"]
+    return "\n".join(lines)
+
+def _referenced_tables(index: SchemaIndex, references) -> List[Tuple[Dict[str, Optional[str]], Tuple[str, str]]]:
+    resolved = []
+    for reference in references:
+        for table in index.resolve_table(reference["db"], reference["table"]):
+            resolved.append((reference, table))
+    return resolved
+
+def _diagnose_unknown_column(sql: str, message: str, index: SchemaIndex) -> Optional[str]:
+    match = re.match(r"Unknown column '(?P<column>[^']+)' in '(?P<clause>[^']+)'", message)
+    if not match:
+        return None
+    qualifier, _, column = match["column"].rpartition(".")
+    clause = match["clause"]
+    resolved = _referenced_tables(index, _table_references(sql))
+    if qualifier:
+        qualifier = qualifier.rpartition(".")[2] # db.table.column -> table
+        scoped = [(ref, table) for ref, table in resolved
+                  if qualifier.lower() in {(ref["alias"] or "").lower(), ref["table"].lower()}]
+        if resolved and not scoped:
+            names = [ref["alias"] or ref["table"] for ref, _ in resolved]
+            return _suggestion(f"`{qualifier}` is not a table or alias used in this query, so `{qualifier}.{column}` cannot be resolved.",
+                               [f"Tables/aliases in the query: {_format_names(names)}."], None, sql)
+        resolved = scoped or resolved
+
+    candidate_columns = sorted({c for _, table in resolved for c in index.columns[table]})
+    best = index.column_names.closest(column, within=candidate_columns) if candidate_columns else index.column_names.closest(column)
+    details = []
+    elsewhere = [t for t in index.tables_by_column.get(column.lower(), []) if t not in {table for _, table in resolved}]
+    if elsewhere:
+        details.append(f"`{column}` exists in {_format_names([f'{db}.{t}' for db, t in elsewhere[:SUGGESTION_LIMIT]])}, "
+                       f"which this query does not select from; add a JOIN if that is the table you meant.")
+    if best:
+        owners = [f"{ref['alias'] or ref['table']}.{best[0]}" for ref, table in resolved if best[0] in index.columns[table]]
+        summary = f"Column `{match['column']}` (in the {clause}) does not exist. Did you mean `{best[0]}`?"
+        if owners:
+            details.append(f"`{best[0]}` belongs to {_format_names(owners[:SUGGESTION_LIMIT])}.")
+        if len(best) > 1:
+            details.append(f"Other close matches: {_format_names(best[1:])}.")
+        corrected = _replace_identifier(sql, column, best[0], qualifier or None)
+        return _suggestion(summary, details, corrected, sql)
+    if candidate_columns:
+        details.append(f"Available columns: {_format_names(candidate_columns[:15])}{' …' if len(candidate_columns) > 15 else ''}.")
+        return _suggestion(f"Column `{match['column']}` (in the {clause}) does not exist in the tables this query uses.", details, None, sql)
+    return _suggestion(f"Column `{match['column']}` does not exist.", details, None, sql) if details else None
+
+def _diagnose_unknown_table(sql: str, message: str, index: SchemaIndex) -> Optional[str]:
+    match = re.match(r"Table '(?:(?P<db>[^.']+)\.)?(?P<table>[^']+)' doesn't exist", message)
+    if not match:
+        return None
+    db_name, table = match["db"], match["table"]
+    elsewhere = index.resolve_table(None, table)
+    if elsewhere:
+        qualified = f"{elsewhere[0][0]}.{elsewhere[0][1]}"
+        corrected = None
+        for reference in _table_references(sql):
+            if reference["table"].lower() == table.lower():
+                corrected = sql.replace(reference["text"], f"`{elsewhere[0][0]}`.`{elsewhere[0][1]}`", 1)
+                break
+        return _suggestion(f"Table `{table}` is not in database `{db_name}`, but `{qualified}` exists.",
+                           [f"Also found in: {_format_names([f'{d}.{t}' for d, t in elsewhere[1:]])}."] if len(elsewhere) > 1 else [],
+                           corrected, sql)
+    known_db = db_name and any(db.lower() == db_name.lower() for db in index.databases)
+    best = index.table_names.closest(table, within=index.tables_in(db_name)) if known_db else index.table_names.closest(table)
+    if not best:
+        tables = index.tables_in(db_name) if known_db else []
+        if tables:
+            return _suggestion(f"Table `{table}` does not exist in `{db_name}`.", [f"Tables in `{db_name}`: {_format_names(tables[:15])}."], None, sql)
+        return None
+    details = [f"Other close matches: {_format_names(best[1:])}."] if len(best) > 1 else []
+    corrected = _replace_identifier(sql, table, best[0], db_name) if db_name else sql
+    if corrected == sql: # Referenced without its database qualifier
+        corrected = _replace_identifier(sql, table, best[0], None)
+    return _suggestion(f"Table `{db_name + '.' if db_name else ''}{table}` does not exist. Did you mean `{best[0]}`?",
+                       details, corrected, sql)
+
+def _diagnose_no_database_selected(sql: str, index: SchemaIndex) -> Optional[str]:
+    corrected, details = sql, []
+    for reference in _table_references(sql):
+        if reference["db"]:
+            continue
+        owners = index.resolve_table(None, reference["table"])
+        if len(owners) == 1:
+            corrected = re.sub(rf"(?<![\w`.]){re.escape(reference['text'])}(?![\w`])", f"`{owners[0][0]}`.`{owners[0][1]}`", corrected, count=1)
+        elif owners:
+            details.append(f"`{reference['table']}` exists in several databases: {_format_names([d for d, _ in owners])}; pick one.")
+    if corrected == sql and not details:
+        return None
+    return _suggestion("No default database is selected, so every table must be qualified as `database.table`.", details, corrected, sql)
+
+def _diagnose_unknown_database(sql: str, message: str, index: SchemaIndex) -> Optional[str]:
+    match = re.match(r"Unknown database '(?P<db>[^']+)'", message)
+    best = index.database_names.closest(match["db"]) if match else []
+    if not best:
+        return None
+    return _suggestion(f"Database `{match['db']}` does not exist. Did you mean `{best[0]}`?", [],
+                       _replace_identifier(sql, match["db"], best[0], None), sql)
+
+def _diagnose_ambiguous_column(sql: str, message: str, index: SchemaIndex) -> Optional[str]:
+    match = re.match(r"Column '(?P<column>[^']+)' in (?P<clause>.+?) is ambiguous", message)
+    if not match:
+        return None
+    column = match["column"]
+    owners = [ref["alias"] or ref["table"] for ref, table in _referenced_tables(index, _table_references(sql))
+              if column.lower() in {c.lower() for c in index.columns[table]}]
+    details = [f"Qualify it with the table or alias you mean: {_format_names([f'{owner}.{column}' for owner in owners])}."] if owners else []
+    return _suggestion(f"Column `{column}` (in the {match['clause']}) exists in more than one joined table, so MySQL cannot tell which one you mean.",
+                       details or ["Prefix it with the table name or alias, e.g. `t.column`."], None, sql)
+
+def _diagnose_syntax_error(sql: str, message: str, index: SchemaIndex) -> Optional[str]:
+    match = re.search(r"near '(?P<near>.*)' at line (?P<line>\d+)", message, re.DOTALL)
+    if not match:
+        return None
+    near = match["near"]
+    if near.lower().startswith("from") and re.search(r",\s*from\b", sql, re.IGNORECASE):
+        return _suggestion("There is a comma directly before `FROM`.", ["Remove the trailing comma after the last selected column."],
+                           re.sub(r",(\s*)(from\b)", r"\1\2", sql, count=1, flags=re.IGNORECASE), sql)
+    if not near.strip():
+        stripped = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", "", sql)
+        if stripped.count("(") != stripped.count(")"):
+            return _suggestion("The query ends early: its parentheses are unbalanced.",
+                               [f"Found {stripped.count('(')} `(` and {stripped.count(')')} `)`."], None, sql)
+        if stripped.count("'") % 2 or stripped.count('"') % 2:
+            return _suggestion("The query ends inside an unterminated string literal.", ["Close the quote that was opened."], None, sql)
+        return _suggestion("The query ends before a clause is complete.",
+                           ["Check the last clause (e.g. a dangling `WHERE`, `AND`, `JOIN ... ON` or `ORDER BY`)."], None, sql)
+
+    position = sql.find(near[:40])
+    preceding = re.findall(r"[A-Za-z_]+", sql[:position])[-1:] if position >= 0 else []
+    near_words = re.findall(r"`?[A-Za-z_]+`?", near)[:1]
+    known_identifiers = set(index.tables_by_name) | set(index.tables_by_column) | set(index.database_names.names)
+    # The parser stops at the first token it cannot use; a misspelt keyword is often the one
+    # before it (FORM gets read as a column alias, so the error points at the table name).
+    for word in near_words + preceding:
+        bare = word.strip("`")
+        if word.startswith("`"):
+            continue
+        if word in near_words and bare.lower() in RESERVED_IDENTIFIER_WORDS and bare.lower() in known_identifiers:
+            return _suggestion(f"`{bare}` is a reserved word in MySQL, so it must be backquoted when used as a column or table name.", [],
+                               _replace_identifier(sql, bare, f"`{bare}`", None), sql)
+        if bare.upper() in _SQL_KEYWORD_SET:
+            continue
+        if len(bare) >= 3 and bare.lower() not in known_identifiers:
+            keyword = min(SQL_KEYWORDS, key=lambda k: edit_distance(bare, k))
+            if edit_distance(bare, keyword, 2) <= (1 if len(bare) <= 4 else 2):
+                return _suggestion(f"`{bare}` looks like a misspelling of the keyword `{keyword}`.", [],
+                                   _replace_identifier(sql, bare, keyword, None), sql)
+    return None
+
+def cached_schema() -> Dict[str, Dict[str, Any]]:
+    """The last introspected schema if there is one, otherwise a (coalesced) fresh fetch."""
+    return schema_flight.peek("schema") or fetch_all_tables_and_columns()
+
+def diagnose_sql_error(failed_sql: str, error_message: str, schema: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    Diagnoses common MySQL errors (1046, 1049, 1052, 1054, 1064, 1146) locally.
+    Returns a Markdown suggestion (with a corrected query when one can be derived),
+    or None when no rule applies and the caller should fall back to Gemini.
+    """
+    match = MYSQL_ERROR_RE.search(error_message or "")
+    if not match or not schema or "error" in schema:
+        return None
+    code, message = int(match["code"]), match["message"].strip()
+    index = schema_index_for(schema)
+    try:
+        if code == 1054:
+            return _diagnose_unknown_column(failed_sql, message, index)
+        if code == 1146:
+            return _diagnose_unknown_table(failed_sql, message, index)
+        if code == 1046:
+            return _diagnose_no_database_selected(failed_sql, index)
+        if code == 1049:
+            return _diagnose_unknown_database(failed_sql, message, index)
+        if code == 1052:
+            return _diagnose_ambiguous_column(failed_sql, message, index)
+        if code == 1064:
+            return _diagnose_syntax_error(failed_sql, message, index)
+    except Exception as e: # A diagnosis bug must never hide the original error
+        logger.warning(f"Local SQL error diagnosis failed for error {code}: {e}", exc_info=True)
+    return None
+
+# --- Pre-execution SQL Validation ---
+
+# Generated SQL is checked against the schema index before a connection is checked out:
+# unambiguous mistakes are repaired in place, the rest are rejected with a local suggestion.
+_TABLE_CLAUSE_KEYWORDS = {"FROM", "INTO", "UPDATE"}
+_EXPRESSION_CLAUSE_KEYWORDS = {"ON", "USING", "WHERE", "GROUP BY", "ORDER BY", "HAVING", "LIMIT", "SET", "VALUES", "WINDOW", "PARTITION BY"}
+_SELECT_ALIAS_OPERAND_KEYWORDS = {"END", "NULL", "TRUE", "FALSE"} # Keywords that can end a select expression
+
+sql_validation_stats = {"validated": 0, "repaired": 0, "rejected": 0}
+
+def _is_name_token(tokens, i) -> bool:
+    token = tokens[i]
+    if token.ttype is sqlparse.tokens.Name:
+        return True
+    # Column/table names that sqlparse lexes as keywords (status, date, ...) count when dotted.
+    if token.ttype in sqlparse.tokens.Keyword:
+        before = tokens[i - 1] if i > 0 else None
+        after = tokens[i + 1] if i + 1 < len(tokens) else None
+        return any(t is not None and t.match(sqlparse.tokens.Punctuation, ".") for t in (before, after))
+    return False
+
+def _read_name_chain(tokens, i) -> Tuple[List[Any], int]:
+    """Reads name(.name)* starting at i; returns the name tokens and the index after the chain."""
+    chain = [tokens[i]]
+    i += 1
+    while i + 1 < len(tokens) and tokens[i].match(sqlparse.tokens.Punctuation, ".") and (
+            _is_name_token(tokens, i + 1) or tokens[i + 1].ttype is sqlparse.tokens.Wildcard):
+        chain.append(tokens[i + 1])
+        i += 2
+    return chain, i
+
+def scan_sql_references(sql: str) -> Optional[Dict[str, Any]]:
+    """
+    Extracts table references (with aliases), column references and select-list aliases
+    from a single statement using sqlparse's lexer. Column checks are only enabled for
+    plain single-SELECT statements; subqueries, UNIONs and CTEs keep table checks only.
+    Returns None when the text is not exactly one statement.
+    """
+    statements = [s for s in sqlparse.parse(sql) if str(s).strip().strip(";").strip()]
+    if len(statements) != 1:
+        return None
+    statement = statements[0]
+    if statement.get_type() not in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+        return None # SHOW/DDL name databases and tables in positions this scanner does not model
+    tokens = [t for t in statement.flatten() if not t.is_whitespace and t.ttype not in sqlparse.tokens.Comment]
+    select_count = sum(1 for t in tokens if t.ttype is sqlparse.tokens.DML and t.normalized == "SELECT")
+    has_set_or_cte = any(t.ttype is sqlparse.tokens.CTE or (t.ttype in sqlparse.tokens.Keyword and t.normalized.startswith("UNION"))
+                         for t in tokens)
+    references: Dict[str, Any] = {
+        "statement": statement, "tables": [], "columns": [], "select_aliases": set(), "using_columns": set(),
+        "column_checks": statement.get_type() == "SELECT" and select_count == 1 and not has_set_or_cte,
+    }
+    context, expecting_table, after_operand, after_as, after_over = None, False, False, False, False
+    depth, table_depth = 0, 0 # Parenthesis nesting; commas only separate tables at the FROM's own level
+    select_depths = {0} if statement.get_type() != "SELECT" else set() # Levels where FROM starts a table clause
+    outer: List[Tuple[Optional[str], Optional[Dict[str, Any]]]] = [] # Clause context outside each open parenthesis
+    call_depths: set = set() # Levels that are a function call's argument list
+    using_depth: Optional[int] = None
+    after_call_using = False # CONVERT(x USING utf8mb4), CHAR(65 USING ascii): a character set follows
+    last_table: Optional[Dict[str, Any]] = None
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if _is_name_token(tokens, i):
+            chain, end = _read_name_chain(tokens, i)
+            names = [_unquote(t.value) for t in chain]
+            is_call = end < len(tokens) and tokens[end].match(sqlparse.tokens.Punctuation, "(")
+            if depth in call_depths and len(chain) == 1 and (after_call_using or names[0].upper() == "SEPARATOR"):
+                pass # Character set name, or GROUP_CONCAT(... SEPARATOR ', ')
+            elif using_depth is not None and len(chain) == 1:
+                references["using_columns"].add(names[0].lower()) # JOIN ... USING (col) merges col into one column
+            elif after_over or (context == "window" and depth == table_depth):
+                pass # Named window
+            elif context == "table" and expecting_table:
+                last_table = {"tokens": chain, "span": tokens[i:end], "names": names, "alias": None}
+                references["tables"].append(last_table)
+                expecting_table = False
+            elif is_call:
+                pass # Function name
+            elif context == "table" and last_table is not None and last_table["alias"] is None and len(chain) == 1:
+                last_table["alias"] = names[0]
+            elif context == "select" and len(chain) == 1 and (after_as or after_operand):
+                references["select_aliases"].add(names[0].lower())
+            elif chain[-1].ttype is not sqlparse.tokens.Wildcard:
+                references["columns"].append({"tokens": chain, "names": names})
+            after_operand, after_as, after_over, after_call_using = not is_call, False, False, False
+            i = end
+            continue
+
+        after_over, after_call_using = False, False
+        if token.ttype in sqlparse.tokens.Keyword:
+            keyword = token.normalized
+            after_as = keyword == "AS"
+            if keyword == "USING" and depth in call_depths:
+                after_call_using = True # Not a JOIN ... USING column list
+            elif token.ttype is sqlparse.tokens.DML and keyword == "SELECT":
+                context, expecting_table = "select", False
+                select_depths.add(depth)
+            elif keyword == "FROM" and depth not in select_depths:
+                pass # EXTRACT(YEAR FROM d), TRIM(LEADING 'x' FROM s), SUBSTRING(s FROM 2): not a table clause
+            elif keyword in _TABLE_CLAUSE_KEYWORDS or keyword.endswith("JOIN"):
+                context, expecting_table, last_table, table_depth = "table", True, None, depth
+                if keyword.startswith("NATURAL"):
+                    references["column_checks"] = False # Merged columns are not modelled
+            elif keyword == "WINDOW":
+                context, expecting_table, table_depth = "window", False, depth
+            elif keyword in _EXPRESSION_CLAUSE_KEYWORDS:
+                context, expecting_table = "expression", False
+            after_operand = keyword in _SELECT_ALIAS_OPERAND_KEYWORDS
+            after_over = keyword == "OVER"
+        elif token.match(sqlparse.tokens.Punctuation, ","):
+            expecting_table = context in ("table", "window") and depth == table_depth
+            last_table = None if expecting_table else last_table
+            after_operand = False
+        elif token.match(sqlparse.tokens.Punctuation, "("):
+            if i > 0 and tokens[i - 1].normalized == "USING" and depth not in call_depths:
+                using_depth = depth + 1
+            elif i > 0 and tokens[i - 1].ttype in sqlparse.tokens.Name:
+                call_depths.add(depth + 1)
+            outer.append((context, last_table))
+            expecting_table = False # Derived table or column list
+            after_operand = False
+            depth += 1
+        else:
+            if token.match(sqlparse.tokens.Punctuation, ")"):
+                select_depths.discard(depth)
+                call_depths.discard(depth)
+                using_depth = None if using_depth == depth else using_depth
+                depth -= 1
+                if outer:
+                    # Clauses inside the parentheses (a window's ORDER BY, a subquery's FROM) end with them.
+                    context, last_table = outer.pop()
+            after_operand = token.match(sqlparse.tokens.Punctuation, ")") or token.ttype in sqlparse.tokens.Literal \
+                or token.ttype is sqlparse.tokens.Wildcard
+        i += 1
+    return references
+
+def _confident_match(name: str, candidates: List[str]) -> Optional[str]:
+    """The single closest candidate within typo distance, or None if there is none or a tie."""
+    max_distance = len(name) // 3 # Names shorter than 3 characters are never "repaired"
+    if max_distance == 0:
+        return None
+    scored = sorted((edit_distance(name, candidate, max_distance), candidate) for candidate in candidates)
+    scored = [(distance, candidate) for distance, candidate in scored if distance <= max_distance]
+    if not scored or (len(scored) > 1 and scored[0][0] == scored[1][0]):
+        return None
+    return scored[0][1]
+
+def _quote(identifier: str) -> str:
+    return f"`{identifier}`"
+
+def _rewrite_table_reference(reference: Dict[str, Any], table: Tuple[str, str]):
+    span = reference["span"]
+    span[0].value = f"{_quote(table[0])}.{_quote(table[1])}"
+    for token in span[1:]:
+        token.value = ""
+
+def _validate_table_reference(reference: Dict[str, Any], index: SchemaIndex, repairs: List[str], problems: List[str]) -> Optional[Tuple[str, str]]:
+    names, tokens = reference["names"], reference["tokens"]
+    if len(names) > 2:
+        return None
+    db_name, table_name = (names[0], names[1]) if len(names) == 2 else (None, names[0])
+    if db_name and not any(db.lower() == db_name.lower() for db in index.databases):
+        fixed_db = _confident_match(db_name, index.databases)
+        if fixed_db is None:
+            problems.append(f"Database `{db_name}` does not exist.")
+            return None
+        repairs.append(f"database `{db_name}` -> `{fixed_db}`")
+        tokens[0].value, db_name = _quote(fixed_db), fixed_db
+
+    matches = index.resolve_table(db_name, table_name)
+    if not matches:
+        elsewhere = index.resolve_table(None, table_name)
+        fixed_table = _confident_match(table_name, index.tables_in(db_name)) if db_name else None
+        if fixed_table:
+            repairs.append(f"table `{db_name}.{table_name}` -> `{db_name}.{fixed_table}`")
+            tokens[-1].value = _quote(fixed_table)
+            matches = index.resolve_table(db_name, fixed_table)
+        elif len(elsewhere) == 1:
+            repairs.append(f"table `{'.'.join(names)}` -> `{elsewhere[0][0]}.{elsewhere[0][1]}`")
+            matches = elsewhere
+        elif not db_name and not elsewhere:
+            typo_owners = [t for t in index.columns if t[1] == _confident_match(table_name, [t for _, t in index.columns])]
+            if len(typo_owners) == 1:
+                repairs.append(f"table `{table_name}` -> `{typo_owners[0][0]}.{typo_owners[0][1]}`")
+                matches = typo_owners
+        if not matches:
+            where = f" in `{db_name}`" if db_name else ""
+            options = f" It exists in: {_format_names([f'{d}.{t}' for d, t in elsewhere])}." if elsewhere else ""
+            problems.append(f"Table `{table_name}` does not exist{where}.{options}")
+            return None
+        _rewrite_table_reference(reference, matches[0])
+    elif len(matches) > 1:
+        problems.append(f"Table `{table_name}` exists in several databases ({_format_names([d for d, _ in matches])}); qualify it as `database.table`.")
+        return None
+    elif not db_name:
+        # Queries run without a default database, so an unqualified table would fail with 1046.
+        repairs.append(f"qualified `{table_name}` as `{matches[0][0]}.{matches[0][1]}`")
+        _rewrite_table_reference(reference, matches[0])
+    return matches[0]
+
+def _validate_column_reference(reference: Dict[str, Any], scopes: Dict[str, Tuple[str, str]], tables: List[Tuple[str, str]],
+                               select_aliases: set, using_columns: set, index: SchemaIndex, repairs: List[str], problems: List[str]):
+    names, tokens = reference["names"], reference["tokens"]
+    column = names[-1]
+    if len(names) == 1:
+        if column.lower() in select_aliases:
+            return
+        owners = [table for table in tables if column.lower() in {c.lower() for c in index.columns[table]}]
+        if len(owners) > 1 and column.lower() not in using_columns:
+            problems.append(f"Column `{column}` is ambiguous; it exists in {_format_names([t for _, t in owners])}.")
+        elif not owners:
+            fixed = _confident_match(column, sorted({c for table in tables for c in index.columns[table]}))
+            if fixed is None:
+                problems.append(f"Column `{column}` does not exist in {_format_names([t for _, t in tables])}.")
+                return
+            repairs.append(f"column `{column}` -> `{fixed}`")
+            tokens[-1].value = _quote(fixed)
+        return
+
+    qualifier = names[-2].lower()
+    table = scopes.get(qualifier)
+    if table is None:
+        problems.append(f"`{names[-2]}` in `{'.'.join(names)}` is not a table or alias used in this query.")
+        return
+    if column.lower() in {c.lower() for c in index.columns[table]}:
+        return
+    fixed = _confident_match(column, index.columns[table])
+    if fixed is None:
+        problems.append(f"Column `{column}` does not exist in `{table[0]}.{table[1]}`.")
+        return
+    repairs.append(f"column `{'.'.join(names)}` -> `{names[-2]}.{fixed}`")
+    tokens[-1].value = _quote(fixed)
+
+def validate_generated_sql(sql: str, schema: Optional[Dict[str, Any]]) -> Tuple[str, List[str], List[str]]:
+    """
+    Checks the databases, tables and columns a generated query references against the
+    cached schema index before it is executed.
+
+    Returns:
+        A tuple containing:
+        - sql: The query, rewritten when references were repaired (typos with a single close
+          match, unqualified tables that exist in exactly one database).
+        - repairs: Human-readable descriptions of the rewrites.
+        - problems: References that could not be resolved; the query should not be executed.
+          Only confident findings end up here: anything the scanner does not model is left
+          for MySQL to accept or reject.
+    """
+    if not schema or "error" in schema:
+        return sql, [], []
+    try:
+        references = scan_sql_references(sql)
+        if references is None:
+            return sql, [], []
+        index = schema_index_for(schema)
+        repairs: List[str] = []
+        problems: List[str] = []
+        _validate_references(references, index, repairs, problems)
+    except Exception as e: # A scanner bug must never block a query MySQL might run
+        logger.warning(f"Pre-execution SQL validation failed; running the query unchecked: {e}", exc_info=True)
+        return sql, [], []
+
+    sql_validation_stats["validated"] += 1
+    if problems:
+        sql_validation_stats["rejected"] += 1
+        return sql, repairs, problems
+    if repairs:
+        sql_validation_stats["repaired"] += 1
+        sql = str(references["statement"]).strip()
+    return sql, repairs, problems
+
+def _validate_references(references: Dict[str, Any], index: SchemaIndex, repairs: List[str], problems: List[str]):
+    scopes: Dict[str, Tuple[str, str]] = {}
+    tables: List[Tuple[str, str]] = []
+    unindexed = False # A table the schema index does not cover; its columns cannot be checked
+    for reference in references["tables"]:
+        names = reference["names"]
+        if (len(names) == 2 and names[0].lower() in SYSTEM_DATABASES) or (len(names) == 1 and names[0].upper() == "DUAL"):
+            unindexed = True
+            continue
+        table = _validate_table_reference(reference, index, repairs, problems)
+        if table is None:
+            continue
+        tables.append(table)
+        scopes[table[1].lower()] = table
+        if reference["alias"]:
+            scopes[reference["alias"].lower()] = table
+
+    if references["column_checks"] and tables and not unindexed and not problems:
+        for reference in references["columns"]:
+            if len(reference["names"]) <= 3:
+                _validate_column_reference(reference, scopes, tables, references["select_aliases"], references["using_columns"], index, repairs, problems)
+
+# --- Query Performance Advisor ---
+# A chat query slower than QUERY_ADVISOR_THRESHOLD_MS gets an EXPLAIN FORMAT=JSON (and,
+# when QUERY_ADVISOR_ANALYZE is on, an EXPLAIN ANALYZE, which runs the query again).
+# The plan is searched for full table scans, full index scans, filesorts, temporary
+# tables and joins without a usable index. For scanned tables, the columns the attached
+# condition compares with = / IN (then one range column) become a CREATE INDEX suggestion,
+# unless information_schema.STATISTICS shows an index that already starts with them.
+# Suggestions are never run here: CREATE is data-modifying (risk level 1), so the UI sends
+# them through the usual confirmation flow.
+
+ADVISOR_MIN_SCAN_ROWS = 1000 # Smaller tables are cheap to scan and not worth an index
+ADVISOR_MAX_INDEX_COLUMNS = 3
+ADVISOR_ANALYZE_MAX_CHARS = 4000
+ADVISOR_COLUMN_REF_RE = re.compile(r"`([^`]+)`\.`([^`]+)`\.`([^`]+)`")
+ADVISOR_EQUALITY_AFTER_RE = re.compile(r"\s*(=|<=>|in\s*\()", re.IGNORECASE)
+ADVISOR_EQUALITY_BEFORE_RE = re.compile(r"(=|<=>)\s*$")
+ADVISOR_RANGE_AFTER_RE = re.compile(r"\s*(<|>|<=|>=|between\b|like\s+'[^%_])", re.IGNORECASE)
+
+def _plan_nodes(plan: Any, context: str = ""):
+    """Yields (context key, dict) for every object in an EXPLAIN FORMAT=JSON plan."""
+    if isinstance(plan, dict):
+        yield context, plan
+        for key, value in plan.items():
+            yield from _plan_nodes(value, key)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_nodes(item, context)
+
+def _condition_columns(condition: str, alias: str) -> Tuple[List[str], List[str], Optional[str]]:
+    """(equality columns, range columns, database) of one table alias in an attached condition."""
+    equality: List[str] = []
+    ranges: List[str] = []
+    database = None
+    for match in ADVISOR_COLUMN_REF_RE.finditer(condition):
+        if match.group(2) != alias:
+            continue
+        database, column = match.group(1), match.group(3)
+        after, before = condition[match.end():match.end() + 12], condition[max(0, match.start() - 4):match.start()]
+        if ADVISOR_EQUALITY_AFTER_RE.match(after) or ADVISOR_EQUALITY_BEFORE_RE.search(before):
+            target = equality
+        elif ADVISOR_RANGE_AFTER_RE.match(after):
+            target = ranges
+        else:
+            continue # Inside a function call or another non-sargable expression
+        if column not in equality and column not in target:
+            target.append(column)
+    return equality, ranges, database
+
+def _table_indexes(cursor, database: str, table: str) -> Dict[str, List[str]]:
+    cursor.execute(
+        "SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+        (database, table))
+    indexes: Dict[str, List[str]] = {}
+    for index_name, column_name in cursor.fetchall():
+        indexes.setdefault(str(index_name), []).append(str(column_name).lower())
+    return indexes
+
+def _resolve_plan_table(alias: str, database: Optional[str], aliases: Dict[str, Tuple[Optional[str], str]], schema: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """Maps a plan's table alias back to (database, table) using the query's FROM clause and the cached schema."""
+    db_name, table = aliases.get(alias.lower(), (None, alias))
+    db_name = db_name or database
+    if db_name is None:
+        owners = [db for db, tables in schema.items() if isinstance(tables, dict) and table in tables]
+        db_name = owners[0] if len(owners) == 1 else None
+    if db_name is None or table not in schema.get(db_name, {}):
+        return None
+    return db_name, table
+
+def advise_query(query: str, elapsed_ms: float, schema: Optional[Dict[str, Any]], session_id: Optional[uuid.UUID] = None,
+                 analyze_timeout_ms: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Explains a slow read query and returns findings plus CREATE INDEX suggestions, or None
+    if the query cannot be explained. Runs against the same datasource as the query.
+    """
+    references = scan_sql_references(query)
+    if references is None or not schema or "error" in schema:
+        return None
+    aliases: Dict[str, Tuple[Optional[str], str]] = {}
+    for reference in references["tables"]:
+        names = reference["names"]
+        target = (names[-2] if len(names) > 1 else None, names[-1])
+        aliases[(reference["alias"] or names[-1]).lower()] = target
+
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection(db_name=None, read_only=True, session_id=session_id)
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        cursor.execute(f"EXPLAIN FORMAT=JSON {query}")
+        plan = json.loads(cursor.fetchone()[0])
+
+        findings: List[Dict[str, Any]] = []
+        suggestions: List[Dict[str, Any]] = []
+        for context, node in _plan_nodes(plan):
+            if node.get("using_filesort"):
+                findings.append({"kind": "filesort", "detail": f"The {context.replace('_', ' ') or 'result'} is sorted in a separate pass (filesort) instead of reading rows in index order."})
+            if node.get("using_temporary_table"):
+                findings.append({"kind": "temporary_table", "detail": f"The {context.replace('_', ' ') or 'query'} builds a temporary table."})
+            if context != "table" or "access_type" not in node:
+                continue
+            alias, access_type = node.get("table_name", ""), node["access_type"]
+            rows = int(node.get("rows_examined_per_scan") or 0)
+            joined = "using_join_buffer" in node
+            if access_type not in ("ALL", "index") and not joined:
+                continue
+            equality, ranges, database = _condition_columns(node.get("attached_condition", ""), alias)
+            resolved = _resolve_plan_table(alias, database, aliases, schema)
+            table_label = ".".join(resolved) if resolved else alias
+            if joined:
+                findings.append({"kind": "join_without_index", "table": table_label, "rows": rows,
+                                 "detail": f"{table_label} is joined through a join buffer ({node['using_join_buffer']}): no index matches the join condition."})
+            elif rows < ADVISOR_MIN_SCAN_ROWS:
+                continue
+            else:
+                kind = "full_scan" if access_type == "ALL" else "full_index_scan"
+                findings.append({"kind": kind, "table": table_label, "rows": rows,
+                                 "detail": f"{table_label} is read in full ({'every row' if kind == 'full_scan' else 'every index entry'}, ~{rows} rows per scan)."})
+
+            columns = (equality + ranges[:1])[:ADVISOR_MAX_INDEX_COLUMNS]
+            if not resolved or not columns:
+                continue
+            db_name, table = resolved
+            known = {str(column).lower(): column for column in schema[db_name][table]}
+            columns = [known[column.lower()] for column in columns if column.lower() in known]
+            if not columns:
+                continue
+            wanted = [column.lower() for column in columns]
+            existing = _table_indexes(cursor, db_name, table)
+            covering = next((name for name, index_columns in existing.items() if index_columns[:len(wanted)] == wanted), None)
+            if covering:
+                findings.append({"kind": "index_not_used", "table": table_label,
+                                 "detail": f"Index `{covering}` on {table_label} already starts with ({', '.join(columns)}) but was not used; the condition may match too many rows for it to help."})
+                continue
+            index_name = re.sub(r"\W", "_", f"idx_{table}_{'_'.join(columns)}")[:64]
+            sql = f"CREATE INDEX {_quote(index_name)} ON {_quote(db_name)}.{_quote(table)} ({', '.join(_quote(column) for column in columns)});"
+            if all(suggestion["sql"] != sql for suggestion in suggestions):
+                suggestions.append({"table": table_label, "columns": columns, "sql": sql,
+                                    "reason": f"Lets {table_label} be searched by {' and '.join(columns)} instead of {'joined through a buffer' if joined else 'scanned in full'}."})
+
+        advice: Dict[str, Any] = {"elapsed_ms": round(elapsed_ms, 1), "findings": findings, "suggestions": suggestions}
+        if QUERY_ADVISOR_ANALYZE:
+            try:
+                if analyze_timeout_ms:
+                    cursor.execute(f"SET SESSION max_execution_time = {int(analyze_timeout_ms)}")
+                cursor.execute(f"EXPLAIN ANALYZE {query}")
+                advice["analyze"] = "\n".join(str(row[0]) for row in cursor.fetchall())[:ADVISOR_ANALYZE_MAX_CHARS]
+            except mysql.connector.Error as e:
+                logger.info(f"EXPLAIN ANALYZE skipped: {e}") # Needs MySQL 8.0.18+, or hit the time limit
+        return advice
+    except (mysql.connector.Error, ValueError, TypeError) as e:
+        logger.warning(f"Could not explain slow query '{query}': {e}")
+        return None
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+# --- Question Templates ---
+# Many questions differ only in a literal ("salary of employee 1234", "products in
+# category Books"). After a generated SELECT succeeds, the literals in the question
+# (numbers, quoted strings, and values of the low-cardinality columns the SQL compares
+# with) are matched to the literals in the SQL, and the pair is stored as a template: a
+# question skeleton such as "salary of employee {number}" plus the SQL split into
+# segments around those literals. A template answers questions only after
+# QUESTION_TEMPLATE_CONFIRMATIONS generations with different literals produced the same
+# SQL, which keeps out follow-ups whose SQL depended on the chat history. A matching
+# question is answered without a Gemini call: its literals are escaped by the executing
+# connection, like bound parameters, and placed between the segments. A template whose
+# query fails is dropped. Templates and the probed column values are kept in question_templates.json.
+
+QUESTION_TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "question_templates.json")
+QUESTION_TEMPLATE_CONFIRMATIONS = 2
+QUESTION_TEMPLATE_MAX = 500 # Least recently used templates are dropped beyond this
+QUESTION_TEMPLATE_MIN_WORDS = 2 # Words a skeleton needs besides its slots
+QUESTION_TEMPLATE_MAX_VALUES = 200 # Columns with more distinct values are not treated as categories
+QUESTION_TEMPLATE_VALUES_TTL_SECONDS = 24 * 3600 # Category values are re-read after this when learning
+QUESTION_TEMPLATE_PROBE_TIMEOUT_MS = 2000
+QUESTION_TEMPLATE_MAX_VALUE_WORDS = 4
+QUESTION_TEMPLATE_MAX_CANDIDATES = 4 # Category values per question tried as slots (2**n skeleton lookups)
+_QUESTION_LITERAL_RE = re.compile(r"(?<!\w)'([^']+)'(?!\w)|(?<!\w)\"([^\"]+)\"(?!\w)|(?<![\w.])(\d+(?:\.\d+)?)(?!\w)(?!\.\d)")
+_QUESTION_WORD_RE = re.compile(r"\w+(?:[-'&.]\w+)*|[&+/]") # Standalone &, + and / occur inside category values
+_QUESTION_TRAILING_RE = re.compile(r"[\s?.!;]+$")
+_SQL_NUMBER_TYPES = (sqlparse.tokens.Literal.Number.Integer, sqlparse.tokens.Literal.Number.Float)
+
+_DISPLAY_CONVERTER = MySQLConverter("utf8mb4")
+
+def render_bound_sql(segments: List[str], params: Tuple[Any, ...], conn=None) -> str:
+    """
+    A template's SQL segments with its slot values inlined between them as SQL literals.
+    With a connection the values are escaped by its prepare_for_mysql(), the conversion
+    cursor.execute() applies to parameters (honouring the session's sql_mode); without
+    one, by a default converter for display, history and logs. The segments are never
+    passed through %-formatting, so % in the SQL text stays as it is.
+    """
+    if conn is not None:
+        literals = [bytes(value).decode("utf-8") for value in conn.prepare_for_mysql(params)]
+    else:
+        literals = [bytes(_DISPLAY_CONVERTER.quote(_DISPLAY_CONVERTER.escape(_DISPLAY_CONVERTER.to_mysql(value)))).decode("utf-8")
+                    for value in params]
+    return segments[0] + "".join(literal + segment for literal, segment in zip(literals, segments[1:]))
+
+def _unquote_sql_string(value: str) -> str:
+    quote, body = value[0], value[1:-1]
+    return re.sub(r"\\(.)", r"\1", body.replace(quote * 2, quote))
+
+def _phrase_key(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def _question_literals(question: str) -> List[Dict[str, Any]]:
+    """Quoted strings and numbers in a question, as slots {start, end, kind, text}."""
+    literals = []
+    for match in _QUESTION_LITERAL_RE.finditer(question):
+        if match.group(3) is not None:
+            literals.append({"start": match.start(), "end": match.end(), "kind": "number", "text": match.group(3)})
+        else:
+            text = match.group(1) if match.group(1) is not None else match.group(2)
+            literals.append({"start": match.start(), "end": match.end(), "kind": "text", "text": text})
+    return literals
+
+def _question_phrases(question: str, literals: List[Dict[str, Any]]) -> List[Tuple[int, int, str]]:
+    """Runs of up to QUESTION_TEMPLATE_MAX_VALUE_WORDS adjacent words outside the literals: (start, end, phrase key)."""
+    words = [m for m in _QUESTION_WORD_RE.finditer(question)
+             if not any(literal["start"] < m.end() and m.start() < literal["end"] for literal in literals)]
+    phrases = []
+    for i, first in enumerate(words):
+        for j in range(i, min(i + QUESTION_TEMPLATE_MAX_VALUE_WORDS, len(words))):
+            if j > i and question[words[j - 1].end():words[j].start()].strip():
+                break # Not adjacent
+            phrases.append((first.start(), words[j].end(), _phrase_key(question[first.start():words[j].end()])))
+    return phrases
+
+def _question_key(question: str, slots: List[Dict[str, Any]]) -> str:
+    """The question skeleton: lowercased, spacing collapsed, each slot (sorted by position) replaced by {kind}."""
+    parts, position = [], 0
+    for slot in slots:
+        parts.append(re.sub(r"\s+", " ", question[position:slot["start"]].lower()))
+        parts.append("{" + slot["kind"] + "}")
+        position = slot["end"]
+    parts.append(re.sub(r"\s+", " ", question[position:].lower()))
+    return _QUESTION_TRAILING_RE.sub("", "".join(parts)).strip()
+
+def _like_affixes(value: str, text: str) -> Optional[Tuple[str, str]]:
+    """(prefix, suffix) of % wildcards around text in a string literal, or None if the literal is something else."""
+    core = value.lstrip("%")
+    prefix = value[:len(value) - len(core)]
+    stripped = core.rstrip("%")
+    if stripped.lower() != text.lower():
+        return None
+    return prefix, core[len(stripped):]
+
+def _compared_column(tokens, i: int, aliases: Dict[str, Tuple[Optional[str], str]], schema: Dict[str, Any]) -> Optional[Tuple[str, str, str]]:
+    """(database, table, column) a literal is compared with by =, <>, LIKE, ... or IN (...), if it resolves to one column."""
+    j = i - 1
+    while j > 0 and (tokens[j].ttype in sqlparse.tokens.Literal or tokens[j].match(sqlparse.tokens.Punctuation, ",")):
+        j -= 1 # Earlier items of an IN list
+    if j > 0 and tokens[j].match(sqlparse.tokens.Punctuation, "(") and tokens[j - 1].normalized == "IN":
+        j -= 2
+    elif j == i - 1 and tokens[j].ttype is sqlparse.tokens.Operator.Comparison:
+        j -= 1
+    else:
+        return None
+    chain: List[str] = []
+    while j >= 0 and _is_name_token(tokens, j):
+        chain.insert(0, _unquote(tokens[j].value))
+        if j < 2 or not tokens[j - 1].match(sqlparse.tokens.Punctuation, "."):
+            break
+        j -= 2
+    if not chain:
+        return None
+    column = chain[-1].lower()
+    if len(chain) > 1:
+        candidates = [_resolve_plan_table(chain[-2], chain[-3] if len(chain) > 2 else None, aliases, schema)]
+    else:
+        candidates = [_resolve_plan_table(alias, None, aliases, schema) for alias in aliases]
+    owners = [table for table in candidates if table and any(str(name).lower() == column for name in schema[table[0]][table[1]])]
+    if len(owners) != 1:
+        return None
+    db_name, table = owners[0]
+    return db_name, table, next(str(name) for name in schema[db_name][table] if str(name).lower() == column)
+
+def _sql_literals(references: Dict[str, Any], schema: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Number and string literals of a scanned statement, with the column each string is compared with."""
+    tokens = [t for t in references["statement"].flatten() if not t.is_whitespace and t.ttype not in sqlparse.tokens.Comment]
+    aliases: Dict[str, Tuple[Optional[str], str]] = {}
+    for reference in references["tables"]:
+        names = reference["names"]
+        aliases[(reference["alias"] or names[-1]).lower()] = (names[-2] if len(names) > 1 else None, names[-1])
+    literals = []
+    for i, token in enumerate(tokens):
+        if token.ttype in _SQL_NUMBER_TYPES:
+            literals.append({"token": token, "kind": "number", "value": token.value,
+                             "integer": token.ttype is sqlparse.tokens.Literal.Number.Integer, "column": None})
+        elif token.ttype is sqlparse.tokens.Literal.String.Single:
+            literals.append({"token": token, "kind": "string", "value": _unquote_sql_string(token.value),
+                             "integer": False, "column": _compared_column(tokens, i, aliases, schema)})
+    return literals
+
+class QuestionTemplateStore:
+    """Learned question templates, the category values of the columns they use, and the matcher."""
+
+    def __init__(self, path: str = QUESTION_TEMPLATES_PATH, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.templates: "OrderedDict[str, Dict[str, Any]]" = OrderedDict() # Skeleton -> template, least recently used first
+        self.columns: Dict[str, Dict[str, Any]] = {} # "db.table.column" -> {"values": {phrase key: value} or None, "probed_at"}
+        self.phrases: set = set() # Phrase keys of every known category value
+        self.stats = {"hits": 0, "learned": 0, "confirmed": 0, "discarded": 0}
+        self._lock = threading.Lock()
+        self._tasks: set = set()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read question templates from {self.path}: {e}")
+            return
+        # Templates saved before SQL was kept as segments are dropped and relearned.
+        self.templates = OrderedDict((template["key"], template) for template in data.get("templates", []) if "segments" in template)
+        self.columns = data.get("columns", {})
+        self._index_phrases()
+        logger.info(f"Loaded {len(self.templates)} question templates")
+
+    def _persist(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"templates": list(self.templates.values()), "columns": self.columns}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not write question templates to {self.path}: {e}")
+
+    def _index_phrases(self):
+        self.phrases = {phrase for entry in self.columns.values() for phrase in (entry["values"] or {})
+                        if len(phrase.split()) <= QUESTION_TEMPLATE_MAX_VALUE_WORDS}
+
+    def _column_values(self, column: Tuple[str, str, str]) -> Optional[Dict[str, str]]:
+        """Distinct values of a low-cardinality column by phrase key (None if it has too many), read at most once per TTL."""
+        key = ".".join(column)
+        entry = self.columns.get(key)
+        if entry is not None and self.clock() - entry["probed_at"] < QUESTION_TEMPLATE_VALUES_TTL_SECONDS:
+            return entry["values"]
+        db_name, table, name = column
+        conn = None
+        cursor = None
+        try:
+            conn = get_db_connection(db_name=None, read_only=True)
+            if not conn:
+                return entry["values"] if entry else None
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT /*+ MAX_EXECUTION_TIME({QUESTION_TEMPLATE_PROBE_TIMEOUT_MS}) */ DISTINCT {_quote(name)} "
+                           f"FROM {_quote(db_name)}.{_quote(table)} WHERE {_quote(name)} IS NOT NULL LIMIT {QUESTION_TEMPLATE_MAX_VALUES + 1}")
+            rows = cursor.fetchall()
+        except mysql.connector.Error as e:
+            logger.info(f"Could not read the values of {key} for question templates: {e}")
+            return entry["values"] if entry else None
+        finally:
+            if cursor:
+                cursor.close()
+            if conn and conn.is_connected():
+                conn.close()
+        values = None
+        if len(rows) <= QUESTION_TEMPLATE_MAX_VALUES:
+            values = {}
+            for (value,) in rows:
+                if isinstance(value, (bytes, bytearray)):
+                    value = value.decode("utf-8", "replace")
+                if isinstance(value, str):
+                    values[_phrase_key(value)] = value
+        with self._lock:
+            self.columns[key] = {"values": values, "probed_at": self.clock()}
+            self._index_phrases()
+        return values
+
+    def learn(self, question: str, sql: str, schema: Optional[Dict[str, Any]] = None):
+        """Derives a template from a successful question -> SELECT pair, then confirms or replaces the stored one."""
+        schema = schema or schema_flight.peek("schema")
+        references = scan_sql_references(sql)
+        if references is None or references["statement"].get_type() != "SELECT" or not schema or "error" in schema:
+            return
+        literals = _question_literals(question)
+        sql_literals = _sql_literals(references, schema)
+
+        slots: List[Dict[str, Any]] = []
+        for literal in literals: # Every number and quoted string in the question must come from the SQL
+            if literal["kind"] == "number":
+                targets = [(target, "", "") for target in sql_literals
+                           if target["kind"] == "number" and float(target["value"]) == float(literal["text"])]
+            else:
+                targets = [(target,) + affixes for target in sql_literals if target["kind"] == "string"
+                           for affixes in [_like_affixes(target["value"], literal["text"])] if affixes is not None]
+            if not targets:
+                return
+            slots.append(dict(literal, targets=targets))
+        taken = {id(target[0]["token"]) for slot in slots for target in slot["targets"]}
+        for target in sql_literals:
+            if target["kind"] != "string" or target["column"] is None or id(target["token"]) in taken:
+                continue
+            spans = [(start, end) for start, end, phrase in _question_phrases(question, literals) if phrase == _phrase_key(target["value"])]
+            values = self._column_values(target["column"]) if len(spans) == 1 else None
+            if values is None or _phrase_key(target["value"]) not in values:
+                continue # Stays a fixed part of the template
+            start, end = spans[0]
+            column = ".".join(target["column"])
+            same = next((slot for slot in slots if slot["start"] == start and slot["end"] == end), None)
+            if same is not None and same["kind"] == "value" and same["column"] == column:
+                same["targets"].append((target, "", ""))
+            elif any(slot["start"] < end and start < slot["end"] for slot in slots):
+                return
+            else:
+                slots.append({"start": start, "end": end, "kind": "value", "text": question[start:end], "column": column, "targets": [(target, "", "")]})
+        if not slots:
+            return
+        slots.sort(key=itemgetter("start"))
+
+        placeholders: Dict[int, Dict[str, Any]] = {}
+        for index, slot in enumerate(slots):
+            for target, prefix, suffix in slot["targets"]:
+                if id(target["token"]) in placeholders:
+                    return # One SQL literal, two question literals: ambiguous
+                placeholders[id(target["token"])] = {"slot": index, "prefix": prefix, "suffix": suffix}
+        segments, params = [""], []
+        for token in references["statement"].flatten():
+            placeholder = placeholders.get(id(token))
+            if placeholder is None:
+                segments[-1] += token.value
+            else:
+                segments.append("")
+                params.append(placeholder)
+        segments[0] = segments[0].lstrip()
+        segments[-1] = segments[-1].rstrip().rstrip(";").rstrip()
+
+        key = _question_key(question, slots)
+        if len(re.findall(r"\w+", re.sub(r"\{\w+\}", " ", key))) < QUESTION_TEMPLATE_MIN_WORDS:
+            return
+        specs = []
+        for slot in slots:
+            spec: Dict[str, Any] = {"kind": slot["kind"]}
+            if slot["kind"] == "number":
+                spec["integer"] = all(target["integer"] for target, _, _ in slot["targets"])
+            elif slot["kind"] == "value":
+                spec["column"] = slot["column"]
+            specs.append(spec)
+        seen = [_phrase_key(slot["text"]) if slot["kind"] == "value" else slot["text"] for slot in slots]
+
+        with self._lock:
+            existing = self.templates.get(key)
+            if existing is not None and (existing.get("segments"), existing["slots"], existing["params"]) == (segments, specs, params):
+                if seen not in existing["seen"] and len(existing["seen"]) < QUESTION_TEMPLATE_CONFIRMATIONS:
+                    existing["seen"].append(seen)
+                    if len(existing["seen"]) == QUESTION_TEMPLATE_CONFIRMATIONS:
+                        self.stats["confirmed"] += 1
+                        logger.info(f"Question template confirmed: '{key}'")
+                self.templates.move_to_end(key)
+            else:
+                if existing is not None:
+                    logger.info(f"Question template '{key}' replaced: the generated SQL differs")
+                self.templates[key] = {"id": hashlib.sha1(key.encode("utf-8")).hexdigest()[:12], "key": key, "segments": segments,
+                                       "slots": specs, "params": params, "example": question, "seen": [seen], "hits": 0}
+                self.stats["learned"] += 1
+                while len(self.templates) > QUESTION_TEMPLATE_MAX:
+                    self.templates.popitem(last=False)
+            self._persist()
+
+    def schedule_learn(self, question: str, sql: str, schema: Optional[Dict[str, Any]]):
+        """Learns in the background: probing a column's values must not delay the response."""
+        async def run():
+            try:
+                await run_in_threadpool(self.learn, question, sql, schema)
+            except Exception as e: # Learning is best effort
+                logger.warning(f"Could not learn a question template from '{question}': {e}", exc_info=True)
+        task = asyncio.ensure_future(run())
+        self._tasks.add(task) # Keep a reference until it finishes
+        task.add_done_callback(self._tasks.discard)
+
+    def _bind(self, template: Dict[str, Any], slots: List[Dict[str, Any]]) -> Optional[Tuple[Any, ...]]:
+        values: List[Any] = []
+        for slot, spec in zip(slots, template["slots"]):
+            if spec["kind"] == "number":
+                if spec["integer"] and "." in slot["text"]:
+                    return None
+                values.append(int(slot["text"]) if spec["integer"] else float(slot["text"]))
+            elif spec["kind"] == "value":
+                value = (self.columns.get(spec["column"], {}).get("values") or {}).get(slot["phrase"])
+                if value is None:
+                    return None # Not a value of this template's column
+                values.append(value)
+            else:
+                values.append(slot["text"])
+        return tuple(param["prefix"] + values[param["slot"]] + param["suffix"] if param["prefix"] or param["suffix"] else values[param["slot"]]
+                     for param in template["params"])
+
+    def match(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        Fills a confirmed template whose skeleton matches the question. Returns
+        {"id", "key", "segments", "params", "sql" (literals inlined for display)} or None.
+        """
+        if not self.templates:
+            return None
+        literals = _question_literals(question)
+        candidates: List[Dict[str, Any]] = [] # Longest known category values first, not overlapping
+        for start, end, phrase in sorted(_question_phrases(question, literals), key=lambda p: p[0] - p[1]):
+            if phrase in self.phrases and all(end <= c["start"] or start >= c["end"] for c in candidates):
+                candidates.append({"start": start, "end": end, "kind": "value", "text": question[start:end], "phrase": phrase})
+        candidates = candidates[:QUESTION_TEMPLATE_MAX_CANDIDATES]
+        for size in range(len(candidates), -1, -1):
+            for chosen in itertools.combinations(candidates, size):
+                slots = sorted(literals + list(chosen), key=itemgetter("start"))
+                template = self.templates.get(_question_key(question, slots))
+                if template is None or len(template["seen"]) < QUESTION_TEMPLATE_CONFIRMATIONS:
+                    continue
+                params = self._bind(template, slots)
+                if params is None:
+                    continue
+                with self._lock:
+                    template["hits"] += 1
+                    self.stats["hits"] += 1
+                    if template["key"] in self.templates:
+                        self.templates.move_to_end(template["key"])
+                return {"id": template["id"], "key": template["key"], "segments": template["segments"], "params": params,
+                        "sql": render_bound_sql(template["segments"], params)}
+        return None
+
+    def discard(self, template_id: str) -> bool:
+        with self._lock:
+            key = next((key for key, template in self.templates.items() if template["id"] == template_id), None)
+            if key is None:
+                return False
+            del self.templates[key]
+            self.stats["discarded"] += 1
+            self._persist()
+        return True
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        return [{"id": t["id"], "key": t["key"], "sql": "?".join(t["segments"]), "example": t["example"], "hits": t["hits"],
+                 "confirmed": len(t["seen"]) >= QUESTION_TEMPLATE_CONFIRMATIONS} for t in reversed(self.templates.values())]
+
+    def describe(self) -> Dict[str, Any]:
+        confirmed = sum(1 for t in self.templates.values() if len(t["seen"]) >= QUESTION_TEMPLATE_CONFIRMATIONS)
+        return dict(self.stats, templates=len(self.templates), confirmed_templates=confirmed, category_columns=len(self.columns))
+
+question_templates = QuestionTemplateStore()
+
+# --- Latency Budget ---
+# Each /chat turn gets one deadline that is passed down the pipeline: LLM calls wait for
+# admission and for the HTTP response only until then, and the query runs with the time
+# left as its max_execution_time. Optional stages (insights, error explanations) are
+# skipped when too little time remains, or cut short, and the response lists what was skipped.
+
+LATENCY_MIN_INSIGHTS_SECONDS = 3.0 # Do not start insights with less time than this left
+LATENCY_MIN_EXPLANATION_SECONDS = 2.0
+LATENCY_MIN_EXECUTION_SECONDS = 1.0 # The query always gets at least this long
+LATENCY_MIN_ADVICE_SECONDS = 0.5
+
+class LatencyBudgetExceeded(Exception):
+    """A stage ran out of the turn's latency budget."""
+
+class LatencyBudget:
+    """Deadline for one chat turn; each stage gets whatever is left of it."""
+
+    def __init__(self, seconds: float, clock=time.monotonic):
+        self.seconds = seconds
+        self.clock = clock
+        self.started = clock()
+        self.deadline = self.started + seconds
+        self.stages: Dict[str, float] = {}
+        self.skipped: List[Dict[str, str]] = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - self.clock())
+
+    def skip(self, stage: str, reason: str):
+        logger.info(f"Latency budget: skipped {stage} ({reason})")
+        self.skipped.append({"stage": stage, "reason": reason})
+
+    def allows(self, stage: str, min_seconds: float) -> bool:
+        """True if at least min_seconds remain; otherwise records the stage as skipped."""
+        remaining = self.remaining()
+        if remaining >= min_seconds:
+            return True
+        self.skip(stage, f"only {remaining:.1f}s of the {self.seconds:g}s budget was left")
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + self.clock() - started
+
+    def describe(self) -> Dict[str, Any]:
+        return {"budget_ms": round(self.seconds * 1000), "elapsed_ms": round((self.clock() - self.started) * 1000, 1),
+                "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}}
+
+# --- LLM Admission Control ---
+# Every Gemini call goes through llm_scheduler. It admits at most GEMINI_MAX_CONCURRENCY
+# calls at a time, in priority order (the user's turn first, then error explanations, then
+# insights), within an optional token-per-minute budget. 429 and 5xx responses are retried
+# with jittered exponential backoff, and a 429 pauses admissions for everyone for the
+# backoff period. When the queue is long, insights are shed first: new ones are refused
+# and queued ones are dropped as more important work arrives.
+
+LLM_PRIORITY_TURN = 0 # SQL generation / combined generation / conversational replies
+LLM_PRIORITY_ERROR = 1 # Error explanations
+LLM_PRIORITY_INSIGHTS = 2
+LLM_PRIORITY_NAMES = {LLM_PRIORITY_TURN: "turn", LLM_PRIORITY_ERROR: "error_explanation", LLM_PRIORITY_INSIGHTS: "insights"}
+LLM_MAX_WAIT_SECONDS = {LLM_PRIORITY_TURN: 60.0, LLM_PRIORITY_ERROR: 30.0, LLM_PRIORITY_INSIGHTS: 10.0}
+LLM_SHED_QUEUE_DEPTH = 2 * GEMINI_MAX_CONCURRENCY # Beyond this many waiting calls, insights are shed
+LLM_MAX_ATTEMPTS = 4
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 8.0
+LLM_WAIT_SAMPLES = 500 # Recent queue waits kept for the p50/p95 in /stats
+
+class LLMOverloadedError(Exception):
+    """A Gemini call was shed or waited too long for admission."""
+
+def is_retryable_llm_error(error: Exception) -> bool:
+    """Rate limits, server errors and transport failures are worth retrying."""
+    code = getattr(error, "code", None)
+    if isinstance(error, genai.errors.APIError) and isinstance(code, int):
+        return code == 429 or code >= 500
+    # The client surfaces network failures and its own HTTP timeout as httpx errors.
+    return isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError))
+
+class _LLMTicket:
+    __slots__ = ("priority", "seq", "tokens", "shed")
+
+    def __init__(self, priority: int, seq: int, tokens: int):
+        self.priority, self.seq, self.tokens, self.shed = priority, seq, tokens, False
+
+    def __lt__(self, other: "_LLMTicket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class LLMScheduler:
+    """Priority admission queue with a concurrency limit, a token bucket and 429-aware retries."""
+
+    def __init__(self, max_concurrency: int = GEMINI_MAX_CONCURRENCY, tokens_per_minute: int = GEMINI_TOKENS_PER_MINUTE,
+                 shed_queue_depth: int = LLM_SHED_QUEUE_DEPTH, clock=time.monotonic, sleep=time.sleep):
+        self.max_concurrency = max(1, max_concurrency)
+        self.tokens_per_minute = tokens_per_minute
+        self.shed_queue_depth = shed_queue_depth
+        self.clock = clock
+        self.sleep = sleep
+        self._cond = threading.Condition()
+        self._waiting: List[_LLMTicket] = [] # heap
+        self._seq = 0
+        self.in_flight = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = clock()
+        self.cooldown_until = 0.0
+        self._waits = deque(maxlen=LLM_WAIT_SAMPLES)
+        self.stats = {"admitted": 0, "retries": 0, "rate_limited": 0, "shed": 0, "wait_timeouts": 0, "failures": 0, "max_queue_depth": 0}
+
+    def _refill(self, now: float):
+        if self.tokens_per_minute > 0:
+            self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60.0)
+        self._refilled_at = now
+
+    def _remove(self, ticket: _LLMTicket):
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+
+    def _shed_for(self, priority: int):
+        """Drops the lowest-priority (insights) waiters while the queue is over the shedding depth."""
+        sheddable = sorted((t for t in self._waiting if t.priority == LLM_PRIORITY_INSIGHTS and t.priority > priority), reverse=True)
+        while len(self._waiting) >= self.shed_queue_depth and sheddable:
+            victim = sheddable.pop(0)
+            victim.shed = True
+            self._remove(victim)
+            self.stats["shed"] += 1
+        self._cond.notify_all()
+
+    def _acquire(self, priority: int, tokens: int, deadline: Optional[float] = None) -> float:
+        """Blocks until this call is admitted (or the optional deadline passes); returns the time spent queued."""
+        if self.tokens_per_minute > 0:
+            tokens = min(tokens, self.tokens_per_minute) # An oversized call still runs once the bucket is full
+        with self._cond:
+            if len(self._waiting) >= self.shed_queue_depth:
+                if priority == LLM_PRIORITY_INSIGHTS:
+                    self.stats["shed"] += 1
+                    raise LLMOverloadedError("The AI service is busy; insights were skipped.")
+                self._shed_for(priority)
+            self._seq += 1
+            ticket = _LLMTicket(priority, self._seq, tokens)
+            heapq.heappush(self._waiting, ticket)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._waiting))
+            started = self.clock()
+            budget_deadline = deadline
+            deadline = started + LLM_MAX_WAIT_SECONDS.get(priority, 60.0)
+            if budget_deadline is not None:
+                deadline = min(deadline, budget_deadline)
+            while True:
+                if ticket.shed:
+                    raise LLMOverloadedError("The AI service is busy; this request was shed.")
+                now = self.clock()
+                self._refill(now)
+                blocked_for = 0.0
+                if self._waiting[0] is ticket and self.in_flight < self.max_concurrency:
+                    blocked_for = max(0.0, self.cooldown_until - now)
+                    if not blocked_for and self.tokens_per_minute > 0 and self._tokens < ticket.tokens:
+                        blocked_for = (ticket.tokens - self._tokens) * 60.0 / self.tokens_per_minute
+                    if not blocked_for:
+                        heapq.heappop(self._waiting)
+                        self.in_flight += 1
+                        self._tokens -= ticket.tokens if self.tokens_per_minute > 0 else 0
+                        self.stats["admitted"] += 1
+                        self._waits.append(now - started)
+                        self._cond.notify_all() # The next ticket is now at the head
+                        return now - started
+                if now >= deadline:
+                    self._remove(ticket)
+                    self.stats["wait_timeouts"] += 1
+                    self._cond.notify_all()
+                    if deadline == budget_deadline:
+                        raise LatencyBudgetExceeded("The latency budget ran out while waiting for the AI service.")
+                    raise LLMOverloadedError("Timed out waiting for the AI service.")
+                self._cond.wait(min(deadline - now, blocked_for or 1.0))
+
+    def _release(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        with self._cond:
+            self.in_flight -= 1
+            if self.tokens_per_minute > 0 and actual_tokens is not None:
+                self._tokens = min(self.tokens_per_minute, self._tokens + estimated_tokens - actual_tokens) # Settle the estimate
+            self._cond.notify_all()
+
+    def backoff_seconds(self, attempt: int) -> float:
+        """Full-jitter exponential backoff."""
+        return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+    def run(self, priority: int, estimated_tokens: int, call, deadline: Optional[float] = None):
+        """Runs call() once admitted, retrying rate limits and server errors (never past the deadline)."""
+        for attempt in range(LLM_MAX_ATTEMPTS):
+            self._acquire(priority, estimated_tokens, deadline)
+            actual_tokens = None
+            try:
+                response = call()
+                usage = getattr(response, "usage_metadata", None)
+                if usage is not None:
+                    # Either count can be missing (blocked responses, stub clients).
+                    actual_tokens = (getattr(usage, "prompt_token_count", 0) or 0) + (getattr(usage, "candidates_token_count", 0) or 0)
+                return response
+            except Exception as e:
+                delay = self.backoff_seconds(attempt)
+                if not is_retryable_llm_error(e) or attempt == LLM_MAX_ATTEMPTS - 1 or (deadline is not None and self.clock() + delay >= deadline):
+                    self.stats["failures"] += 1
+                    raise
+                with self._cond:
+                    self.stats["retries"] += 1
+                    if getattr(e, "code", None) == 429:
+                        # The quota is shared: hold every admission back, not just this call.
+                        self.stats["rate_limited"] += 1
+                        self.cooldown_until = max(self.cooldown_until, self.clock() + delay)
+                logger.warning(f"Gemini call failed ({e}); retry {attempt + 1}/{LLM_MAX_ATTEMPTS - 1} in {delay:.2f}s.")
+            finally:
+                self._release(estimated_tokens, actual_tokens)
+            self.sleep(delay)
+
+    def describe(self) -> Dict[str, Any]:
+        with self._cond:
+            waits = sorted(self._waits)
+            depth_by_priority = {name: sum(1 for t in self._waiting if t.priority == priority) for priority, name in LLM_PRIORITY_NAMES.items()}
+            described = dict(self.stats, queue_depth=len(self._waiting), queue_depth_by_priority=depth_by_priority, in_flight=self.in_flight,
+                             max_concurrency=self.max_concurrency, tokens_per_minute=self.tokens_per_minute)
+            if self.tokens_per_minute > 0:
+                described["tokens_available"] = int(self._tokens)
+        if waits:
+            described["wait_ms_p50"] = round(waits[len(waits) // 2] * 1000, 1)
+            described["wait_ms_p95"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1)
+        return described
+
+llm_scheduler = LLMScheduler()
+
+# --- Gemini Prompt Prefix Caching ---
+
+# Every prompt is laid out as [stable prefix | history | task instructions + question]. The
+# prefix (shared instructions + schema) is identical across requests for the same schema, so
+# it is stored once as a Gemini cached content and referenced by name; cached input tokens
+# are billed at a discount and skip re-processing.
+GEMINI_SYSTEM_INSTRUCTION = """You are DataFlow, an expert assistant for SQL, databases and data analysis, connected to a MySQL server.
+- Ground every answer in the database schema below (when one is provided); never invent databases, tables or columns.
+- Always reference tables with fully qualified names (`database_name`.`table_name`); the connection has no default database.
+- Use the prior conversation to resolve vague references such as "it" or "the above".
+- Follow the output format requested in the latest message exactly."""
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_RENEW_MARGIN_SECONDS = 300 # Extend the TTL when a cache is this close to expiring
+PROMPT_CACHE_MIN_TOKENS = 1024 # Gemini rejects cached contents smaller than this
+PROMPT_CACHE_RETRY_SECONDS = 600 # After a failed create, use the uncached prefix for this long
+
+def build_stable_prefix(schema: Optional[Dict[str, Any]]) -> str:
+    """System instructions plus (when available) the schema listing: the cacheable prompt prefix."""
+    if not schema:
+        return GEMINI_SYSTEM_INSTRUCTION
+    schema_string = "Could not fetch schema." if "error" in schema else format_schema_for_prompt(schema)
+    return f"{GEMINI_SYSTEM_INSTRUCTION}\n\nDatabase Schema:\n{schema_string}"
+
+class PromptCacheManager:
+    """
+    Creates and reuses Gemini cached contents keyed by (model, prefix fingerprint).
+    A changed schema yields a new fingerprint and therefore a new cache; the superseded
+    one is deleted. Caches close to expiry get their TTL extended instead of recreated.
+    Prefixes too small to cache, or that the API refuses, are sent as a plain
+    system_instruction so the request still starts with the same stable text.
+    """
+
+    def __init__(self, ttl_seconds: int = PROMPT_CACHE_TTL_SECONDS, renew_margin_seconds: int = PROMPT_CACHE_RENEW_MARGIN_SECONDS,
+                 min_tokens: int = PROMPT_CACHE_MIN_TOKENS, clock=time.time):
+        self.ttl_seconds = ttl_seconds
+        self.renew_margin_seconds = renew_margin_seconds
+        self.min_tokens = min_tokens
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = {} # (model, fingerprint) -> {"name", "expires_at"}
+        self._retry_after: Dict[Tuple[str, str], float] = {}
+        self._flight = SingleFlight() # One create per key even when requests race
+        self.stats = {"requests": 0, "cached_requests": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                      "creates": 0, "renewals": 0, "invalidations": 0, "create_failures": 0}
+
+    def config_for(self, client, model: str, prefix: str, **config_kwargs) -> "genai.types.GenerateContentConfig":
+        """GenerateContentConfig that references the cached prefix, or carries it inline."""
+        name = self._cache_name(client, model, prefix)
+        if name:
+            return genai.types.GenerateContentConfig(cached_content=name, **config_kwargs)
+        return genai.types.GenerateContentConfig(system_instruction=prefix, **config_kwargs)
+
+    def generate(self, client, model: str, prefix: str, contents: List[Dict[str, Any]], **config_kwargs):
+        """generate_content with the prefix cached when possible; records cached vs uncached tokens."""
+        config = self.config_for(client, model, prefix, **config_kwargs)
+        try:
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            if not config.cached_content or is_retryable_llm_error(e):
+                raise # Rate limits, outages and timeouts are retried by llm_scheduler (or end the budget), not by dropping the cache
+            # The cache may have been evicted server-side; drop it and retry inline once.
+            self._drop(model, prefix)
+            config = genai.types.GenerateContentConfig(system_instruction=prefix, **config_kwargs)
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+        self._record_usage(response, bool(config.cached_content))
+        return response
+
+    def _key(self, model: str, prefix: str) -> Tuple[str, str]:
+        return model, hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+
+    def _cache_name(self, client, model: str, prefix: str) -> Optional[str]:
+        key = self._key(model, prefix)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._retry_after.get(key, 0) > now:
+                return None
+        if entry is not None and entry["expires_at"] - now > self.renew_margin_seconds:
+            return entry["name"]
+        if len(prefix) // 4 < self.min_tokens: # ~4 characters per token
+            return None
+        if entry is not None and entry["expires_at"] > now:
+            return self._flight.do(("renew", key), lambda: self._renew(client, key, entry))
+        return self._flight.do(("create", key), lambda: self._create(client, key, prefix))
+
+    def _create(self, client, key: Tuple[str, str], prefix: str) -> Optional[str]:
+        model, fingerprint = key
+        try:
+            cache = client.caches.create(model=model, config=genai.types.CreateCachedContentConfig(
+                system_instruction=prefix, ttl=f"{self.ttl_seconds}s", display_name=f"dataflow-prefix-{fingerprint[:12]}"))
+        except Exception as e:
+            logger.warning(f"Could not create Gemini context cache ({e}); sending the prefix uncached.")
+            with self._lock:
+                self._retry_after[key] = self.clock() + PROMPT_CACHE_RETRY_SECONDS
+                self.stats["create_failures"] += 1
+            return None
+        with self._lock:
+            superseded = [(k, e) for k, e in self._entries.items() if k[0] == model and k != key]
+            for k, _ in superseded:
+                del self._entries[k]
+            self._entries[key] = {"name": cache.name, "expires_at": self.clock() + self.ttl_seconds}
+            self.stats["creates"] += 1
+        logger.info(f"Created Gemini context cache {cache.name} for prefix {fingerprint[:12]}.")
+        for _, old_entry in superseded: # The schema changed: the old prefix will not be requested again
+            self._delete(client, old_entry["name"])
+        return cache.name
+
+    def _renew(self, client, key: Tuple[str, str], entry: Dict[str, Any]) -> Optional[str]:
+        try:
+            client.caches.update(name=entry["name"], config=genai.types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except Exception as e:
+            logger.warning(f"Could not extend Gemini context cache {entry['name']} ({e}); it will be recreated.")
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+        with self._lock:
+            entry["expires_at"] = self.clock() + self.ttl_seconds
+            self.stats["renewals"] += 1
+        return entry["name"]
+
+    def _delete(self, client, name: str):
+        try:
+            client.caches.delete(name=name)
+        except Exception as e:
+            logger.info(f"Could not delete Gemini context cache {name}: {e}")
+
+    def _drop(self, model: str, prefix: str):
+        with self._lock:
+            self._entries.pop(self._key(model, prefix), None)
+
+    def _record_usage(self, response, used_cache: bool):
+        usage = getattr(response, "usage_metadata", None)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["cached_requests"] += int(used_cache)
+            if usage is not None:
+                self.stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+                self.stats["cached_tokens"] += getattr(usage, "cached_content_token_count", 0) or 0
+
+    def invalidate(self, client=None):
+        """Forgets (and, given the client that created them, deletes) every cached prefix."""
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), {}
+            self._retry_after.clear()
+            self.stats["invalidations"] += 1
+        if client is not None:
+            for entry in entries:
+                self._delete(client, entry["name"])
+
+prompt_cache = PromptCacheManager()
+
+def generate_with_prefix(contents: List[Dict[str, Any]], schema: Optional[Dict[str, Any]] = None, priority: int = LLM_PRIORITY_TURN,
+                         budget: Optional[LatencyBudget] = None, **config_kwargs):
+    """
+    Calls Gemini with the stable prefix (instructions + schema) ahead of `contents`, through
+    llm_scheduler. With a budget, both the admission wait and the HTTP call end at its deadline
+    (raising LatencyBudgetExceeded).
+    """
+    client = gemini_client
+    prefix = build_stable_prefix(schema)
+    # ~4 characters per token, plus headroom for the response.
+    estimated_tokens = (len(prefix) + sum(len(part.get("text", "")) for message in contents for part in message["parts"])) // 4 + 512
+    if budget is None:
+        return llm_scheduler.run(priority, estimated_tokens, lambda: prompt_cache.generate(client, GEMINI_MODEL_NAME, prefix, contents, **config_kwargs))
+
+    def call():
+        remaining = budget.remaining()
+        if remaining <= 0:
+            raise LatencyBudgetExceeded("The latency budget ran out before the AI call started.")
+        http_options = genai.types.HttpOptions(timeout=max(1, int(remaining * 1000)))
+        try:
+            return prompt_cache.generate(client, GEMINI_MODEL_NAME, prefix, contents, http_options=http_options, **config_kwargs)
+        except httpx.TimeoutException as e:
+            raise LatencyBudgetExceeded(f"The AI call was cut off by the latency budget ({e}).") from e
+    return llm_scheduler.run(priority, estimated_tokens, call, deadline=budget.deadline)
+
+# --- Insight Cache ---
+# Insights depend only on the question, the query and the rows it returned. When the same
+# question is asked again over unchanged data (a repeated question, a saved-query snapshot)
+# the earlier analysis is returned instead of calling Gemini again. Concurrent misses for
+# the same key share one call.
+
+INSIGHT_CACHE_MAX_ENTRIES = 256
+INSIGHT_CACHE_TTL_SECONDS = 6 * 3600
+
+def result_digest(results: Any) -> str:
+    """Hash of every cell of a result (RawRows wire bytes or decoded rows), in order."""
+    digest = hashlib.sha256()
+    for row in (results.rows if isinstance(results, RawRows) else results):
+        for value in row:
+            if value is None:
+                digest.update(b"\xff\xff\xff\xff") # A length no real cell has
+                continue
+            data = bytes(value) if isinstance(value, (bytes, bytearray)) else json.dumps(value, default=str).encode("utf-8")
+            digest.update(len(data).to_bytes(4, "big") + data) # Length prefix: ("ab", "c") != ("a", "bc")
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def insight_cache_key(original_query: str, sql_query: str, columns: List[str], col_types: str, results: Any) -> str:
+    parts = [original_query.strip(), normalize_sql(sql_query), columns, col_types, result_digest(results)]
+    return hashlib.sha256(json.dumps(parts, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+class InsightCache:
+    """LRU of generated insights with a TTL, keyed by insight_cache_key()."""
+
+    def __init__(self, max_entries: int = INSIGHT_CACHE_MAX_ENTRIES, ttl_seconds: float = INSIGHT_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict() # key -> (expires_at, insights)
+        self._flight = SingleFlight()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def _lookup(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, insights: str):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl_seconds, insights)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        insights = self._lookup(key)
+        with self._lock:
+            self.stats["hits" if insights is not None else "misses"] += 1
+        return insights
+
+    def get_or_generate(self, key: str, generate) -> Optional[str]:
+        """
+        generate()'s result for a key that missed (cached when non-empty). Callers
+        arriving while the same key is being generated wait for that call instead.
+        """
+        def fill():
+            cached = self._lookup(key) # Filled by a call that finished just before this one started
+            if cached is not None:
+                return cached
+            generated = generate()
+            if generated:
+                self.put(key, generated)
+            return generated
+        # The LRU above is the cache; the flight only coalesces, so it keeps no results itself.
+        return self._flight.do(key, fill, is_success=lambda result: False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries, ttl_seconds=self.ttl_seconds)
+
+insight_cache = InsightCache()
+
 # --- Gemini API Interaction ---
 
+def format_schema_for_prompt(schema: Dict[str, Any]) -> str:
+    """Renders a fetch_all_tables_and_columns() result as the schema listing used in prompts."""
+    schema_string = ""
+    for db_name, tables in schema.items():
+        schema_string += f"\nDatabase: `{db_name}`\n"
+        if isinstance(tables, dict): 
+            if not tables:
+                 schema_string += "  (No tables found or accessible)\n"
+            elif "error" in tables:
+                 schema_string += f"  Error fetching tables: {tables['error']}\n"
+            else:
+                for table_name, columns in tables.items():
+                    col_string = ', '.join([f"`{c}`" for c in columns])
+                    schema_string += f"  - Table: `{table_name}`: Columns: {col_string}\n"
+        else:
+             schema_string += f"  Error retrieving table details for this database.\n"
+    return schema_string
+
 # Decorator to check Gemini API initialization
 def ensure_gemini_initialized(func):
     """Decorator to ensure Gemini API is initialized before calling the wrapped function."""
@@ -464,33 +4329,10 @@ def ensure_gemini_initialized(func):
     return wrapper
 
 @ensure_gemini_initialized
-def generate_sql_with_gemini(user_query: str, schema: Dict[str, Dict[str, List[str]]], history: List[Dict[str, Any]]) -> Optional[str]:
+def generate_sql_with_gemini(user_query: str, schema: Dict[str, Dict[str, List[str]]], history: List[Dict[str, Any]], budget: Optional[LatencyBudget] = None) -> Optional[str]:
     """Generates an SQL query using the Gemini API based on user input and multi-DB schema."""
-    schema_string = ""
-    if not schema or "error" in schema: 
-         schema_string = "Could not fetch schema. Please ensure database connection is correct."
-    else:
-        for db_name, tables in schema.items():
-            schema_string += f"\nDatabase: `{db_name}`\n"
-            if isinstance(tables, dict): 
-                if not tables:
-                     schema_string += "  (No tables found or accessible)\n"
-                elif "error" in tables:
-                     schema_string += f"  Error fetching tables: {tables['error']}\n"
-                else:
-                    for table_name, columns in tables.items():
-                        col_string = ', '.join([f"`{c}`" for c in columns])
-                        schema_string += f"  - Table: `{table_name}`: Columns: {col_string}\n"
-            else:
-                 schema_string += f"  Error retrieving table details for this database.\n"
-
-    # The system instruction or initial prompt part
-    system_prompt = f"""You are an expert SQL assistant. Given the following database schema across potentially multiple databases and a user question, generate the most appropriate SQL query to answer the question.
-
-Database Schema:
-{schema_string}
-
-User Question: "{user_query}"
+    # The schema lives in the cached stable prefix; this message carries only the task and the question.
+    prompt = f"""Task: generate the most appropriate SQL query to answer the user question below, using the database schema.
 
 Instructions:
 - Your **only** task is to generate a single, executable MySQL query to answer the user's question based on the schema.
@@ -503,56 +4345,151 @@ Instructions:
 - Do not include any explanations, introductory text, backticks (```sql), or markdown formatting.
 - If the user's request is impossible to answer with a SQL query (e.g., it's a greeting like "hello"), then and only then, respond with the exact text: "Error: This is a conversational query."
 
+User Question: "{user_query}"
+
 SQL Query:"""
 
-    # Combine the history with the new system prompt
+    # Combine the history with the new task prompt
     # The API expects the 'contents' to be a list of these dictionaries.
-    request_contents = history + [{"role": "user", "parts": [{"text": system_prompt}]}]
+    request_contents = history + [{"role": "user", "parts": [{"text": prompt}]}]
 
     try:
         # The new SDK uses client.models.generate_content
         if not gemini_client:
             return "Error: Gemini client not initialized."
             
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=request_contents
-        )
+        response = generate_with_prefix(request_contents, schema, budget=budget)
 
         if not hasattr(response, 'text') or not response.text:
             logger.warning(f"Gemini returned no text for SQL generation from user query: {user_query}")
             return "Error: The AI model did not return a response."
 
-        sql_query = response.text.strip() # Clean up potential markdown formatting
-        if sql_query.startswith("```sql"):
-            sql_query = sql_query[6:]
-        if sql_query.endswith("```"):
-            sql_query = sql_query[:-3]
-        sql_query = sql_query.strip() 
+        return _clean_generated_sql(response.text)
+
+    except LatencyBudgetExceeded as e:
+        logger.warning(f"SQL generation exceeded the latency budget: {e}")
+        return "Error: Generating the SQL query took too long. Please try again."
+    except Exception as e:
+        logger.error(f"Error calling Gemini API for SQL generation: {e}", exc_info=True)
+        return "Error: Failed to communicate with the AI model for SQL generation."
+
+def _clean_generated_sql(text: str) -> str:
+    """Strips markdown fences from generated SQL; returns an "Error: ..." string if it is not SQL."""
+    sql_query = text.strip() # Clean up potential markdown formatting
+    if sql_query.startswith("```sql"):
+        sql_query = sql_query[6:]
+    if sql_query.endswith("```"):
+        sql_query = sql_query[:-3]
+    sql_query = sql_query.strip() 
+
+    logger.info(f"Gemini generated SQL: {sql_query}")
+    if sql_query.lower().startswith("error:"):
+         logger.warning(f"Gemini indicated an error: {sql_query}")
+         return sql_query 
+
+    # Basic validation
+    if not any(kw in sql_query.lower() for kw in ["select", "insert", "update", "delete", "show", "create", "alter", "drop", "use"]):
+         logger.warning(f"Generated text doesn't look like SQL: {sql_query}")
+         return "Error: Generated text does not appear to be a valid SQL query."
+
+    return sql_query
+
+class SqlOrReply(BaseModel):
+    """Structured output of the combined generation call."""
+    kind: Literal["sql", "reply"]
+    sql: Optional[str] = None
+    reply: Optional[str] = None
+
+def parse_sql_or_reply(text: Optional[str]) -> Optional[Dict[str, str]]:
+    """Strictly parses a combined-generation response; None if it does not match the schema."""
+    try:
+        turn = SqlOrReply.model_validate_json(text or "")
+    except ValueError as e:
+        logger.warning(f"Combined generation returned malformed JSON: {e}")
+        return None
+    if turn.kind == "sql":
+        return {"kind": "sql", "sql": _clean_generated_sql(turn.sql)} if turn.sql and turn.sql.strip() else None
+    return {"kind": "reply", "reply": turn.reply.strip()} if turn.reply and turn.reply.strip() else None
+
+def generate_sql_or_reply_with_gemini(user_query: str, schema: Dict[str, Dict[str, List[str]]], history: List[Dict[str, Any]], budget: Optional[LatencyBudget] = None) -> Dict[str, str]:
+    """
+    Resolves a chat turn in one Gemini call using structured JSON output: either
+    {"kind": "sql", "sql": ...} or {"kind": "reply", "reply": ...}.
+    Falls back to the two-call path (SQL generation, then a conversational reply on the
+    "conversational query" sentinel) when the structured response cannot be parsed.
+    """
+    if not gemini_initialized or not gemini_client:
+        return {"kind": "sql", "sql": "Error: Gemini API not configured. Please set up your API key in the configuration."}
 
-        logger.info(f"Gemini generated SQL: {sql_query}")
-        if sql_query.lower().startswith("error:"):
-             logger.warning(f"Gemini indicated an error: {sql_query}")
-             return sql_query 
+    prompt = f"""Task: decide whether the user's message needs a database query or a conversational answer, and respond with JSON only.
 
-        # Basic validation
-        if not any(kw in sql_query.lower() for kw in ["select", "insert", "update", "delete", "show", "create", "alter", "drop", "use"]):
-             logger.warning(f"Generated text doesn't look like SQL: {sql_query}")
-             return "Error: Generated text does not appear to be a valid SQL query."
+Instructions:
+- If the message asks for data, schema information or a change to the data, respond with {{"kind": "sql", "sql": "<query>"}}.
+  - Generate a single, executable MySQL statement. No comments, no markdown, no `USE` statements.
+  - Always use fully qualified table names (e.g., `database_name`.`table_name`).
+  - When using a `JOIN`, select specific, useful columns from both tables instead of `SELECT *`.
+- If the message is a greeting, thanks, a question about concepts, a request to explain earlier results, or anything else that a query cannot answer, respond with {{"kind": "reply", "reply": "<answer in Markdown>"}}.
 
-        return sql_query
+User Message: "{user_query}"
+"""
+    request_contents = history + [{"role": "user", "parts": [{"text": prompt}]}]
 
+    try:
+        response = generate_with_prefix(request_contents, schema, budget=budget, response_mime_type="application/json", response_schema=SqlOrReply)
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            logger.warning(f"Combined generation blocked. Reason: {response.prompt_feedback.block_reason}")
+            return {"kind": "reply", "reply": "I cannot provide a response to that topic."}
+        turn = parse_sql_or_reply(response.text)
+        if turn is not None:
+            logger.info(f"Combined generation resolved the turn as '{turn['kind']}' in one call.")
+            return turn
+    except LatencyBudgetExceeded as e:
+        logger.warning(f"Combined generation exceeded the latency budget: {e}")
+        return {"kind": "sql", "sql": "Error: Generating the SQL query took too long. Please try again."} # No time left for the fallback
     except Exception as e:
-        logger.error(f"Error calling Gemini API for SQL generation: {e}", exc_info=True)
-        return "Error: Failed to communicate with the AI model for SQL generation."
+        logger.error(f"Error calling Gemini API for combined generation: {e}", exc_info=True)
+
+    logger.info("Falling back to separate SQL generation and conversational calls.")
+    generated_sql = generate_sql_with_gemini(user_query, schema, history, budget=budget)
+    if generated_sql and generated_sql.strip().lower().startswith("error: this is a conversational query"):
+        return {"kind": "reply", "reply": get_conversational_response_with_gemini(user_query, history, budget=budget)}
+    return {"kind": "sql", "sql": generated_sql or ""}
 
 @ensure_gemini_initialized
-def get_insights_with_gemini(original_query: str, sql_query: str, results: List[Any], columns: List[str], col_types: str, history: List[Dict[str, Any]]) -> str:
-    """Generates insights on the data using the Gemini API."""
+def get_insights_with_gemini(original_query: str, sql_query: str, results: List[Any], columns: List[str], col_types: str, history: List[Dict[str, Any]], budget: Optional[LatencyBudget] = None) -> str:
+    """Generates insights on the data using the Gemini API. Returns "" when the latency budget cuts it short."""
     if not results:
         return "No results to analyze."
+    cache_key = insight_cache_key(original_query, sql_query, columns, col_types, results)
+    cached = insight_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Serving cached insights for an unchanged result.")
+        return cached
+
+    profile = getattr(results, "profile", None)
+    sample_size = INSIGHTS_SAMPLE_ROWS if profile else 20
+    preview_rows = results.to_python(sample_size) if isinstance(results, RawRows) else results[:sample_size]
+    results_preview = "\n".join(json.dumps(row, separators=(",", ":"), default=str) for row in preview_rows) # One compact JSON array per row
+
+    if profile:
+        coverage = ("A uniform random sample of rows was profiled; the profile below summarises the full result's distribution."
+                    if "sampled_rows" in profile else "Every row was profiled; the profile below summarises the full result.")
+        data_section = f"""The query returned {profile['row_count']} rows. {coverage}
+Columns and Types:
+{col_types}
 
-    results_preview = json.dumps(results[:20], indent=2, default=str) # Limit results sent to Gemini
+Column Profile (over {"a sample of" if "sampled_rows" in profile else "all"} rows):
+{format_result_profile(profile)}
+
+Sample Rows (first {len(preview_rows)}, one JSON array per row, in column order {json.dumps(columns)}):
+{results_preview}"""
+    else:
+        data_section = f"""The query returned the following data (showing up to 20 rows):
+Columns and Types:
+{col_types}
+
+Results (one JSON array per row, in column order {json.dumps(columns)}):
+{results_preview}"""
 
     # The main prompt for this specific task
     prompt = f"""You are a data analyst assistant. A user asked the following question:
@@ -563,15 +4500,10 @@ The following SQL query was executed to fetch data:
 {sql_query}
 ```
 
-The query returned the following data (showing up to 20 rows):
-Columns and Types:
-{col_types}
-
-Results (JSON format):
-{results_preview}
+{data_section}
 
 Instructions:
-- Provide concise, insightful observations based *only* on the provided data sample.
+- Provide concise, insightful observations based *only* on the provided profile and data sample.
 - Do not invent data or make assumptions beyond what's shown.
 - Suggest 1-2 potential follow-up questions or SQL queries the user might be interested in, based on these results and the original question.
 - **Crucially, any suggested SQL query MUST be enclosed in its own Markdown fenced code block with the `sql` language identifier.** For example:
@@ -589,18 +4521,26 @@ Analysis:"""
         if not gemini_client:
             return "Error: Gemini client not initialized."
 
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=request_contents
-        )
-        logger.info("Gemini generated insights.")
-        return response.text if response.text else "No insights could be generated from the data."
+        # Shares the cached prefix with SQL generation; the schema grounds suggested follow-up queries.
+        def generate():
+            response = generate_with_prefix(request_contents, schema_flight.peek("schema"), priority=LLM_PRIORITY_INSIGHTS, budget=budget)
+            logger.info("Gemini generated insights.")
+            return response.text
+        insights = insight_cache.get_or_generate(cache_key, generate)
+        return insights if insights else "No insights could be generated from the data."
+    except LatencyBudgetExceeded as e:
+        if budget is not None: # A call shared with another turn may have run out of that turn's budget
+            budget.skip("insights", f"cut short: {e}")
+        return ""
+    except LLMOverloadedError as e:
+        logger.info(f"Insights shed under load: {e}")
+        return "_Insights were skipped because the AI service is busy right now._"
     except Exception as e:
         logger.error(f"Error calling Gemini API for insights: {e}", exc_info=True)
         return "Error generating insights from the AI model."
 
 @ensure_gemini_initialized
-def get_conversational_response_with_gemini(user_message: str, history: List[Dict[str, Any]]) -> str:
+def get_conversational_response_with_gemini(user_message: str, history: List[Dict[str, Any]], budget: Optional[LatencyBudget] = None) -> str:
     """Gets a conversational response from Gemini for non-SQL related queries."""
     logger.info(f"Getting conversational response for: {user_message}")
     
@@ -631,51 +4571,27 @@ Assistant Response:"""
         if not gemini_client:
             return "Error: Gemini client not initialized."
             
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=request_contents
-        )
+        response = generate_with_prefix(request_contents, schema_flight.peek("schema"), budget=budget)
         if response.prompt_feedback and response.prompt_feedback.block_reason:
              logger.warning(f"Conversational response blocked. Reason: {response.prompt_feedback.block_reason}")
              return "I cannot provide a response to that topic."
 
         return response.text.strip() if response.text else "I am unable to provide a response at this time."
 
+    except LatencyBudgetExceeded as e:
+        logger.warning(f"Conversational response exceeded the latency budget: {e}")
+        return "Sorry, that took too long to answer. Please try again."
     except Exception as e:
         logger.error(f"Error calling Gemini API for conversational response: {e}", exc_info=True)
         return "I'm having trouble responding right now. Please try again later."
 
 @ensure_gemini_initialized
-def get_error_explanation_with_gemini(original_user_query: Optional[str], failed_sql_query: str, error_message: str, schema: Optional[Dict[str, Any]] = None, history: List[Dict[str, Any]] = []) -> str:
-    """Generates a user-friendly explanation for an SQL error using Gemini."""
+def get_error_explanation_with_gemini(original_user_query: Optional[str], failed_sql_query: str, error_message: str, schema: Optional[Dict[str, Any]] = None, history: List[Dict[str, Any]] = [], budget: Optional[LatencyBudget] = None) -> str:
+    """Generates a user-friendly explanation for an SQL error using Gemini. Returns "" when the latency budget cuts it short."""
     prompt_context = f"User's original request (if available): \"{original_user_query}\"\n"
     if not original_user_query:
         prompt_context = "The user was attempting to execute a specific SQL query.\n"
 
-    schema_context = ""
-    if schema:
-        schema_string = ""
-        if not schema or "error" in schema:
-            schema_string = "Could not fetch schema."
-        else:
-            for db_name, tables in schema.items():
-                schema_string += f"\nDatabase: `{db_name}`\n"
-                if isinstance(tables, dict):
-                    if not tables:
-                        schema_string += "  (No tables found or accessible)\n"
-                    elif "error" in tables:
-                        schema_string += f"  Error fetching tables: {tables['error']}\n"
-                    else:
-                        for table_name, columns in tables.items():
-                            col_string = ', '.join([f"`{c}`" for c in columns])
-                            schema_string += f"  - Table: `{table_name}`: Columns: {col_string}\n"
-                else:
-                    schema_string += f"  Error retrieving table details for this database.\n"
-        schema_context = f"""
-For context, here is the database schema the query was run against:
-{schema_string}
-"""
-
     prompt = f"""You are an expert SQL troubleshooting assistant.
 
 The following SQL query failed:
@@ -687,7 +4603,6 @@ The database returned this error message:
 {error_message}
 
 {prompt_context}
-{schema_context}
 Instructions:
 - Explain the error message in simple, easy-to-understand terms in 5-10 sentences maximum.
 - **Use the provided database schema to give a specific, actionable suggestion.** For example, if a column name is wrong, suggest the correct one from the schema.
@@ -706,15 +4621,15 @@ Explanation:"""
         if not gemini_client:
             return "Error: Gemini client not initialized."
             
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=request_contents
-        )
+        response = generate_with_prefix(request_contents, schema, priority=LLM_PRIORITY_ERROR, budget=budget) # The schema the query ran against is in the prefix
         if response.prompt_feedback and response.prompt_feedback.block_reason:
             logger.warning(f"Error explanation response blocked. Reason: {response.prompt_feedback.block_reason}")
             return "AI explanation could not be generated for this error due to content restrictions."
         logger.info("Gemini generated SQL error explanation.")
         return response.text.strip() if response.text else "An AI explanation could not be generated for this error."
+    except LatencyBudgetExceeded as e:
+        budget.skip("error_explanation", f"cut short: {e}")
+        return ""
     except Exception as e:
         logger.error(f"Error calling Gemini API for SQL error explanation: {e}", exc_info=True)
         return "Error generating AI explanation for the SQL error."
@@ -785,6 +4700,50 @@ def get_query_risk_level(sql_query: str) -> int:
         logger.error(f"Failed to parse SQL query for security check: {e}. Flagging as high-risk.")
         return 2 # If any other exception occurs during parsing, fail-closed.
 
+# --- Intent Classification ---
+
+# Character n-gram logistic regression deciding whether a chat message asks for data (SQL)
+# or is conversational. Trained offline by train-intent.py; weights ship as a sparse JSON file.
+INTENT_WEIGHTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent", "weights.json")
+INTENT_CONFIDENCE_THRESHOLD = 0.8 # Below this, messages take the SQL path (Gemini can still bail out)
+INTENT_NGRAM_RANGE = (2, 4)
+INTENT_HASH_BUCKETS = 1 << 15
+
+def intent_features(message: str, ngram_range: Tuple[int, int] = INTENT_NGRAM_RANGE, buckets: int = INTENT_HASH_BUCKETS) -> Dict[int, float]:
+    """L2-normalised hashed character n-gram counts of a message (padded per word)."""
+    words = re.findall(r"[a-z0-9']+|[?!]", message.lower())
+    counts: Dict[int, float] = {}
+    for word in words:
+        padded = f" {word} "
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            for i in range(len(padded) - n + 1):
+                bucket = zlib.crc32(padded[i:i + n].encode("utf-8")) % buckets
+                counts[bucket] = counts.get(bucket, 0.0) + 1.0
+    norm = sum(v * v for v in counts.values()) ** 0.5
+    return {k: v / norm for k, v in counts.items()} if norm else counts
+
+class IntentClassifier:
+    """Scores P(conversational) for a message from a weights file written by train-intent.py."""
+
+    def __init__(self, weights_path: str = INTENT_WEIGHTS_PATH):
+        with open(weights_path, "r", encoding="utf-8") as f:
+            model = json.load(f)
+        self.ngram_range = tuple(model["ngram_range"])
+        self.buckets = model["buckets"]
+        self.bias = model["bias"]
+        self.weights = {int(k): v for k, v in model["weights"].items()}
+
+    def predict_proba(self, message: str) -> float:
+        features = intent_features(message, self.ngram_range, self.buckets)
+        score = self.bias + sum(self.weights.get(bucket, 0.0) * value for bucket, value in features.items())
+        return 1.0 / (1.0 + np.exp(-score))
+
+try:
+    intent_classifier: Optional[IntentClassifier] = IntentClassifier()
+except (OSError, ValueError, KeyError) as e:
+    logger.warning(f"Intent classifier unavailable ({e}); falling back to keyword matching.")
+    intent_classifier = None
+
 # --- Pydantic Models ---
 
 # Helper to classify whether a message is conversational-only (does not request new SQL).
@@ -794,8 +4753,13 @@ def _looks_conversational_only(message: str) -> bool:
     """Determine if the user message looks like a conversational or explanatory request.
 
     The goal is to let the assistant stay in conversational mode when the user says
-    things such as "explain the above" or "don't write SQL".
+    things such as "explain the above" or "don't write SQL". Uses the trained intent
+    classifier when its weights file is present, keyword markers otherwise.
     """
+    if intent_classifier is not None:
+        # Only confident predictions skip the schema fetch and the SQL-generation call.
+        return intent_classifier.predict_proba(message) >= INTENT_CONFIDENCE_THRESHOLD
+
     msg = message.strip().lower()
     if msg.startswith(("hello", "hi", "hey", "thanks", "thank you", "ok")):
         return True
@@ -837,16 +4801,282 @@ class ConfirmedExecutionRequest(BaseModel):
     query: str
 
 
+class ExplainErrorRequest(BaseModel):
+    query: str
+    error: str
+    user_query: Optional[str] = None
+
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    concurrency: Optional[int] = None
+    timeout_seconds: Optional[float] = None
+
+
+class SaveQueryRequest(BaseModel):
+    query: str
+    name: Optional[str] = None
+    interval: str = SAVED_QUERY_DEFAULT_INTERVAL
+
+
+class SnapshotFilter(BaseModel):
+    column: str
+    op: Literal["eq", "ne", "lt", "le", "gt", "ge", "in", "contains", "is_null", "not_null"]
+    value: Any = None
+
+
+class SnapshotAggregate(BaseModel):
+    func: Literal["count", "count_distinct", "sum", "avg", "min", "max"]
+    column: str = "*"
+
+
+class SnapshotSort(BaseModel):
+    column: str
+    descending: bool = False
+
+
+class SnapshotQueryRequest(BaseModel):
+    filters: List[SnapshotFilter] = []
+    group_by: List[str] = []
+    aggregates: List[SnapshotAggregate] = []
+    sort: List[SnapshotSort] = []
+    limit: int = RESULT_DISPLAY_LIMIT
+
+
+class ChartDataRequest(BaseModel):
+    x: str
+    y: Optional[str] = None # Without y, rows are counted per bin/category
+    snapshot_id: Optional[str] = None
+    query: Optional[str] = None # Re-run when no snapshot is given (read-only queries only)
+    mode: Literal["auto", "lttb", "bins"] = "auto"
+    agg: Literal["avg", "sum", "min", "max", "count"] = "avg"
+    points: int = CHART_DEFAULT_POINTS
+
+
+# --- Response Compression ---
+
+COMPRESSION_MIN_SIZE = 1024 # Responses smaller than this go out uncompressed
+COMPRESSION_THREAD_MIN_SIZE = 256 * 1024 # Larger single-chunk bodies are compressed off the event loop
+GZIP_DYNAMIC_LEVEL = 6
+BROTLI_DYNAMIC_QUALITY = 4 # Dynamic bodies favour speed; precompressed static assets use quality 11
+# Already-compressed or streaming-sensitive payloads that gain nothing from another pass.
+UNCOMPRESSIBLE_MEDIA_PREFIXES = ("image/", "audio/", "video/", "font/woff", "application/gzip", "application/x-gzip",
+                                 "application/zip", "application/vnd.apache.parquet", "text/event-stream")
+
+try:
+    import brotli # Optional: enables 'br' for dynamic responses
+except ImportError:
+    brotli = None
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parses an Accept-Encoding header into {coding: q}."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, *params = [token.strip() for token in part.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name.lower()] = q
+    return accepted
+
+def negotiate_encoding(accept_encoding: str, available: Tuple[str, ...]) -> Optional[str]:
+    """Picks the first of `available` (in preference order) that the client accepts."""
+    accepted = _accepted_encodings(accept_encoding)
+    for encoding in available:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+class _StreamCompressor:
+    """Incremental gzip/brotli encoder; flushes per chunk so streamed exports keep flowing."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_DYNAMIC_QUALITY)
+        else:
+            self._gzip = zlib.compressobj(GZIP_DYNAMIC_LEVEL, zlib.DEFLATED, 31) # wbits 31 -> gzip container
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._brotli.process(data) if data else b""
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        out = self._gzip.compress(data) if data else b""
+        return out + self._gzip.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with brotli (when installed) or gzip.
+    Skips small bodies, uncompressible media types, partial/empty responses and
+    anything that already carries a Content-Encoding (e.g. /schema's cached gzip
+    body, gzipped exports and precompressed static assets).
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate_encoding(accept_encoding, self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "compressor": None, "passthrough": False}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                headers = {name.lower(): value for name, value in message.get("headers", [])}
+                media_type = headers.get(b"content-type", b"").decode("latin-1").lower()
+                state["passthrough"] = (
+                    b"content-encoding" in headers
+                    or message["status"] in (204, 206, 304)
+                    or media_type.startswith(UNCOMPRESSIBLE_MEDIA_PREFIXES)
+                )
+                if state["passthrough"]:
+                    await send(message)
+                else:
+                    state["start"] = message # Held until the first body chunk decides
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if state["start"] is not None:
+                start, state["start"] = state["start"], None
+                raw_headers = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+                vary = [v for k, v in start.get("headers", []) if k.lower() == b"vary"]
+                if not more_body and len(body) < self.minimum_size:
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+                state["compressor"] = _StreamCompressor(encoding)
+                vary_value = b", ".join(vary) if vary else b""
+                if b"accept-encoding" not in vary_value.lower():
+                    vary_value = vary_value + b", Accept-Encoding" if vary_value else b"Accept-Encoding"
+                raw_headers += [(b"content-encoding", encoding.encode("latin-1")), (b"vary", vary_value)]
+                if not more_body:
+                    if len(body) >= COMPRESSION_THREAD_MIN_SIZE:
+                        compressed = await run_in_threadpool(state["compressor"].compress, body, True)
+                    else:
+                        compressed = state["compressor"].compress(body, True)
+                    raw_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                    await send({**start, "headers": raw_headers})
+                    await send({"type": "http.response.body", "body": compressed, "more_body": False})
+                    return
+                await send({**start, "headers": raw_headers})
+            await send({"type": "http.response.body",
+                        "body": state["compressor"].compress(body, not more_body),
+                        "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
 # --- Static Files with Caching ---
+
+STATIC_DIR = "static"
+PRECOMPRESSED_VARIANTS = (("br", ".br"), ("gzip", ".gz")) # Preference order; built by build-static.py
+# main.<12 hex chars>.js -> main.js
+FINGERPRINTED_ASSET_RE = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<ext>\.[A-Za-z0-9]+)$")
+
 class CachingStaticFiles(StaticFiles):
-    def __init__(self, *args, max_age: int = 31536000, **kwargs):
+    """
+    Static files with content-hash fingerprinted URLs and precompressed variants.
+
+    `asset_url("main.js")` returns `/static/main.<sha256[:12]>.js`; requests for a
+    fingerprinted URL are served from the plain file with one-year immutable caching,
+    while un-fingerprinted URLs must revalidate (ETag/Last-Modified) so a deploy is
+    never masked by a stale cache. When the client accepts it and a fresh `.br`/`.gz`
+    sibling exists, that variant is sent instead of compressing on every request.
+    """
+
+    def __init__(self, *args, max_age: int = 31536000, url_prefix: str = "/static", **kwargs):
         super().__init__(*args, **kwargs)
         self.max_age = max_age
+        self.url_prefix = url_prefix
+        self._digests: Dict[str, Tuple[Tuple[float, int], str]] = {} # path -> ((mtime, size), digest)
+
+    def asset_digest(self, path: str) -> Optional[str]:
+        """Content hash of a static file; recomputed only when its mtime/size changes."""
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None:
+            return None
+        key = (stat_result.st_mtime, stat_result.st_size)
+        cached = self._digests.get(path)
+        if cached is None or cached[0] != key:
+            with open(full_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            cached = self._digests[path] = (key, digest)
+        return cached[1]
+
+    def asset_url(self, path: str) -> str:
+        """Fingerprinted URL for use in templates; falls back to the plain URL for unknown files."""
+        digest = self.asset_digest(path)
+        if digest is None:
+            logger.warning(f"Static asset '{path}' not found; serving it without a fingerprint.")
+            return f"{self.url_prefix}/{path}"
+        stem, ext = os.path.splitext(path)
+        return f"{self.url_prefix}/{stem}.{digest}{ext}"
+
+    def _precompressed_response(self, path: str, scope) -> Optional[Response]:
+        request_headers = Headers(scope=scope)
+        accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+        _, source_stat = self.lookup_path(path)
+        if source_stat is None:
+            return None
+        for encoding, suffix in PRECOMPRESSED_VARIANTS:
+            if accepted.get(encoding, accepted.get("*", 0.0)) <= 0:
+                continue
+            full_path, stat_result = self.lookup_path(path + suffix)
+            # A variant older than its source is stale (the source changed since the last build).
+            if stat_result is None or stat_result.st_mtime < source_stat.st_mtime:
+                continue
+            response = FileResponse(full_path, stat_result=stat_result, media_type=mimetypes.guess_type(path)[0],
+                                    headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+            if self.is_not_modified(response.headers, request_headers):
+                return NotModifiedResponse(response.headers)
+            return response
+        return None
 
     async def get_response(self, path: str, scope):
-        response = await super().get_response(path, scope)
-        if response.status_code == 200:
-            response.headers.setdefault("Cache-Control", f"public, max-age={self.max_age}, immutable")
+        fingerprinted = False
+        match = FINGERPRINTED_ASSET_RE.match(os.path.basename(path))
+        if match:
+            plain_path = os.path.join(os.path.dirname(path), match["stem"] + match["ext"])
+            current_digest = self.asset_digest(plain_path)
+            # Any digest resolves to the current file; only the current digest earns immutable caching.
+            if current_digest is not None:
+                fingerprinted = current_digest == match["digest"]
+                path = plain_path
+
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            response = await run_in_threadpool(self._precompressed_response, path, scope)
+        if response is None:
+            response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            if fingerprinted:
+                response.headers.setdefault("Cache-Control", f"public, max-age={self.max_age}, immutable")
+            else:
+                response.headers.setdefault("Cache-Control", "no-cache")
         return response
 
 # --- FastAPI Application ---
@@ -870,13 +5100,24 @@ async def lifespan(app: FastAPI):
     # We need a way to pass this to the root response. A simple global might suffice for this narrow case.
     # A better approach might involve a middleware that creates sessions if they don't exist.
     app.state.initial_session_id = session_id
+
+    saved_queries.load()
+    question_templates.load()
+    background = [asyncio.ensure_future(saved_queries.run_scheduler())]
+    if datasource_router.replicas:
+        background.append(asyncio.ensure_future(datasource_router.run_health_checks()))
     yield
-    # No shutdown logic needed for now
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
 
 app = FastAPI(title="SQL Assistant with Gemini", lifespan=lifespan)
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
 # Mount static files using the caching-enabled subclass so that browsers can cache assets effectively.
-app.mount("/static", CachingStaticFiles(directory="static", max_age=31536000), name="static")
+static_files = CachingStaticFiles(directory=STATIC_DIR, max_age=31536000)
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory=".") # Expect index.html in the root directory
+templates.env.globals["asset_url"] = static_files.asset_url # {{ asset_url('main.js') }} -> fingerprinted URL
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -927,13 +5168,60 @@ async def get_config_status():
     )
 
 @app.get("/schema", response_class=JSONResponse)
-async def get_schema():
+async def get_schema(request: Request):
     """API endpoint to fetch the current database schema."""
-    schema = fetch_all_tables_and_columns()
+    # Sidebar refreshes may be served the previous schema while another request is re-introspecting.
+    schema = await run_in_threadpool(fetch_all_tables_and_columns, True)
     if "error" in schema:
          # Returning 200 but with error content for client-side handling
          return JSONResponse(content={"schema": schema}, status_code=200)
-    return JSONResponse(content={"schema": schema})
+    # The ETag is the schema fingerprint, so an unchanged schema costs a 304 and no body.
+    encoded, fingerprint = encoded_schema_body(schema)
+    return conditional_json_response(request, encoded, fingerprint)
+
+@app.get("/schema/databases", response_class=JSONResponse)
+async def get_schema_databases(request: Request):
+    """Lazy schema API: lists databases with their table counts."""
+    result = await run_in_threadpool(schema_flight.do, "databases", fetch_database_list)
+    if "error" in result:
+        return JSONResponse(content=result, status_code=200)
+    return conditional_json_response(request, _EncodedBody(json.dumps(result).encode("utf-8")))
+
+@app.get("/schema/{db_name}/tables", response_class=JSONResponse)
+async def get_schema_tables(request: Request, db_name: str, cursor: str = "", limit: int = SCHEMA_TABLES_PAGE_SIZE):
+    """Lazy schema API: one page of tables and their columns; pass next_cursor back as ?cursor= for the next page."""
+    limit = max(1, min(limit, 1000))
+    # Pages are only coalesced, not kept: the key comes from the client, so storing results would grow without bound.
+    result = await run_in_threadpool(schema_flight.do, ("tables", db_name, cursor, limit), lambda: fetch_tables_page(db_name, cursor, limit),
+                                     is_success=lambda page: False)
+    if "error" in result:
+        return JSONResponse(content=result, status_code=200)
+    return conditional_json_response(request, _EncodedBody(json.dumps(result).encode("utf-8")))
+
+@app.get("/stats", response_class=JSONResponse)
+async def get_stats():
+    """Counters for the local fast paths that avoid DB and LLM round trips, and for Gemini prompt caching."""
+    validation = dict(sql_validation_stats)
+    # Every repaired query is a failed execution (pool checkout + MySQL round trip) and an
+    # error explanation that did not have to happen. Rejections are not counted: the scanner
+    # cannot prove the rejected query would have failed.
+    avoided = validation["repaired"]
+    validation.update(db_round_trips_saved=avoided, error_explanations_saved=avoided)
+    saved = dict(saved_queries.stats, saved=len(saved_queries.definitions))
+    return JSONResponse(content={"sql_validation": validation, "prompt_cache": dict(prompt_cache.stats), "saved_queries": saved, "llm": llm_scheduler.describe(),
+                                 "insight_cache": insight_cache.describe(), "result_snapshots": result_snapshots.describe(), "question_templates": question_templates.describe(),
+                                 "datasources": dict(datasource_router.describe(), primary=primary_pool.describe())})
+
+@app.get("/workload_report", response_class=JSONResponse)
+async def workload_report(limit: int = WORKLOAD_REPORT_LIMIT):
+    """
+    The app's logged statements matched to performance_schema digests on every server,
+    ranked by total latency, rows examined and execution count, with candidate remedies.
+    """
+    report = await run_in_threadpool(build_workload_report, max(1, min(limit, 500)))
+    if report["logged_statements"] and not any(server["status"] == "ok" for server in report["servers"]):
+        return JSONResponse(content={"type": "error", "content": "Could not read performance_schema on any server.", "servers": report["servers"]}, status_code=503)
+    return JSONResponse(content=jsonable_encoder(report))
 
 @app.post("/reset_chat", response_class=JSONResponse)
 async def reset_chat(session_id: uuid.UUID = Depends(cookie)):
@@ -942,9 +5230,45 @@ async def reset_chat(session_id: uuid.UUID = Depends(cookie)):
     new_session_data = SessionData()
     # Replace the old session data with the new empty one
     await session_backend.update(session_id, new_session_data)
+    result_snapshots.drop_session(session_id)
     logger.info(f"Chat history for session {session_id} has been reset.")
     return JSONResponse(content={"status": "success", "message": "Chat history has been reset."})
 
+def test_mysql_credentials(host: str, user: str, password: str) -> str:
+    """Opens and closes one connection; returns "success" or "failed: <reason>"."""
+    try:
+        conn = mysql.connector.connect(host=host, user=user, password=password, auth_plugin='mysql_native_password',
+                                       connection_timeout=CONFIG_TEST_TIMEOUT_SECONDS)
+        conn.close()
+        return "success"
+    except mysql.connector.Error as err:
+        logger.error(f"Failed to connect with new MySQL credentials: {err}")
+        return f"failed: {err}"
+
+def test_gemini_api_key(api_key: str) -> str:
+    """Makes a one-token call with the key; returns "success", "not_provided" or "failed: <reason>"."""
+    if not api_key:
+        return "not_provided"
+    try:
+        test_client = genai.Client(api_key=api_key, http_options=genai.types.HttpOptions(timeout=CONFIG_TEST_TIMEOUT_SECONDS * 1000))
+        test_response = test_client.models.generate_content(model=GEMINI_MODEL_NAME, contents="ping", config={"max_output_tokens": 1})
+        return "success" if test_response.text else "failed: no response"
+    except Exception as e:
+        logger.error(f"Failed to initialize Gemini API with new key: {e}")
+        return f"failed: {e}"
+
+pool_swap_tasks: set = set()
+
+def schedule_primary_pool_swap(config: Dict[str, Any]):
+    """Builds, warms and swaps in the primary pool in the background."""
+    async def swap():
+        if await run_in_threadpool(primary_pool.rebuild, config):
+            schema_flight.forget() # Anything introspected through the old pool may describe the old server
+            saved_queries.invalidate()
+    task = asyncio.ensure_future(swap())
+    pool_swap_tasks.add(task) # Keep a reference until it finishes
+    task.add_done_callback(pool_swap_tasks.discard)
+
 @app.post("/config", response_class=JSONResponse)
 async def update_config(config_request: ConfigRequest):
     """Updates application configuration and tests connections."""
@@ -961,52 +5285,30 @@ async def update_config(config_request: ConfigRequest):
             "gemini_api_key": gemini_api_key
         }
         
-        mysql_status = "failed: unknown"
-        try: # Test MySQL connection
-            conn = mysql.connector.connect(
-                host=mysql_host,
-                user=mysql_user,
-                password=mysql_password,
-                auth_plugin='mysql_native_password'
-            )
-            conn.close()
-            mysql_status = "success"
-        except mysql.connector.Error as err:
-            logger.error(f"Failed to connect with new MySQL credentials: {err}")
-            mysql_status = f"failed: {err}"
-            
-        gemini_status = "failed: unknown"
-        original_key = GEMINI_API_KEY
-        try: # Test Gemini API key
-            if gemini_api_key:
-                # Use the new SDK's client for testing
-                test_client = genai.Client(api_key=gemini_api_key)
-                test_response = test_client.models.generate_content(
-                    model=GEMINI_MODEL_NAME,
-                    contents="ping",
-                    config={
-                        "max_output_tokens": 1
-                    }
-                )
-                if test_response.text:
-                    gemini_status = "success"
-                else:
-                    gemini_status = "failed: no response"
-            else:
-                gemini_status = "not_provided"
-        except Exception as e:
-            logger.error(f"Failed to initialize Gemini API with new key: {e}")
-            gemini_status = f"failed: {e}"
-            # Restore the original key if test failed
-            os.environ["GEMINI_API_KEY"] = original_key
-            if original_key: initialize_gemini_api() 
+        # Test both connections concurrently; a test still running at the deadline is
+        # reported as timed out and its result ignored.
+        mysql_test = asyncio.ensure_future(run_in_threadpool(test_mysql_credentials, mysql_host, mysql_user, mysql_password))
+        gemini_test = asyncio.ensure_future(run_in_threadpool(test_gemini_api_key, gemini_api_key))
+        await asyncio.wait({mysql_test, gemini_test}, timeout=CONFIG_TEST_TIMEOUT_SECONDS + 1)
+        mysql_status = mysql_test.result() if mysql_test.done() else "failed: timed out"
+        gemini_status = gemini_test.result() if gemini_test.done() else "failed: timed out"
         
-        update_environment(config_data) # Update environment and .env file
+        update_environment(config_data, gemini_validated=gemini_status == "success") # Update environment and .env file
+        datasource_router.reset_pools() # Replicas share the MySQL credentials
+        if mysql_status == "success":
+            # Queries keep using the old pool until the new one is warm.
+            pool_status = "warming"
+            schedule_primary_pool_swap(primary_connection_config())
+        else:
+            pool_status = "reset"
+            primary_pool.reset()
+            saved_queries.invalidate()
         
         return JSONResponse(content={
             "status": "success",
             "mysql_connection": mysql_status,
             "gemini_api": gemini_status,
+            "connection_pool": pool_status,
             "message": "Configuration updated. Check connection statuses.",
             "restart_needed": False 
         })
@@ -1028,18 +5330,26 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
     
     # Use a copy of the session history for this request to avoid modifying it mid-process
     history = list(session_data.history)
+    budget = LatencyBudget(CHAT_LATENCY_BUDGET_SECONDS) # Each stage below gets what is left of it
+    generated = False # Only SQL generated for this question is learned as a question template
 
     try:
         # Step 1: Determine the nature of the user message.
+        template_match = question_templates.match(user_message) if QUESTION_TEMPLATES and not user_message.lower().startswith("/run ") else None
         if user_message.lower().startswith("/run "):
             # Direct SQL execution command.
             query_to_run = user_message[5:].strip()
             if not query_to_run:
                 response_data = {"type": "error", "content": "No query provided after /run command."}
                 return JSONResponse(content=response_data)
+        elif template_match is not None:
+            # Same question shape as a confirmed template: its new literals are bound as parameters, no Gemini call.
+            logger.info(f"Answering from question template '{template_match['key']}'")
+            query_to_run = template_match["sql"]
         elif _looks_conversational_only(user_message):
             # The user appears to want a non-SQL explanation or general conversation.
-            model_response_text = get_conversational_response_with_gemini(user_message, history)
+            with budget.stage("generation"):
+                model_response_text = await run_in_threadpool(get_conversational_response_with_gemini, user_message, history, budget)
             response_data = {"type": "info", "content": model_response_text}
 
             add_to_history(session_data, "user", user_message)
@@ -1049,7 +5359,8 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
             return JSONResponse(content=jsonable_encoder(response_data))
         else:
             logger.info(f"Processing natural language query: {user_message}")
-            schema = fetch_all_tables_and_columns()
+            with budget.stage("schema"):
+                schema = await run_in_threadpool(fetch_all_tables_and_columns)
             if "error" in schema:
                 error_msg = "Could not fetch database schema to process your request."
                 if schema.get("error", {}).get("schema"):
@@ -1057,12 +5368,21 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
                 response_data = {"type": "error", "content": error_msg}
                 return JSONResponse(content=response_data)
 
-            generated_sql = generate_sql_with_gemini(user_message, schema, history)
+            with budget.stage("generation"):
+                if COMBINED_GENERATION:
+                    # One structured call decides between SQL and a conversational reply.
+                    turn = await run_in_threadpool(generate_sql_or_reply_with_gemini, user_message, schema, history, budget)
+                else:
+                    generated_sql = await run_in_threadpool(generate_sql_with_gemini, user_message, schema, history, budget)
+                    turn = {"kind": "sql", "sql": generated_sql or ""}
+                    if generated_sql and generated_sql.strip().lower().startswith("error: this is a conversational query"):
+                        logger.info("AI determined this is a conversational query. Replying with a generic message.")
+                        turn = {"kind": "reply", "reply": await run_in_threadpool(get_conversational_response_with_gemini, user_message, history, budget)}
+            generated_sql = turn.get("sql")
             model_response_text = ""
 
-            if generated_sql and generated_sql.strip().lower().startswith("error: this is a conversational query"):
-                logger.info("AI determined this is a conversational query. Replying with a generic message.")
-                model_response_text = get_conversational_response_with_gemini(user_message, history)
+            if turn["kind"] == "reply":
+                model_response_text = turn["reply"]
                 response_data = {"type": "info", "content": model_response_text}
                 
                 # CORRECTED LOGIC: Add to history only on success
@@ -1078,6 +5398,19 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
                 return JSONResponse(content=response_data)
             
             query_to_run = generated_sql.strip()
+            # Validate references against the cached schema before any DB round trip.
+            query_to_run, repairs, problems = validate_generated_sql(query_to_run, schema)
+            if problems:
+                logger.info(f"Rejected generated SQL before execution: {problems}")
+                response_data = {
+                    "type": "error",
+                    "content": f"The generated query references objects that do not exist, so it was not run:\n```sql\n{query_to_run}\n```",
+                    "ai_explanation": "### Suggested Fix\n" + "\n".join(f"- {problem}" for problem in problems) + "\n\nTry rephrasing your question with the table or column names shown in the schema sidebar."
+                }
+                return JSONResponse(content=jsonable_encoder(response_data))
+            if repairs:
+                logger.info(f"Repaired generated SQL before execution: {repairs}")
+            generated = True
             # DO NOT add to history here yet. Wait for execution result.
 
         # Step 2: Centralized security check for the determined query
@@ -1106,7 +5439,7 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
         # Special handling for plain 'SHOW TABLES;' to add context
         if query_to_run.strip().lower() == 'show tables;':
             logger.info("Detected plain 'SHOW TABLES;' query. Checking database context...")
-            current_schema = schema or fetch_all_tables_and_columns()
+            current_schema = schema or await run_in_threadpool(fetch_all_tables_and_columns)
             user_databases = [
                 db for db, tables in current_schema.items()
                 if db != 'error' and db not in {'information_schema', 'mysql', 'performance_schema', 'sys'} and isinstance(tables, dict) and 'error' not in tables
@@ -1129,35 +5462,83 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
                 return JSONResponse(content=jsonable_encoder(response_data))
         
         # --- Direct execution for safe (risk_level == 0) queries ---
-        logger.info(f"Executing safe, final query: {query_to_run}")
-        results, columns, col_types, status, db_error = execute_sql_query(query_to_run)
+        # A saved query's materialized snapshot is served instead of re-running it.
+        saved = saved_queries.snapshot_for(query_to_run)
+        if saved is not None:
+            saved_id, snapshot = saved
+            logger.info(f"Serving saved query {saved_id} snapshot for: {query_to_run}")
+            results, columns, col_types, status, db_error = snapshot["results"], snapshot["columns"], snapshot["col_types"], 1, None
+        else:
+            logger.info(f"Executing safe, final query: {query_to_run}")
+            query_log.record("chat", query_to_run, user_message if not user_message.lower().startswith("/run ") else None)
+            # The query may use what is left of the budget, but always gets a minimum slot.
+            timeout_ms = int(max(budget.remaining(), LATENCY_MIN_EXECUTION_SECONDS) * 1000)
+            with budget.stage("execution"):
+                bound = (template_match["segments"], template_match["params"]) if template_match is not None else None
+                results, columns, col_types, status, db_error = await run_in_threadpool(execute_sql_query, query_to_run, raw=True, timeout_ms=timeout_ms, session_id=session_id,
+                                                                                        snapshot=True, bound=bound)
         
         if status == 3: # SQL Error
             if schema is None:
-                logger.info("Fetching schema for error context.")
-                schema = fetch_all_tables_and_columns()
+                logger.info("Using cached schema for error context.")
+                schema = await run_in_threadpool(cached_schema)
 
             # Determine original intent for better AI explanation
             original_intent = user_message if not user_message.lower().startswith("/run ") else None
             
             error_content = f"Query failed to execute:\n```sql\n{query_to_run}\n```\nError: {db_error or 'Unknown SQL execution error.'}"
-            ai_explanation = get_error_explanation_with_gemini(original_user_query=original_intent, failed_sql_query=query_to_run, error_message=str(db_error), schema=schema, history=history)
-            response_data = {"type": "error", "content": error_content, "ai_explanation": ai_explanation}
+            response_data = {"type": "error", "content": error_content}
+            if template_match is not None and question_templates.discard(template_match["id"]):
+                logger.info(f"Dropped question template '{template_match['key']}' after its query failed")
+            local_diagnosis = diagnose_sql_error(query_to_run, str(db_error), schema)
+            if local_diagnosis:
+                # The Gemini explanation stays available on demand via /explain_error.
+                response_data["ai_explanation"] = local_diagnosis
+                response_data["explain_error"] = {"query": query_to_run, "error": str(db_error), "user_query": original_intent}
+            elif budget.allows("error_explanation", LATENCY_MIN_EXPLANATION_SECONDS):
+                with budget.stage("error_explanation"):
+                    response_data["ai_explanation"] = await run_in_threadpool(get_error_explanation_with_gemini, original_user_query=original_intent, failed_sql_query=query_to_run, error_message=str(db_error), schema=schema, history=history, budget=budget)
+            if not response_data.get("ai_explanation"):
+                # Skipped or cut short by the budget: the user can still ask for it.
+                response_data.pop("ai_explanation", None)
+                response_data["explain_error"] = {"query": query_to_run, "error": str(db_error), "user_query": original_intent}
             # FAILED, so we don't add to history.
 
         elif status == 2: # DML/DDL Success (Should not be reached from this endpoint anymore)
             response_data = {"type": "info", "content": f"Query executed successfully:\n\n```sql\n{query_to_run}\n```"}
         elif status == 1: # SELECT/SHOW Success
             insights = ""
+            advice = None
             # CORRECTED LOGIC: Add user message and generated SQL to history now.
             add_to_history(session_data, "user", user_message)
             add_to_history(session_data, "model", query_to_run)
 
+            # Only the statement itself: the "execution" stage also covers profiling and the snapshot.
+            execution_ms = getattr(results, "elapsed_ms", None) or 0.0
+            if saved is None and QUERY_ADVISOR_THRESHOLD_MS > 0 and execution_ms >= QUERY_ADVISOR_THRESHOLD_MS \
+                    and budget.allows("query_advice", LATENCY_MIN_ADVICE_SECONDS):
+                with budget.stage("query_advice"):
+                    advice = await run_in_threadpool(advise_query, query_to_run, execution_ms, schema or schema_flight.peek("schema"), session_id,
+                                                     int(max(budget.remaining(), LATENCY_MIN_EXECUTION_SECONDS) * 1000))
+
             if results is not None and columns and col_types:
                 original_user_intent = user_message
                 if user_message.lower().startswith("/run "): original_user_intent = f"Direct execution: {user_message[5:].strip()}"
-                insights = get_insights_with_gemini(original_query=original_user_intent, sql_query=query_to_run, results=results, columns=columns, col_types=col_types, history=history)
+                if budget.allows("insights", LATENCY_MIN_INSIGHTS_SECONDS):
+                    with budget.stage("insights"):
+                        insights = await run_in_threadpool(get_insights_with_gemini, original_query=original_user_intent, sql_query=query_to_run, results=results, columns=columns, col_types=col_types, history=history, budget=budget)
             response_data = {"type": "result", "query": query_to_run, "columns": columns, "results": results, "insights": insights }
+            if saved is not None:
+                response_data["snapshot"] = saved_queries.summary(saved_id)
+            if template_match is not None:
+                response_data["template"] = {"id": template_match["id"], "key": template_match["key"]}
+            elif generated and QUESTION_TEMPLATES:
+                question_templates.schedule_learn(user_message, query_to_run, schema)
+            if advice:
+                response_data["advice"] = advice
+            if getattr(results, "snapshot", None) is not None and result_snapshots.add(session_id, results.snapshot):
+                # The full result can be re-sorted/filtered/grouped via /result_snapshots/{id}/query.
+                response_data["result_snapshot"] = results.snapshot.summary()
             
             # If insights were generated, add them as a separate model response for better context
             if insights:
@@ -1168,7 +5549,10 @@ async def handle_chat(chat_request: ChatRequest, session_id: uuid.UUID = Depends
         else: 
             response_data = {"type": "error", "content": "Unknown query execution status."}
 
-        return JSONResponse(content=jsonable_encoder(response_data))
+        if budget.skipped:
+            response_data["skipped"] = budget.skipped
+        response_data["latency"] = budget.describe()
+        return _json_response(response_data)
     
     except HTTPException as http_exc:
         logger.error(f"HTTP Exception: {http_exc.detail}")
@@ -1191,14 +5575,23 @@ async def handle_confirmed_sql(request: ConfirmedExecutionRequest, session_id: u
 
     try:
         logger.info(f"Executing user-confirmed query: {query_to_run}")
-        results, columns, col_types, status, db_error = execute_sql_query(query_to_run)
+        query_log.record("confirmed", query_to_run)
+        # No insights are generated here, so the result is not profiled.
+        results, columns, col_types, status, db_error = await run_in_threadpool(execute_sql_query, query_to_run, raw=True, profile=False,
+                                                                                session_id=session_id)
         
         if status == 3: # SQL Error
             error_content = f"Confirmed query failed to execute:\n```sql\n{query_to_run}\n```\nError: {db_error or 'Unknown SQL execution error.'}"
-            schema = fetch_all_tables_and_columns()
-            ai_explanation = get_error_explanation_with_gemini(original_user_query=f"User confirmed execution of the following SQL", failed_sql_query=query_to_run, error_message=str(db_error), schema=schema, history=history)
-            response_data = {"type": "error", "content": error_content, "ai_explanation": ai_explanation}
+            schema = await run_in_threadpool(cached_schema)
+            response_data = {"type": "error", "content": error_content}
+            local_diagnosis = diagnose_sql_error(query_to_run, str(db_error), schema)
+            if local_diagnosis:
+                response_data["ai_explanation"] = local_diagnosis
+                response_data["explain_error"] = {"query": query_to_run, "error": str(db_error), "user_query": "User confirmed execution of the following SQL"}
+            else:
+                response_data["ai_explanation"] = await run_in_threadpool(get_error_explanation_with_gemini, original_user_query=f"User confirmed execution of the following SQL", failed_sql_query=query_to_run, error_message=str(db_error), schema=schema, history=history)
         elif status == 2: # DML/DDL Success
+            datasource_router.note_write(session_id) # This session reads its own write from the primary for a while
             response_data = {"type": "info", "content": f"Query executed successfully:\n\n```sql\n{query_to_run}\n```"}
             # CORRECTED LOGIC: Add successful DML query to history
             add_to_history(session_data, "model", query_to_run) # The user prompt is already in history
@@ -1218,13 +5611,200 @@ async def handle_confirmed_sql(request: ConfirmedExecutionRequest, session_id: u
         else: 
             response_data = {"type": "error", "content": "Unknown query execution status."}
 
-        return JSONResponse(content=jsonable_encoder(response_data))
+        return _json_response(response_data)
 
     except Exception as e:
         logger.critical(f"Unhandled error in /execute_confirmed_sql endpoint: {e}", exc_info=True)
         response_data = {"type": "error", "content": f"An internal server error occurred: {e}"}
         return JSONResponse(content=response_data, status_code=500)
 
+@app.post("/explain_error", response_class=JSONResponse)
+async def explain_error(request: ExplainErrorRequest, session_data: SessionData = Depends(session_verifier)):
+    """On-demand Gemini explanation for a failed query that was already diagnosed locally."""
+    schema = await run_in_threadpool(cached_schema)
+    ai_explanation = await run_in_threadpool(get_error_explanation_with_gemini, original_user_query=request.user_query, failed_sql_query=request.query, error_message=request.error, schema=schema, history=list(session_data.history))
+    return JSONResponse(content={"ai_explanation": ai_explanation})
+
+@app.get("/saved_queries", response_class=JSONResponse)
+async def list_saved_queries():
+    """Saved queries with the age of their materialized snapshot."""
+    return JSONResponse(content={"saved_queries": [saved_queries.summary(saved_id) for saved_id in saved_queries.definitions]})
+
+@app.post("/saved_queries", response_class=JSONResponse)
+async def save_query(request: SaveQueryRequest):
+    """Pins a read-only query; its result is materialized now and refreshed every interval."""
+    query_to_save = request.query.strip()
+    if not query_to_save:
+        return JSONResponse(content={"type": "error", "content": "No query provided to save."}, status_code=400)
+    if get_query_risk_level(query_to_save) != 0:
+        return JSONResponse(content={"type": "error", "content": "Only read-only queries can be saved."}, status_code=403)
+    interval_seconds = parse_interval(request.interval)
+    if interval_seconds is None:
+        return JSONResponse(content={"type": "error", "content": f"Invalid refresh interval '{request.interval}'. Use e.g. 15m, 1h or 1d (at least {SAVED_QUERY_MIN_INTERVAL_SECONDS}s)."}, status_code=400)
+    definition = saved_queries.add(query_to_save, request.name, interval_seconds)
+    return JSONResponse(content=saved_queries.summary(definition["id"]))
+
+@app.get("/saved_queries/{saved_id}", response_class=JSONResponse)
+async def get_saved_query(saved_id: str):
+    """A saved query's materialized snapshot (up to RESULT_DISPLAY_LIMIT rows)."""
+    if saved_id not in saved_queries.definitions:
+        return JSONResponse(content={"type": "error", "content": "Saved query not found."}, status_code=404)
+    snapshot = saved_queries.snapshots.get(saved_id)
+    response_data = {"type": "result", **saved_queries.summary(saved_id)}
+    if snapshot is not None:
+        response_data.update(columns=snapshot["columns"], results=snapshot["results"])
+    return _json_response(response_data)
+
+@app.post("/saved_queries/{saved_id}/refresh", response_class=JSONResponse)
+async def refresh_saved_query(saved_id: str):
+    """Schedules an immediate refresh of a saved query."""
+    if not saved_queries.request_refresh(saved_id):
+        return JSONResponse(content={"type": "error", "content": "Saved query not found."}, status_code=404)
+    return JSONResponse(content=saved_queries.summary(saved_id))
+
+@app.delete("/saved_queries/{saved_id}", response_class=JSONResponse)
+async def delete_saved_query(saved_id: str):
+    if not saved_queries.remove(saved_id):
+        return JSONResponse(content={"type": "error", "content": "Saved query not found."}, status_code=404)
+    return JSONResponse(content={"type": "info", "content": "Saved query removed."})
+
+@app.get("/question_templates", response_class=JSONResponse)
+async def list_question_templates():
+    """Learned question templates, most recently used first; unconfirmed ones do not answer questions yet."""
+    return JSONResponse(content={"question_templates": question_templates.summaries()})
+
+@app.delete("/question_templates/{template_id}", response_class=JSONResponse)
+async def delete_question_template(template_id: str):
+    if not question_templates.discard(template_id):
+        return JSONResponse(content={"type": "error", "content": "Question template not found."}, status_code=404)
+    return JSONResponse(content={"type": "info", "content": "Question template removed."})
+
+@app.get("/result_snapshots", response_class=JSONResponse)
+async def list_result_snapshots(session_id: uuid.UUID = Depends(cookie), session_data: SessionData = Depends(session_verifier)):
+    """This session's recent query results that can be re-sorted, filtered or grouped locally."""
+    return JSONResponse(content={"result_snapshots": [snapshot.summary() for snapshot in result_snapshots.for_session(session_id)]})
+
+@app.post("/result_snapshots/{snapshot_id}/query")
+async def query_result_snapshot(snapshot_id: str, request: SnapshotQueryRequest, session_id: uuid.UUID = Depends(cookie), session_data: SessionData = Depends(session_verifier)):
+    """
+    Filters, groups/aggregates and sorts a result snapshot in memory, without touching
+    MySQL or Gemini. Filters apply to the snapshot's rows; sort may name group-by columns
+    and aggregates (e.g. "sum(amount)").
+    """
+    snapshot = result_snapshots.get(session_id, snapshot_id)
+    if snapshot is None:
+        return JSONResponse(content={"type": "error", "content": "Result snapshot not found; it may have been evicted. Run the query again."}, status_code=404)
+    started = time.perf_counter()
+    try:
+        columns, rows, total = await run_in_threadpool(snapshot.run, [f.model_dump() for f in request.filters], request.group_by,
+                                                       [a.model_dump() for a in request.aggregates], [o.model_dump() for o in request.sort],
+                                                       max(0, min(request.limit, RESULT_SNAPSHOT_MAX_ROWS)))
+    except ValueError as e:
+        return JSONResponse(content={"type": "error", "content": str(e)}, status_code=400)
+    return _json_response({"type": "result", "query": snapshot.query, "columns": columns, "results": rows, "row_count": total,
+                           "result_snapshot": snapshot.summary(), "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)})
+
+@app.post("/chart_data", response_class=JSONResponse)
+async def chart_data(request: ChartDataRequest, session_id: uuid.UUID = Depends(cookie), session_data: SessionData = Depends(session_verifier)):
+    """
+    Chart-ready points for one or two columns of a result snapshot or a read-only query:
+    LTTB-downsampled for time series, binned aggregates for numeric x, grouped for text x.
+    At most CHART_MAX_POINTS points are returned whatever the row count.
+    """
+    points = max(3, min(request.points, CHART_MAX_POINTS))
+    started = time.perf_counter()
+    try:
+        if request.snapshot_id:
+            snapshot = result_snapshots.get(session_id, request.snapshot_id)
+            if snapshot is None:
+                return JSONResponse(content={"type": "error", "content": "Result snapshot not found; it may have been evicted. Run the query again."}, status_code=404)
+            for name in filter(None, (request.x, request.y)):
+                if name not in snapshot.by_name:
+                    raise ValueError(f"Unknown column '{name}'. Available: {', '.join(snapshot.by_name)}")
+            x_axis = _ChartAxis.from_snapshot(snapshot.by_name[request.x])
+            y_axis = _ChartAxis.from_snapshot(snapshot.by_name[request.y]) if request.y else None
+            chart = await run_in_threadpool(chart_points, x_axis, y_axis, request.mode, request.agg, points)
+            chart["truncated"] = snapshot.truncated
+        else:
+            query_to_chart = (request.query or "").strip()
+            if not query_to_chart:
+                return JSONResponse(content={"type": "error", "content": "Provide a snapshot_id or a query to chart."}, status_code=400)
+            if get_query_risk_level(query_to_chart) != 0:
+                return JSONResponse(content={"type": "error", "content": "Only read-only queries can be charted."}, status_code=403)
+            chart = await run_in_threadpool(chart_from_query, query_to_chart, request.x, request.y, request.mode, request.agg, points)
+    except ValueError as e:
+        return JSONResponse(content={"type": "error", "content": str(e)}, status_code=400)
+    except mysql.connector.Error as e:
+        logger.error(f"SQL Error charting '{request.query}': {e}")
+        return JSONResponse(content={"type": "error", "content": f"SQL Error: {e}"}, status_code=400)
+    chart.update(type="chart", elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+    return JSONResponse(content=chart)
+
+@app.post("/batch")
+async def run_batch(request: BatchQueryRequest):
+    """
+    Runs up to BATCH_MAX_QUERIES read-only queries concurrently and streams the results
+    as NDJSON, one line per query in completion order ("index" maps it back to the
+    request), then a summary line. A result line carries at most RESULT_DISPLAY_LIMIT
+    rows; "row_count" counts the full result and "truncated" says whether rows were cut.
+    """
+    queries = [query.strip() for query in request.queries]
+    if not queries or not all(queries):
+        return JSONResponse(content={"type": "error", "content": "Provide a non-empty list of non-empty queries."}, status_code=400)
+    if len(queries) > BATCH_MAX_QUERIES:
+        return JSONResponse(content={"type": "error", "content": f"A batch can contain at most {BATCH_MAX_QUERIES} queries."}, status_code=400)
+    concurrency = max(1, min(request.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY, len(queries)))
+    timeout_seconds = max(0.1, min(request.timeout_seconds or BATCH_DEFAULT_TIMEOUT_SECONDS, BATCH_MAX_TIMEOUT_SECONDS))
+    logger.info(f"Running batch of {len(queries)} queries (concurrency {concurrency}, timeout {timeout_seconds:g}s)")
+    return StreamingResponse(run_query_batch(queries, concurrency, timeout_seconds), media_type="application/x-ndjson")
+
+@app.get("/export")
+async def export_query(query: str, format: str = "csv", use_gzip: bool = Query(False, alias="gzip")):
+    """
+    Streams the full result of a read-only query as CSV, NDJSON or Parquet.
+    Unlike /chat, results are not truncated; rows are streamed with constant memory.
+    """
+    query_to_run = query.strip()
+    export_format = format.lower()
+    if not query_to_run:
+        return JSONResponse(content={"type": "error", "content": "No query provided for export."}, status_code=400)
+    if export_format not in EXPORT_FORMATS:
+        return JSONResponse(content={"type": "error", "content": f"Unsupported export format '{format}'. Use one of: {', '.join(EXPORT_FORMATS)}."}, status_code=400)
+    if export_format == "parquet":
+        try:
+            import pyarrow # noqa: F401
+        except ImportError:
+            return JSONResponse(content={"type": "error", "content": "Parquet export requires the 'pyarrow' package to be installed."}, status_code=400)
+
+    # Re-check the risk level: only read-only queries can be exported.
+    if get_query_risk_level(query_to_run) != 0:
+        logger.warning(f"Blocking export of non read-only query: {query_to_run}")
+        return JSONResponse(content={"type": "error", "content": "Only read-only queries can be exported."}, status_code=403)
+
+    query_log.record("export", query_to_run)
+    try:
+        conn, cursor = await run_in_threadpool(open_export_cursor, query_to_run)
+    except mysql.connector.Error as e:
+        logger.error(f"SQL Error starting export for '{query_to_run}': {e}")
+        return JSONResponse(content={"type": "error", "content": f"SQL Error: {e}"}, status_code=400)
+
+    if not cursor.description:
+        _close_export_cursor(conn, cursor)
+        return JSONResponse(content={"type": "error", "content": "The query did not return a result set to export."}, status_code=400)
+
+    media_type, extension = EXPORT_FORMATS[export_format]
+    filename = f"export.{extension}"
+    if use_gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+    logger.info(f"Streaming {export_format} export{' (gzip)' if use_gzip else ''} for query: {query_to_run}")
+    # A sync iterator is consumed in the threadpool, one chunk per send, so a slow client
+    # applies backpressure all the way to the MySQL socket without blocking the event loop.
+    return StreamingResponse(
+        stream_export(conn, cursor, export_format, use_gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # --- Main Execution ---
 if __name__ == "__main__":
     import uvicorn
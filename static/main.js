@@ -148,7 +148,7 @@ function addMessageToChat(sender, messageHtml, messageType = 'info') {
     }
 }
 
-function createTableHtml(columns, results) {
+function createTableHtml(columns, results, query = null, snapshot = null, sortState = null) {
     if (!results || results.length === 0) {
         return '<p class="text-sm text-gray-600 italic">Query returned no results.</p>';
     }
@@ -156,9 +156,15 @@ function createTableHtml(columns, results) {
          return '<p class="text-sm text-red-600">Error: Missing column names for results.</p>';
     }
 
-    let tableHtml = '<div class="results-table"><table><thead><tr>';
+    // With a result snapshot, clicking a header re-sorts the full result on the server (no new query).
+    let tableHtml = snapshot ? `<div class="results-table" data-snapshot-id="${escapeHtml(snapshot.id)}"><table><thead><tr>` : '<div class="results-table"><table><thead><tr>';
     columns.forEach(col => {
-        tableHtml += `<th>${escapeHtml(col)}</th>`;
+        if (snapshot) {
+            const arrow = sortState && sortState.column === col ? (sortState.descending ? ' ▼' : ' ▲') : '';
+            tableHtml += `<th class="snapshot-sort cursor-pointer" data-column="${escapeHtml(col)}" title="Sort all ${snapshot.row_count} rows">${escapeHtml(col)}${arrow}</th>`;
+        } else {
+            tableHtml += `<th>${escapeHtml(col)}</th>`;
+        }
     });
     tableHtml += '</tr></thead><tbody>';
 
@@ -189,6 +195,11 @@ function createTableHtml(columns, results) {
     tableHtml += '</tbody></table></div>';
     if (results.length === 100) {
         tableHtml += '<p class="text-xs text-gray-500 italic mt-1">Displaying up to 100 rows. The actual result set may be larger.</p>';
+        if (query) {
+            // Full-result downloads are streamed by the /export endpoint
+            const exportUrl = (format) => `/export?format=${format}&query=${encodeURIComponent(query)}`;
+            tableHtml += `<p class="text-xs text-gray-500 mt-1">Download full result: <a class="underline" href="${exportUrl('csv')}" download>CSV</a> · <a class="underline" href="${exportUrl('ndjson')}" download>NDJSON</a> · <a class="underline" href="${exportUrl('parquet')}" download>Parquet</a></p>`;
+        }
     }
     return tableHtml;
 }
@@ -300,7 +311,8 @@ async function fetchSchema(showLoading = true) {
     };
 
      try {
-         const response = await fetch('/schema');
+         // The sidebar loads lazily: only the database list here, tables when a database is expanded.
+         const response = await fetch('/schema/databases');
          if (!response.ok) {
             let errorMsg = `HTTP error! status: ${response.status}`;
             try { // Try to get more specific error from backend
@@ -310,62 +322,23 @@ async function fetchSchema(showLoading = true) {
             } catch(e) { /* ignore if body isn't json */ }
             throw new Error(errorMsg);
          }
-         const data = await response.json();
-         const schema = data.schema; // Expected format: { dbName: { tableName: [columns] } } or { error: { schema: ["message"] } }
+         const data = await response.json(); // Expected format: { databases: [{ name, table_count }] } or { error: { schema: ["message"] } }
 
          let finalSchemaHtml = ''; // Variable to store the fully constructed HTML
 
          // Check for the top-level error structure first
-         if (schema && typeof schema === 'object' && schema.error && schema.error.schema && Array.isArray(schema.error.schema)) {
-            finalSchemaHtml = `<div class="p-4"><p class="text-red-600">Error fetching schema: ${escapeHtml(schema.error.schema.join(', '))}</p></div>`;
-         } else if (schema && typeof schema === 'object' && Object.keys(schema).length > 0) {
+         if (data && data.error && data.error.schema && Array.isArray(data.error.schema)) {
+            finalSchemaHtml = `<div class="p-4"><p class="text-red-600">Error fetching schema: ${escapeHtml(data.error.schema.join(', '))}</p></div>`;
+         } else if (data && Array.isArray(data.databases) && data.databases.length > 0) {
              let builtSchemaContent = ''; // Temporary string to build schema details
-             // Iterate through Databases
-             for (const dbName in schema) {
-                 if (schema.hasOwnProperty(dbName)) {
-                     // ADDED: group class, toggle-icon, and made it initially not expanded
-                     builtSchemaContent += `<div class="schema-item schema-database-item group"><i data-lucide="database"></i>${escapeHtml(dbName)}<i data-lucide="chevron-down" class="toggle-icon h-4 w-4 text-gray-400 group-hover:text-gray-600"></i></div>`;
-                     // ADDED: Wrapper for all tables and columns under this DB, hidden by default
-                     builtSchemaContent += '<div class="database-content-wrapper">';
-                      const tables = schema[dbName]; // This could be { tableName: [cols] } or { error: ["msg"] }
-
-                      // Check if the value for the dbName is an error object
-                      if (typeof tables === 'object' && tables !== null && tables.error && Array.isArray(tables.error)) {
-                          builtSchemaContent += `<div class="schema-item schema-table-item italic text-red-500"><i data-lucide="alert-triangle"></i>Error: ${escapeHtml(tables.error.join(', '))}</div>`;
-                      }
-                      // Check if it's a valid tables object (and not the error object)
-                      else if (typeof tables === 'object' && tables !== null && !tables.error) {
-                          if (Object.keys(tables).length > 0) {
-                              // Iterate through Tables within the Database
-                              for (const tableName in tables) {
-                                  if (tables.hasOwnProperty(tableName) && Array.isArray(tables[tableName])) {
-                                      // ADDED: group class for hover states on icon, and toggle-icon span
-                                      builtSchemaContent += `<div class="schema-item schema-table-item group"><i data-lucide="table-2"></i><strong>${escapeHtml(tableName)}</strong><i data-lucide="chevron-down" class="toggle-icon h-4 w-4 text-gray-400 group-hover:text-gray-600"></i></div>`;
-                                       if (tables[tableName].length > 0) {
-                                           // ADDED: hidden class to collapse columns by default
-                                           builtSchemaContent += '<div class="schema-columns-list">';
-                                            tables[tableName].forEach(column => {
-                                                builtSchemaContent += `<div class="schema-column">${escapeHtml(column)}</div>`;
-                                            });
-                                           builtSchemaContent += '</div>';
-                                       } else {
-                                           builtSchemaContent += '<div class="schema-columns-list italic">No columns found.</div>';
-                                       }
-                                  }
-                              }
-                          } else {
-                              builtSchemaContent += '<div class="schema-item schema-table-item italic"><i data-lucide="info"></i>No tables found.</div>';
-                          }
-                      } else {
-                          // Handle unexpected format for the database entry
-                          builtSchemaContent += '<div class="schema-item schema-table-item italic"><i data-lucide="info"></i>No table data.</div>';
-                      }
-                  builtSchemaContent += '</div>'; // Close database-content-wrapper
-                  }
-              }
-              finalSchemaHtml = builtSchemaContent || '<div class="p-4 text-gray-500"><i data-lucide="search-x" class="inline-block mr-2"></i>No databases or tables found.</div>';
+             data.databases.forEach(db => {
+                 builtSchemaContent += `<div class="schema-item schema-database-item group" data-db-name="${escapeHtml(db.name)}"><i data-lucide="database"></i>${escapeHtml(db.name)}<span class="ml-1 text-xs text-gray-400">(${Number(db.table_count) || 0})</span><i data-lucide="chevron-down" class="toggle-icon h-4 w-4 text-gray-400 group-hover:text-gray-600"></i></div>`;
+                 // Tables are filled in by loadSchemaTablesPage() on first expand
+                 builtSchemaContent += `<div class="database-content-wrapper" data-db-name="${escapeHtml(db.name)}" data-loaded="false"></div>`;
+             });
+             finalSchemaHtml = builtSchemaContent;
           } else {
-              // This case handles empty schema object {} or other non-error, non-object types
+              // This case handles an empty database list or other unexpected payloads
               finalSchemaHtml = '<div class="p-4 text-gray-500"><i data-lucide="database-zap" class="inline-block mr-2"></i>No schema found or unable to fetch.</div>';
           }
           updateContentWithDelay(finalSchemaHtml); // Use the helper to update content
@@ -377,6 +350,57 @@ async function fetchSchema(showLoading = true) {
       }
 }
 
+// Renders table and column items for one database: { tableName: [columns] }
+function renderSchemaTablesHtml(tables) {
+    let html = '';
+    for (const tableName in tables) {
+        if (tables.hasOwnProperty(tableName) && Array.isArray(tables[tableName])) {
+            html += `<div class="schema-item schema-table-item group"><i data-lucide="table-2"></i><strong>${escapeHtml(tableName)}</strong><i data-lucide="chevron-down" class="toggle-icon h-4 w-4 text-gray-400 group-hover:text-gray-600"></i></div>`;
+            if (tables[tableName].length > 0) {
+                html += '<div class="schema-columns-list">';
+                tables[tableName].forEach(column => {
+                    html += `<div class="schema-column">${escapeHtml(column)}</div>`;
+                });
+                html += '</div>';
+            } else {
+                html += '<div class="schema-columns-list italic">No columns found.</div>';
+            }
+        }
+    }
+    return html;
+}
+
+// Fetches one page of tables for a database wrapper and appends it, with a "Load more" item if there are more pages.
+async function loadSchemaTablesPage(wrapper, cursor = '') {
+    const dbName = wrapper.dataset.dbName;
+    let html = '';
+    wrapper.dataset.loaded = 'loading'; // Guards against a second fetch from a double click
+    try {
+        const response = await fetch(`/schema/${encodeURIComponent(dbName)}/tables?cursor=${encodeURIComponent(cursor)}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const data = await response.json(); // { database, tables: { tableName: [columns] }, next_cursor } or { error: { schema: ["message"] } }
+        if (data.error && data.error.schema && Array.isArray(data.error.schema)) {
+            html = `<div class="schema-item schema-table-item italic text-red-500"><i data-lucide="alert-triangle"></i>Error: ${escapeHtml(data.error.schema.join(', '))}</div>`;
+        } else {
+            html = renderSchemaTablesHtml(data.tables || {});
+            if (data.next_cursor) {
+                html += `<div class="schema-item schema-load-more italic" data-cursor="${escapeHtml(data.next_cursor)}"><i data-lucide="more-horizontal"></i>Load more tables…</div>`;
+            } else if (!html && !cursor) {
+                html = '<div class="schema-item schema-table-item italic"><i data-lucide="info"></i>No tables found.</div>';
+            }
+        }
+    } catch (error) {
+        console.error(`Error fetching tables for ${dbName}:`, error);
+        html = `<div class="schema-item schema-table-item italic text-red-500"><i data-lucide="alert-triangle"></i>Failed to load tables. ${escapeHtml(error.message)}</div>`;
+    }
+    wrapper.dataset.loaded = 'true';
+    wrapper.insertAdjacentHTML('beforeend', html);
+    wrapper.querySelectorAll('.schema-item').forEach(item => item.classList.add('visible-item'));
+    lucide.createIcons();
+}
+
 async function sendMessage(message) {
     addMessageToChat('user', `<p>${escapeHtml(message)}</p>`); // Display user message immediately
     messageInput.value = ''; // Clear input
@@ -406,11 +430,16 @@ async function sendMessage(message) {
 
         if (data.type === 'result') {
             assistantMessageHtml += `<p class="font-semibold">Generated SQL:</p><pre><code class="language-sql">${escapeHtml(data.query || '')}</code></pre>`;
-            assistantMessageHtml += createTableHtml(data.columns, data.results);
+            assistantMessageHtml += createTableHtml(data.columns, data.results, data.query, data.result_snapshot);
+            assistantMessageHtml += chartButtonHtml(data.columns, data.results, data.result_snapshot);
+            assistantMessageHtml += savedQueryHtml(data.query, data.snapshot);
+            assistantMessageHtml += questionTemplateHtml(data.template);
             if (data.insights) {
                 // Render insights as Markdown
                 assistantMessageHtml += renderMarkdown(data.insights);
             }
+            assistantMessageHtml += queryAdviceHtml(data.advice);
+            assistantMessageHtml += skippedStagesHtml(data.skipped);
         } else if (data.type === 'info') {
              // Render info potentially containing markdown (like code blocks)
              assistantMessageHtml += renderMarkdown(data.content);
@@ -420,6 +449,8 @@ async function sendMessage(message) {
              if (data.ai_explanation) {
                 assistantMessageHtml += renderMarkdown(data.ai_explanation); // Render AI explanation as Markdown
              }
+             assistantMessageHtml += explainErrorButtonHtml(data.explain_error);
+             assistantMessageHtml += skippedStagesHtml(data.skipped);
         } else if (data.type === 'confirm_execution') {
             // This case is now handled by addConfirmationMessageToChat
             // It will set loading state to false to re-enable input while confirm buttons are visible.
@@ -439,6 +470,202 @@ async function sendMessage(message) {
     }
 }
 
+// --- Re-sorting a result from its server-side snapshot ---
+chatHistory.addEventListener('click', async function(event) {
+    const header = event.target.closest('th.snapshot-sort');
+    if (!header) return;
+    const table = header.closest('.results-table');
+    if (table.dataset.loading) return;
+    const column = header.dataset.column;
+    const descending = table.dataset.sortColumn === column && table.dataset.sortDescending !== 'true';
+    table.dataset.loading = 'true';
+    try {
+        const response = await fetch(`/result_snapshots/${encodeURIComponent(table.dataset.snapshotId)}/query`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ sort: [{ column, descending }] })
+        });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.content || `HTTP error! status: ${response.status}`);
+        const wrapper = document.createElement('div');
+        wrapper.innerHTML = createTableHtml(data.columns, data.results, null, data.result_snapshot, { column, descending });
+        const sorted = wrapper.querySelector('.results-table');
+        sorted.dataset.sortColumn = column;
+        sorted.dataset.sortDescending = String(descending);
+        table.replaceWith(sorted);
+    } catch (error) {
+        console.error('Error sorting result snapshot:', error);
+        showToast(`Could not sort: ${error.message}`, 'error');
+        delete table.dataset.loading;
+    }
+});
+
+// --- Charts: the server reduces the full result to a bounded number of points (/chart_data) ---
+function chartButtonHtml(columns, results, snapshot) {
+    if (!snapshot || !columns || columns.length < 2 || !results || !results.length) return '';
+    // Chart the first column against the first numeric column after it.
+    const y = columns.slice(1).find((_, i) => results.some(row => typeof row[i + 1] === 'number'));
+    if (!y) return '';
+    return `<button class="chart-btn mt-2 text-sm font-semibold text-indigo-600 hover:underline flex items-center"
+                data-snapshot-id="${escapeHtml(snapshot.id)}" data-x="${escapeHtml(columns[0])}" data-y="${escapeHtml(y)}">
+                <i data-lucide="line-chart" class="h-4 w-4 mr-1"></i>Chart ${escapeHtml(y)} by ${escapeHtml(columns[0])}</button>`;
+}
+
+function chartSvg(chart) {
+    const width = 560, height = 200, pad = 6;
+    const points = chart.points.filter(point => point[1] !== null);
+    if (!points.length) return '<p class="text-sm text-gray-600 italic">Nothing to chart.</p>';
+    const ys = points.map(point => point[1]);
+    const yMin = Math.min(0, ...ys), yMax = Math.max(...ys), ySpan = (yMax - yMin) || 1;
+    const sy = value => height - pad - (value - yMin) / ySpan * (height - 2 * pad);
+    let shapes;
+    if (chart.x_kind === 'category') {
+        const barWidth = (width - 2 * pad) / points.length;
+        shapes = points.map((point, i) => `<rect x="${pad + i * barWidth + 1}" y="${sy(point[1])}" width="${Math.max(1, barWidth - 2)}" height="${sy(yMin) - sy(point[1])}" fill="currentColor"><title>${escapeHtml(String(point[0]))}: ${point[1]}</title></rect>`).join('');
+    } else {
+        const xs = points.map(point => point[0]);
+        const xMin = Math.min(...xs), xSpan = (Math.max(...xs) - xMin) || 1;
+        const sx = value => pad + (value - xMin) / xSpan * (width - 2 * pad);
+        shapes = `<polyline fill="none" stroke="currentColor" stroke-width="1.5" points="${points.map(point => `${sx(point[0]).toFixed(1)},${sy(point[1]).toFixed(1)}`).join(' ')}"/>`;
+    }
+    const label = chart.mode === 'lttb' ? `${points.length} of ${chart.row_count} points (LTTB)` : `${chart.agg} of ${chart.y || 'rows'} over ${chart.row_count} rows (${chart.mode})`;
+    return `<svg class="text-indigo-600 mt-2" viewBox="0 0 ${width} ${height}" width="100%" preserveAspectRatio="none">${shapes}</svg>
+            <p class="text-xs text-gray-500 italic">${escapeHtml(label)}</p>`;
+}
+
+chatHistory.addEventListener('click', async function(event) {
+    const button = event.target.closest('.chart-btn');
+    if (!button || button.disabled) return;
+    button.disabled = true;
+    try {
+        const response = await fetch('/chart_data', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ snapshot_id: button.dataset.snapshotId, x: button.dataset.x, y: button.dataset.y })
+        });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.content || `HTTP error! status: ${response.status}`);
+        const chartDiv = document.createElement('div');
+        chartDiv.innerHTML = chartSvg(data);
+        button.replaceWith(chartDiv);
+    } catch (error) {
+        console.error('Error fetching chart data:', error);
+        showToast(`Could not chart: ${error.message}`, 'error');
+        button.disabled = false;
+    }
+});
+
+// --- Index advice for slow queries (suggestions go through the normal confirmation flow) ---
+function queryAdviceHtml(advice) {
+    if (!advice || (!advice.findings.length && !advice.suggestions.length)) return '';
+    let html = `<p class="font-semibold mt-3">Why this query took ${Math.round(advice.elapsed_ms)} ms</p><ul class="text-sm">`;
+    advice.findings.forEach(finding => { html += `<li>${escapeHtml(finding.detail)}</li>`; });
+    html += '</ul>';
+    advice.suggestions.forEach(suggestion => {
+        html += `<p class="text-sm mt-2">${escapeHtml(suggestion.reason)}</p><pre><code class="language-sql">${escapeHtml(suggestion.sql)}</code></pre>
+                 <button class="apply-index-btn text-sm font-semibold text-indigo-600 hover:underline flex items-center" data-query="${escapeHtml(suggestion.sql)}">
+                 <i data-lucide="zap" class="h-4 w-4 mr-1"></i>Review and create this index</button>`;
+    });
+    if (advice.analyze) {
+        html += `<details class="text-xs mt-2"><summary>EXPLAIN ANALYZE</summary><pre>${escapeHtml(advice.analyze)}</pre></details>`;
+    }
+    return html;
+}
+
+chatHistory.addEventListener('click', function(event) {
+    const button = event.target.closest('.apply-index-btn');
+    if (!button) return;
+    addConfirmationMessageToChat('Creating an index changes the table and can take a while on large tables. Please review and confirm:', button.dataset.query);
+});
+
+// --- Stages dropped by the per-turn latency budget ---
+const SKIPPED_STAGE_LABELS = { insights: 'AI insights', error_explanation: 'the AI error explanation', query_advice: 'the index advisor' };
+
+function skippedStagesHtml(skipped) {
+    if (!skipped || !skipped.length) return '';
+    const labels = skipped.map(entry => SKIPPED_STAGE_LABELS[entry.stage] || entry.stage);
+    return `<p class="text-xs text-gray-500 italic mt-1">Skipped ${escapeHtml(labels.join(', '))} to keep the response fast.</p>`;
+}
+
+// --- Questions answered from a learned template ---
+function questionTemplateHtml(template) {
+    if (!template) return '';
+    return `<p class="text-xs text-gray-500 italic mt-1">Answered without AI from the learned question pattern "${escapeHtml(template.key)}".</p>`;
+}
+
+// --- Optional AI explanation for locally diagnosed SQL errors ---
+function explainErrorButtonHtml(explainError) {
+    if (!explainError) return '';
+    return `<button class="explain-error-btn mt-2 text-sm font-semibold text-indigo-600 hover:underline flex items-center"
+                data-query="${escapeHtml(explainError.query)}" data-error="${escapeHtml(explainError.error)}"
+                data-user-query="${escapeHtml(explainError.user_query || '')}">
+                <i data-lucide="sparkles" class="h-4 w-4 mr-1"></i>Ask AI for a detailed explanation</button>`;
+}
+
+chatHistory.addEventListener('click', async function(event) {
+    const button = event.target.closest('.explain-error-btn');
+    if (!button || button.disabled) return;
+    button.disabled = true;
+    button.innerHTML = `${createSpinnerSvg('h-4 w-4 mr-1')}Asking AI...`;
+    try {
+        const response = await fetch('/explain_error', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                query: button.dataset.query,
+                error: button.dataset.error,
+                user_query: button.dataset.userQuery || null
+            })
+        });
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        const data = await response.json();
+        const explanationDiv = document.createElement('div');
+        explanationDiv.innerHTML = renderMarkdown(data.ai_explanation || 'No explanation was returned.');
+        button.replaceWith(explanationDiv);
+    } catch (error) {
+        console.error('Error fetching AI explanation:', error);
+        button.disabled = false;
+        button.textContent = 'AI explanation failed. Try again';
+    }
+});
+
+// --- Saved queries: pin a result so it is materialized and refreshed in the background ---
+function formatAge(seconds) {
+    if (seconds < 60) return 'just now';
+    if (seconds < 3600) return `${Math.round(seconds / 60)} min ago`;
+    if (seconds < 86400) return `${Math.round(seconds / 3600)} h ago`;
+    return `${Math.round(seconds / 86400)} d ago`;
+}
+
+function savedQueryHtml(query, snapshot) {
+    if (snapshot) {
+        return `<p class="text-xs text-gray-500 italic mt-1">Served from saved query "${escapeHtml(snapshot.name)}", refreshed ${formatAge(snapshot.age_seconds || 0)}.</p>`;
+    }
+    if (!query) return '';
+    return `<button class="save-query-btn mt-2 text-sm font-semibold text-indigo-600 hover:underline flex items-center" data-query="${escapeHtml(query)}">
+                <i data-lucide="pin" class="h-4 w-4 mr-1"></i>Save query (refresh hourly)</button>`;
+}
+
+chatHistory.addEventListener('click', async function(event) {
+    const button = event.target.closest('.save-query-btn');
+    if (!button || button.disabled) return;
+    button.disabled = true;
+    try {
+        const response = await fetch('/saved_queries', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ query: button.dataset.query })
+        });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.content || `HTTP error! status: ${response.status}`);
+        button.outerHTML = `<p class="text-xs text-gray-500 italic mt-1">Saved as "${escapeHtml(data.name)}". The result is refreshed every ${Math.round(data.interval_seconds / 60)} min and served to everyone asking the same query.</p>`;
+    } catch (error) {
+        console.error('Error saving query:', error);
+        showToast(`Could not save query: ${error.message}`, 'error');
+        button.disabled = false;
+    }
+});
+
 // --- ADDED: Functions for handling query confirmation ---
 function addConfirmationMessageToChat(messageText, queryToConfirm) {
     const messageDiv = document.createElement('div');
@@ -540,9 +767,10 @@ async function executeConfirmedQuery(query) {
             if (data.ai_explanation) {
                 resultMessageHtml += renderMarkdown(data.ai_explanation); // Render AI explanation as Markdown
             }
+            resultMessageHtml += explainErrorButtonHtml(data.explain_error);
         } else if (data.type === 'result') { // Should be rare for this flow but handle
             resultMessageHtml += `<p class="font-semibold">Query Executed:</p><pre><code class="language-sql">${escapeHtml(data.query || '')}</code></pre>`;
-            resultMessageHtml += createTableHtml(data.columns, data.results);
+            resultMessageHtml += createTableHtml(data.columns, data.results, data.query);
             if (data.insights) {
                 resultMessageHtml += renderMarkdown(data.insights);
             }
@@ -978,13 +1206,24 @@ document.addEventListener('click', function(event) {
 });
 
 // --- ADDED: Event listener for schema table toggling ---
-schemaContent.addEventListener('click', function(event) {
+schemaContent.addEventListener('click', async function(event) {
     const dbItem = event.target.closest('.schema-database-item');
-
-    if (dbItem) {
+    const loadMoreItem = event.target.closest('.schema-load-more');
+
+    if (loadMoreItem) {
+        const wrapper = loadMoreItem.closest('.database-content-wrapper');
+        const cursor = loadMoreItem.dataset.cursor;
+        loadMoreItem.remove();
+        await loadSchemaTablesPage(wrapper, cursor);
+        wrapper.style.maxHeight = wrapper.scrollHeight + 'px';
+    } else if (dbItem) {
         dbItem.classList.toggle('expanded');
         const dbContentWrapper = dbItem.nextElementSibling;
         if (dbContentWrapper && dbContentWrapper.classList.contains('database-content-wrapper')) {
+            if (dbContentWrapper.dataset.loaded === 'false') {
+                // First expand: fetch the first page of tables before measuring the height
+                await loadSchemaTablesPage(dbContentWrapper);
+            }
             if (dbContentWrapper.style.maxHeight && dbContentWrapper.style.maxHeight !== '0px') {
                 // Collapse the database content
                 dbContentWrapper.style.maxHeight = '0px';
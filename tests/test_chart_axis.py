@@ -0,0 +1,32 @@
+import numpy as np
+from mysql.connector import FieldType
+
+import sql_assistant
+
+
+def raw_axis(field_type, rows):
+    axis = sql_assistant._ChartAxis.for_field("c", field_type, 0)
+    axis.add_raw(rows, 0, field_type, 0)
+    return axis
+
+
+def test_time_column_with_null():
+    axis = raw_axis(FieldType.TIME, [(b"01:00:00",), (None,), (b"-00:00:30.5",)])
+    assert axis.kind == "number"
+    np.testing.assert_array_equal(axis.values(), [3600.0, np.nan, -30.5])
+
+
+def test_bit_column_with_null():
+    axis = raw_axis(FieldType.BIT, [(b"\x05",), (None,), (bytearray(b"\x00\x01"),)])
+    assert axis.kind == "number"
+    np.testing.assert_array_equal(axis.values(), [5.0, np.nan, 1.0])
+
+
+def test_all_null_time_column():
+    axis = raw_axis(FieldType.TIME, [(None,), (None,)])
+    assert np.isnan(axis.values()).all()
+
+
+def test_numeric_column_with_null():
+    axis = raw_axis(FieldType.NEWDECIMAL, [(b"1.50",), (None,)])
+    np.testing.assert_array_equal(axis.values(), [1.5, np.nan])
@@ -0,0 +1,64 @@
+import pytest
+
+import sql_assistant
+
+SCHEMA = {
+    "hr": {
+        "employees": ["employee_id", "first_name", "date_of_birth", "dept_id"],
+        "salaries": ["employee_id", "amount", "from_date"],
+        "departments": ["dept_id", "name"],
+    }
+}
+
+
+def validate(sql):
+    return sql_assistant.validate_generated_sql(sql, SCHEMA)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT COUNT(*) FROM information_schema.tables",
+    "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'hr'",
+    "SELECT DIGEST_TEXT FROM performance_schema.events_statements_summary_by_digest",
+    "SELECT user, host FROM mysql.user",
+    "SELECT * FROM sys.schema_table_statistics",
+    "SELECT 1 FROM DUAL",
+    "SELECT dept_id, GROUP_CONCAT(first_name ORDER BY first_name SEPARATOR ', ') FROM hr.employees GROUP BY dept_id",
+    "SELECT CONVERT(name USING utf8mb4) FROM hr.departments",
+    "SELECT CHAR(65 USING ascii), CAST(amount AS DECIMAL(10,2)) FROM hr.salaries",
+    "SELECT EXTRACT(YEAR FROM date_of_birth) y, COUNT(*) FROM hr.employees GROUP BY y",
+    "SELECT TRIM(LEADING 'A' FROM first_name) FROM hr.employees",
+    "SELECT employee_id, amount FROM hr.employees JOIN hr.salaries USING (employee_id)",
+    "SELECT first_name, ROW_NUMBER() OVER (PARTITION BY dept_id ORDER BY date_of_birth) rn FROM hr.employees ORDER BY rn",
+    "SELECT first_name, RANK() OVER w AS r FROM hr.employees WINDOW w AS (ORDER BY date_of_birth)",
+    "SELECT employee_id, name FROM hr.employees NATURAL JOIN hr.departments",
+])
+def test_valid_sql_is_not_rejected(sql):
+    checked, repairs, problems = validate(sql)
+    assert problems == []
+    assert repairs == []
+    assert checked == sql
+
+
+@pytest.mark.parametrize("sql, problem", [
+    ("SELECT nope FROM hr.employees", "Column `nope` does not exist"),
+    ("SELECT GROUP_CONCAT(nope SEPARATOR ',') FROM hr.employees", "Column `nope` does not exist"),
+    ("SELECT employee_id FROM hr.employees e JOIN hr.salaries s ON e.employee_id = s.employee_id", "Column `employee_id` is ambiguous"),
+    ("SELECT 1 FROM hr.nothing_like_it", "Table `nothing_like_it` does not exist"),
+])
+def test_unresolved_references_are_rejected(sql, problem):
+    _, _, problems = validate(sql)
+    assert any(problem in p for p in problems), problems
+
+
+def test_typos_are_repaired():
+    checked, repairs, problems = validate("SELECT first_nme FROM hr.employes")
+    assert problems == []
+    assert checked == "SELECT `first_name` FROM `hr`.`employees`"
+    assert len(repairs) == 2
+
+
+def test_scanner_failure_lets_the_query_run(monkeypatch):
+    def broken(sql):
+        raise RuntimeError("scanner bug")
+    monkeypatch.setattr(sql_assistant, "scan_sql_references", broken)
+    assert validate("SELECT nope FROM hr.employees") == ("SELECT nope FROM hr.employees", [], [])
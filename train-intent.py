@@ -0,0 +1,114 @@
+import argparse
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+# Trains the chat intent classifier used by /chat to route conversational messages
+# straight to a reply (no schema fetch, no SQL generation).
+# Model: logistic regression over hashed character n-grams (see intent_features() in
+# sql_assistant.py), trained with full-batch gradient descent and L2 regularisation.
+# Writes the sparse weights to intent/weights.json and reports accuracy and latency on
+# the held-out eval set.
+#
+# Usage: python train-intent.py [--epochs 400] [--l2 1e-4]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+import sql_assistant # noqa: E402 (shares the featuriser with the server)
+
+LABELS = {"sql": 0, "conversational": 1}
+MIN_WEIGHT = 1e-3 # Weights smaller than this are dropped from the shipped file
+
+
+def load_examples(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(row["text"], LABELS[row["label"]]) for row in csv.DictReader(f, delimiter="\t")]
+
+
+def to_matrix(texts, buckets):
+    """Dense matrix over the buckets that actually occur, plus the bucket id of each column."""
+    rows = [sql_assistant.intent_features(text, buckets=buckets) for text in texts]
+    active = sorted({bucket for row in rows for bucket in row})
+    column = {bucket: j for j, bucket in enumerate(active)}
+    X = np.zeros((len(texts), len(active)), dtype=np.float64)
+    for i, row in enumerate(rows):
+        for bucket, value in row.items():
+            X[i, column[bucket]] = value
+    return X, active
+
+
+def train(X, y, epochs, learning_rate, l2):
+    weights = np.zeros(X.shape[1], dtype=np.float64)
+    bias = 0.0
+    # Balance the classes so the smaller one is not drowned out.
+    sample_weight = np.where(y == 1, 0.5 / y.mean(), 0.5 / (1 - y.mean()))
+    for _ in range(epochs):
+        p = 1.0 / (1.0 + np.exp(-(X @ weights + bias)))
+        error = (p - y) * sample_weight
+        weights -= learning_rate * (X.T @ error / len(y) + l2 * weights)
+        bias -= learning_rate * error.mean()
+    return weights, bias
+
+
+def evaluate(classifier, examples, threshold):
+    """Accuracy at 0.5, routed accuracy/coverage at the confidence threshold, and latency."""
+    correct = confident = confident_correct = sql_misrouted = 0
+    latencies = []
+    for text, label in examples:
+        started = time.perf_counter()
+        p = classifier.predict_proba(text)
+        latencies.append(time.perf_counter() - started)
+        correct += int((p >= 0.5) == bool(label))
+        if p >= threshold:
+            confident += 1
+            confident_correct += label
+            sql_misrouted += 1 - label # Data questions wrongly answered without SQL
+    latencies_us = np.array(latencies) * 1e6
+    conversational_total = sum(label for _, label in examples)
+    return {
+        "accuracy": correct / len(examples),
+        "conversational_recall_at_threshold": confident_correct / max(1, conversational_total),
+        "sql_misrouted_at_threshold": sql_misrouted,
+        "routed_precision": confident_correct / max(1, confident),
+        "latency_p50_us": float(np.percentile(latencies_us, 50)),
+        "latency_p99_us": float(np.percentile(latencies_us, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the chat intent classifier.")
+    parser.add_argument("--train", default=os.path.join(HERE, "intent", "train.tsv"))
+    parser.add_argument("--eval", default=os.path.join(HERE, "intent", "eval.tsv"))
+    parser.add_argument("--output", default=sql_assistant.INTENT_WEIGHTS_PATH)
+    parser.add_argument("--epochs", type=int, default=400)
+    parser.add_argument("--learning-rate", type=float, default=20.0)
+    parser.add_argument("--l2", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    examples = load_examples(args.train)
+    texts, labels = zip(*examples)
+    buckets = sql_assistant.INTENT_HASH_BUCKETS
+    X, active = to_matrix(texts, buckets)
+    weights, bias = train(X, np.array(labels, dtype=np.float64), args.epochs, args.learning_rate, args.l2)
+
+    kept = {str(bucket): round(float(w), 4) for bucket, w in zip(active, weights) if abs(w) >= MIN_WEIGHT}
+    model = {"ngram_range": list(sql_assistant.INTENT_NGRAM_RANGE), "buckets": buckets, "bias": round(float(bias), 4), "weights": kept}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(model, f, separators=(",", ":"))
+    print(f"Wrote {len(kept)} weights to {args.output} ({os.path.getsize(args.output) / 1024:.1f} KB)")
+
+    classifier = sql_assistant.IntentClassifier(args.output)
+    threshold = sql_assistant.INTENT_CONFIDENCE_THRESHOLD
+    for name, path in (("train", args.train), ("eval", args.eval)):
+        metrics = evaluate(classifier, load_examples(path), threshold)
+        print(f"{name:>5}: accuracy {metrics['accuracy']:.1%} | at threshold {threshold}: "
+              f"conversational recall {metrics['conversational_recall_at_threshold']:.1%}, "
+              f"precision {metrics['routed_precision']:.1%}, data questions misrouted {metrics['sql_misrouted_at_threshold']} | "
+              f"latency p50 {metrics['latency_p50_us']:.0f} us, p99 {metrics['latency_p99_us']:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import json
+
+# Prints the query shapes the app spends the most time on, from the local query log
+# (query_log.jsonl) matched to performance_schema statement digests on the primary and
+# every configured replica. Same data as GET /workload_report, without the server.
+#
+# Usage: python workload-report.py [--limit 20] [--by total_latency|rows_examined|count] [--json]
+
+import sql_assistant
+
+RANKINGS = ("total_latency", "rows_examined", "count")
+
+
+def shorten(text, width):
+    text = " ".join(str(text).split())
+    return text if len(text) <= width else text[:width - 3] + "..."
+
+
+def print_ranking(report, ranking):
+    entries = report["rankings"].get(ranking, [])
+    header = f"{'total ms':>11} {'avg ms':>9} {'count':>7} {'rows exam.':>11} {'rows sent':>10} {'hints':<22} statement / top question"
+    print(header)
+    print("-" * len(header))
+    for entry in entries:
+        print(f"{entry['total_latency_ms']:>11.1f} {entry['avg_latency_ms']:>9.2f} {entry['count']:>7} {entry['rows_examined']:>11} "
+              f"{entry['rows_sent']:>10} {','.join(entry['hints']) or '-':<22} {shorten(entry['sample_sql'], 80)}")
+        if entry["questions"]:
+            question, times = entry["questions"][0]
+            print(f"{'':>75} \"{shorten(question, 70)}\" x{times}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank the app's query shapes by performance_schema digest counters.")
+    parser.add_argument("--limit", type=int, default=sql_assistant.WORKLOAD_REPORT_LIMIT, help="Query shapes per ranking.")
+    parser.add_argument("--by", choices=RANKINGS, default="total_latency", help="Ranking to print.")
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON instead.")
+    args = parser.parse_args()
+
+    report = sql_assistant.build_workload_report(max(1, args.limit))
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return
+    if not report["logged_statements"]:
+        raise SystemExit(f"No statements logged yet in {sql_assistant.QUERY_LOG_PATH}.")
+    servers = ", ".join(f"{server['name']} ({server['status']})" for server in report["servers"]) or "none"
+    print(f"{report['logged_statements']} logged statements; servers: {servers}; matched by {report['matched_by'] or '-'}; "
+          f"{report['unmatched_statements']} not found in the digest tables")
+    print()
+    print_ranking(report, args.by)
+
+
+if __name__ == "__main__":
+    main()